@@ -0,0 +1,278 @@
+"""Approximate nearest-neighbour index for large face galleries.
+
+An IVF (inverted file) index: a k-means coarse quantizer splits the gallery
+into IVF_NLIST cells, a query only visits the IVF_NPROBE cells closest to it,
+and the shortlisted rows are re-ranked with exact face distances. Raising
+nprobe trades latency for recall.
+
+Build and persist the index from user_faces with:
+
+    python ann.py build [--nlist N] [--nprobe P]
+"""
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+
+from gallery import exact_distances
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# "flat" scans the whole gallery, "ivf" uses the index below
+GALLERY_INDEX = os.getenv('GALLERY_INDEX', 'flat').lower()
+# Number of k-means cells; 0 picks 4 * sqrt(N)
+IVF_NLIST = int(os.getenv('IVF_NLIST', '0'))
+# Cells visited per query
+IVF_NPROBE = int(os.getenv('IVF_NPROBE', '16'))
+IVF_INDEX_PATH = os.getenv('IVF_INDEX_PATH', 'ivf_index.npz')
+# Below this size brute force is already fast enough
+IVF_MIN_GALLERY_SIZE = int(os.getenv('IVF_MIN_GALLERY_SIZE', '50000'))
+
+INDEX_VERSION = 1
+TRAIN_SAMPLES_PER_LIST = 40
+CHUNK_SIZE = 65536
+
+
+def default_nlist(count):
+    return max(1, min(int(4 * np.sqrt(count)), count // TRAIN_SAMPLES_PER_LIST or 1))
+
+
+def nearest_centroids(encodings, centroids, n=1):
+    """Indices of the n nearest centroids for every encoding, shape (len(encodings), n)"""
+    centroid_sq = np.einsum("ij,ij->i", centroids, centroids)
+    n = min(n, len(centroids))
+    result = np.empty((len(encodings), n), dtype=np.int32)
+    for start in range(0, len(encodings), CHUNK_SIZE):
+        chunk = encodings[start:start + CHUNK_SIZE]
+        # |x|^2 is constant per row, so it does not change the ranking
+        scores = centroid_sq - 2.0 * (chunk @ centroids.T)
+        if n == 1:
+            result[start:start + len(chunk), 0] = np.argmin(scores, axis=1)
+        else:
+            nearest = np.argpartition(scores, n - 1, axis=1)[:, :n]
+            order = np.argsort(np.take_along_axis(scores, nearest, axis=1), axis=1)
+            result[start:start + len(chunk)] = np.take_along_axis(nearest, order, axis=1)
+    return result
+
+
+def train_centroids(encodings, nlist, iterations=10, seed=0):
+    """Lloyd's k-means on a sample of the gallery.
+
+    A gallery smaller than nlist gets one cell per encoding.
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(encodings), nlist * TRAIN_SAMPLES_PER_LIST)
+    nlist = min(nlist, sample_size)
+    sample = encodings[rng.choice(len(encodings), sample_size, replace=False)]
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+    for _ in range(iterations):
+        labels = nearest_centroids(sample, centroids)[:, 0]
+        counts = np.bincount(labels, minlength=nlist)
+        filled = counts > 0
+        # Per-cell sums over the sample sorted by cell
+        order = np.argsort(labels, kind="stable")
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        sums = np.add.reduceat(sample[order], starts[filled], axis=0)
+        centroids[filled] = sums / counts[filled, None]
+        # Re-seed empty cells from random samples
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = sample[rng.choice(sample_size, len(empty), replace=False)]
+    return centroids
+
+
+class IVFIndex:
+    """Inverted lists of gallery row numbers, kept in step with FaceGallery.
+
+    The gallery calls add/remove as rows change, so the lists always refer to
+    current row positions (including rows moved by swap-removal).
+    """
+
+    def __init__(self, centroids, nprobe=IVF_NPROBE, persisted_assignments=None):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float64)
+        self.nprobe = nprobe
+        self.lists = [[] for _ in range(len(self.centroids))]
+        self._assign = np.empty(0, dtype=np.int32)
+        self._slot = np.empty(0, dtype=np.int64)
+        # face_id -> list from a saved index, reused on the next rebuild
+        self._persisted = persisted_assignments or {}
+        self.recall = None
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def train(cls, encodings, nlist=None, nprobe=IVF_NPROBE, iterations=10, seed=0):
+        nlist = nlist or default_nlist(len(encodings))
+        return cls(train_centroids(encodings, nlist, iterations, seed), nprobe)
+
+    def rebuild(self, encodings, face_ids=None):
+        """Assign every gallery row to a list"""
+        count = len(encodings)
+        assign = np.full(count, -1, dtype=np.int32)
+        if face_ids is not None and self._persisted:
+            for i, face_id in enumerate(face_ids):
+                assign[i] = self._persisted.get(face_id, -1)
+        self._persisted = {}
+        missing = np.flatnonzero(assign < 0)
+        if len(missing):
+            assign[missing] = nearest_centroids(encodings[missing], self.centroids)[:, 0]
+
+        self._assign = assign
+        self._slot = np.empty(count, dtype=np.int64)
+        order = np.argsort(assign, kind="stable")
+        bounds = np.searchsorted(assign[order], np.arange(self.nlist + 1))
+        for c in range(self.nlist):
+            rows = order[bounds[c]:bounds[c + 1]]
+            self._slot[rows] = np.arange(len(rows))
+            self.lists[c] = rows.tolist()
+
+    def add(self, row, encoding):
+        if row >= len(self._assign):
+            capacity = max(2 * len(self._assign), row + 1, 1024)
+            self._assign = np.resize(self._assign, capacity)
+            self._slot = np.resize(self._slot, capacity)
+        c = int(nearest_centroids(encoding[None, :], self.centroids)[0, 0])
+        self._assign[row] = c
+        self._slot[row] = len(self.lists[c])
+        self.lists[c].append(row)
+
+    def remove(self, row, last):
+        """Drop row; the gallery then moves its last row into the gap"""
+        c, s = self._assign[row], self._slot[row]
+        members = self.lists[c]
+        tail = members.pop()
+        if tail != row:
+            members[s] = tail
+            self._slot[tail] = s
+        if row != last:
+            c, s = self._assign[last], self._slot[last]
+            self.lists[c][s] = row
+            self._assign[row] = c
+            self._slot[row] = s
+
+    def candidates(self, face_encoding, nprobe=None):
+        """Gallery rows in the nprobe cells nearest to the query"""
+        cells = nearest_centroids(face_encoding[None, :], self.centroids, nprobe or self.nprobe)[0]
+        rows = [row for c in cells for row in self.lists[c]]
+        return np.fromiter(rows, dtype=np.int64, count=len(rows))
+
+    def save(self, path, face_ids):
+        """Persist centroids plus each face's list so a restart skips assignment"""
+        count = len(face_ids)
+        np.savez(
+            path,
+            version=INDEX_VERSION,
+            centroids=self.centroids,
+            nprobe=self.nprobe,
+            face_ids=np.asarray(face_ids, dtype=str),
+            assign=self._assign[:count],
+            recall=np.nan if self.recall is None else self.recall["recall"],
+        )
+
+    @classmethod
+    def load(cls, path, nprobe=None):
+        with np.load(path) as data:
+            if int(data["version"]) != INDEX_VERSION:
+                raise ValueError(f"Unsupported IVF index version {int(data['version'])}")
+            persisted = dict(zip(data["face_ids"].tolist(), data["assign"].tolist()))
+            return cls(data["centroids"], nprobe or int(data["nprobe"]), persisted)
+
+
+def measure_recall(gallery, index, queries=200, noise=0.02, seed=0):
+    """Top-1 recall of the index against brute force on perturbed gallery rows"""
+    rng = np.random.default_rng(seed)
+    with gallery.view() as (encodings, _):
+        n = len(encodings)
+        if n == 0:
+            return None
+        rows = rng.choice(n, min(queries, n), replace=False)
+        probes = encodings[rows] + rng.normal(scale=noise, size=(len(rows), encodings.shape[1]))
+
+        hits, flat_time, ivf_time = 0, 0.0, 0.0
+        for probe in probes:
+            start = time.perf_counter()
+            expected = int(np.argmin(gallery.distances(probe)))
+            flat_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            shortlist = index.candidates(probe)
+            found = -1
+            if len(shortlist):
+                found = int(shortlist[np.argmin(exact_distances(encodings[shortlist], probe))])
+            ivf_time += time.perf_counter() - start
+            hits += found == expected
+
+    index.recall = {
+        "recall": hits / len(probes),
+        "queries": len(probes),
+        "nlist": index.nlist,
+        "nprobe": index.nprobe,
+        "flat_ms": 1000 * flat_time / len(probes),
+        "ivf_ms": 1000 * ivf_time / len(probes),
+    }
+    return index.recall
+
+
+def load_or_build(gallery, path=IVF_INDEX_PATH):
+    """Attach an IVF index to the gallery, loading it from path when possible"""
+    if len(gallery) < IVF_MIN_GALLERY_SIZE:
+        logger.info(f"Gallery has {len(gallery)} encodings, below IVF_MIN_GALLERY_SIZE; using flat search")
+        return None
+    index = None
+    if os.path.exists(path):
+        try:
+            index = IVFIndex.load(path, IVF_NPROBE)
+            logger.info(f"Loaded IVF index with {index.nlist} lists from {path}")
+        except Exception as e:
+            logger.warning(f"Could not load IVF index from {path}, retraining: {e}")
+    if index is None:
+        with gallery.view() as (encodings, _):
+            index = IVFIndex.train(encodings, IVF_NLIST or None, IVF_NPROBE)
+        logger.info(f"Trained IVF index with {index.nlist} lists")
+    gallery.attach_index(index)
+    recall = measure_recall(gallery, index)
+    logger.info(
+        f"IVF recall@1 {recall['recall']:.3f} with nprobe={recall['nprobe']} "
+        f"({recall['ivf_ms']:.2f} ms vs {recall['flat_ms']:.2f} ms flat)"
+    )
+    return index
+
+
+def build(path=IVF_INDEX_PATH, nlist=None, nprobe=IVF_NPROBE):
+    """Train an index on the current user_faces table and save it"""
+    from gallery import FaceGallery
+
+    gallery = FaceGallery()
+    gallery.load()
+    if len(gallery) == 0:
+        print("No face encodings in user_faces, nothing to index.")
+        return
+    start = time.perf_counter()
+    with gallery.view() as (encodings, _):
+        index = IVFIndex.train(encodings, nlist, nprobe)
+    gallery.attach_index(index)
+    print(f"Trained {index.nlist} lists on {len(gallery)} encodings in {time.perf_counter() - start:.1f}s")
+    recall = measure_recall(gallery, index)
+    print(
+        f"recall@1={recall['recall']:.3f} over {recall['queries']} queries, nprobe={recall['nprobe']}: "
+        f"{recall['ivf_ms']:.2f} ms/query vs {recall['flat_ms']:.2f} ms/query flat"
+    )
+    with gallery.view() as (_, face_ids):
+        index.save(path, face_ids.tolist())
+    print(f"Saved IVF index to {path}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Build the IVF face index from user_faces")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("--path", default=IVF_INDEX_PATH)
+    parser.add_argument("--nlist", type=int, default=IVF_NLIST or None)
+    parser.add_argument("--nprobe", type=int, default=IVF_NPROBE)
+    args = parser.parse_args()
+    build(args.path, args.nlist, args.nprobe)
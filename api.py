@@ -1,121 +1,228 @@
-from fastapi import APIRouter, File, UploadFile, Form, Depends, HTTPException, status
+from fastapi import APIRouter, File, UploadFile, Form, Query, Depends, HTTPException, status
 from fastapi.security.api_key import APIKeyHeader
-import face_recognition
-import numpy as np
+from typing import List, Literal, Optional
+import asyncio
+import json
 import uuid
 import io
-from db import get_db_cursor, get_db_connection
+import zipfile
+from db_async import database, upsert_user, insert_faces, PoolTimeout
+from gallery import gallery, MATCH_TOLERANCE, MATCH_STRATEGY
+from compute import encode_faces, locate_and_encode_faces, single_face_error
+from metrics import stage
+from preprocess import IMAGE_EXTENSIONS
 import os
 
 router = APIRouter()
 
 API_KEY = os.getenv('API_KEY', 'mysecretkey')
+MAX_BATCH_IMAGES = int(os.getenv('MAX_BATCH_IMAGES', '100'))
+# Total size of the images in one batch, counted uncompressed for zip entries
+MAX_BATCH_BYTES = int(os.getenv('MAX_BATCH_BYTES', str(200 * 1024 * 1024)))
+MAX_TOP_K = int(os.getenv('MAX_TOP_K', '20'))
 api_key_header = APIKeyHeader(name='X-API-Key')
 
 def get_api_key(api_key: str = Depends(api_key_header)):
     if api_key != API_KEY:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid API Key")
 
+def parse_boxes(boxes):
+    """Client-supplied candidate face boxes: the JSON "faces" list of a /detect response"""
+    if boxes is None:
+        return None
+    try:
+        parsed = [(int(box["x"]), int(box["y"]), int(box["width"]), int(box["height"]))
+                  for box in json.loads(boxes)]
+    except (ValueError, TypeError, KeyError) as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                          detail=f"Invalid boxes, expected a JSON list of x/y/width/height objects: {str(e)}")
+    if any(w <= 0 or h <= 0 for (_, _, w, h) in parsed):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid boxes, width and height must be positive")
+    return parsed
+
 @router.post("/register", dependencies=[Depends(get_api_key)])
-async def register_face(name: str = Form(...), file: UploadFile = File(...)):
+async def register_face(name: str = Form(...), file: UploadFile = File(...), boxes: Optional[str] = Form(None)):
     try:
-        image_bytes = await file.read()
-        
-        try:
-            # Reset file position and try first method
-            await file.seek(0)
-            img = face_recognition.load_image_file(file.file)
-        except Exception:
-            # If first method fails, use bytes directly
-            img = face_recognition.load_image_file(io.BytesIO(image_bytes))
+        with stage("read"):
+            image_bytes = await file.read()
         
-        encodings = face_recognition.face_encodings(img)
-        if len(encodings) == 0:
-            return {"error": "No face detected in the image."}
-        if len(encodings) > 1:
-            return {"error": "Multiple faces detected. Please upload an image with a single face."}
+        # Decode and encode on the compute pool so the event loop stays free
+        encodings = await encode_faces(image_bytes, parse_boxes(boxes))
+        error = single_face_error(encodings)
+        if error:
+            return {"error": error}
         
         face_encoding = encodings[0]
         registration_id = str(uuid.uuid4())
         
-        # Use context manager for proper resource handling
         try:
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    # Insert or get user
-                    cur.execute(
-                        "INSERT INTO users (name) VALUES (%s) ON CONFLICT (name) DO NOTHING RETURNING id",
-                        (name,)
-                    )
-                    result = cur.fetchone()
-                    if result is None:
-                        cur.execute("SELECT id FROM users WHERE name = %s", (name,))
-                        result = cur.fetchone()
-                        if result is None:
-                            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, 
-                                              detail="Failed to create or retrieve user.")
-                    
-                    user_id = result[0]
-                    
-                    # Store face encoding with registration_id for consistency with WebSocket API
-                    cur.execute(
-                        "INSERT INTO user_faces (user_id, face_encoding, registration_id) VALUES (%s, %s, %s)",
-                        (user_id, face_encoding.tobytes(), registration_id)
-                    )
+            async with database.transaction() as conn:
+                user_id = await upsert_user(conn, name)
+                # Store face encoding with registration_id for consistency with WebSocket API
+                face_id, = await insert_faces(conn, user_id, [face_encoding], registration_id)
+            
+            # Make the new face recognizable without reloading the gallery
+            gallery.add(face_id, user_id, name, face_encoding)
                     
             return {"message": f"Registered {name} successfully.", "registration_id": registration_id}
+        except PoolTimeout as e:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
         except Exception as e:
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, 
                               detail=f"Database error: {str(e)}")
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                           detail=f"Face registration failed: {str(e)}")
 
+def match_response(match):
+    """Response body for one query encoding's best gallery match"""
+    if match is not None and match.distance <= MATCH_TOLERANCE:
+        confidence = float(max(0, 1 - match.distance))
+        result = {"id": match.user_id, "name": match.name, "confidence": confidence}
+        if match.votes is not None:
+            result["votes"] = match.votes
+        return {"matches": [result], "strategy": MATCH_STRATEGY}
+    else:
+        return {"matches": [], "message": "No match found.", "strategy": MATCH_STRATEGY}
+
+def face_box(location):
+    """face_recognition (top, right, bottom, left) as the x/y/width/height used by /detect"""
+    top, right, bottom, left = location
+    return {"x": int(left), "y": int(top), "width": int(right - left), "height": int(bottom - top)}
+
+def candidate_response(match):
+    result = {
+        "id": match.user_id,
+        "name": match.name,
+        "distance": match.distance,
+        "confidence": float(max(0, 1 - match.distance)),
+        "is_match": match.distance <= MATCH_TOLERANCE,
+    }
+    if match.votes is not None:
+        result["votes"] = match.votes
+    return result
+
+async def recognize_all_faces(image_bytes, top_k, boxes=None):
+    """Encode every face in one pass and return its box and top-k gallery candidates"""
+    locations, encodings = await locate_and_encode_faces(image_bytes, boxes)
+    if len(encodings) == 0:
+        return {"error": "No face detected in the image."}
+    
+    candidates = gallery.top_k(encodings, top_k)
+    return {"faces": [
+        {"box": face_box(location), "candidates": [candidate_response(match) for match in matches]}
+        for location, matches in zip(locations, candidates)
+    ], "strategy": MATCH_STRATEGY}
+
 @router.post("/recognize", dependencies=[Depends(get_api_key)])
-async def recognize_face(file: UploadFile = File(...)):
+async def recognize_face(
+    file: UploadFile = File(...),
+    mode: Literal["single", "multi"] = Query("single"),
+    top_k: int = Query(1, ge=1, le=MAX_TOP_K),
+    boxes: Optional[str] = Form(None)
+):
+    # Boxes from an earlier /detect call stand in for the detection pass
+    candidate_boxes = parse_boxes(boxes)
     try:
-        image_bytes = await file.read()
-        img = face_recognition.load_image_file(io.BytesIO(image_bytes))
+        with stage("read"):
+            image_bytes = await file.read()
         
-        encodings = face_recognition.face_encodings(img)
-        if len(encodings) == 0:
-            return {"error": "No face detected in the image."}
-        if len(encodings) > 1:
-            return {"error": "Multiple faces detected. Please upload an image with a single face."}
+        # Multi-face mode: every detected face with its top-k candidates
+        if mode == "multi":
+            return await recognize_all_faces(image_bytes, top_k, candidate_boxes)
+        
+        encodings = await encode_faces(image_bytes, candidate_boxes)
+        error = single_face_error(encodings)
+        if error:
+            return {"error": error}
         
         face_encoding = encodings[0]
         
-        # Use context manager for database operations
+        # Match against the in-memory gallery with one vectorized distance computation
         try:
-            with get_db_cursor() as cur:
-                cur.execute("SELECT u.id, u.name, uf.face_encoding FROM users u JOIN user_faces uf ON u.id = uf.user_id")
-                users = cur.fetchall()
-            
-            best_match = None
-            best_distance = None
-            best_name = None
-            best_id = None
-            for user_id, name, encoding_bytes in users:
-                db_encoding = np.frombuffer(encoding_bytes, dtype=np.float64)
-                distance = face_recognition.face_distance([db_encoding], face_encoding)[0]
-                if best_distance is None or distance < best_distance:
-                    best_distance = distance
-                    best_match = db_encoding
-                    best_name = name
-                    best_id = user_id
-            
-            # Threshold for match (same as compare_faces default tolerance=0.6)
-            if best_distance is not None and best_distance <= 0.6:
-                confidence = float(max(0, 1 - best_distance))
-                return {"matches": [{"id": best_id, "name": best_name, "confidence": confidence}]}
-            else:
-                return {"matches": [], "message": "No match found."}
+            return match_response(gallery.best_match(face_encoding))
                 
         except Exception as e:
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                              detail=f"Database error during recognition: {str(e)}")
+                              detail=f"Gallery error during recognition: {str(e)}")
     
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                           detail=f"Face recognition failed: {str(e)}")
+
+async def read_batch_images(files):
+    """Flatten uploaded images and zip archives into (filename, bytes) pairs.
+
+    Zip archives are checked against MAX_BATCH_IMAGES and MAX_BATCH_BYTES
+    from their entry headers before anything is extracted.
+    """
+    images = []
+    total_bytes = 0
+
+    def check_limits(count, size):
+        if count > MAX_BATCH_IMAGES:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                              detail=f"Too many images in batch (max {MAX_BATCH_IMAGES}).")
+        if size > MAX_BATCH_BYTES:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                              detail=f"Batch images too large (max {MAX_BATCH_BYTES} bytes).")
+
+    for file in files:
+        with stage("read"):
+            contents = await file.read()
+        if file.content_type in ("application/zip", "application/x-zip-compressed") \
+                or (file.filename or "").lower().endswith(".zip"):
+            try:
+                with zipfile.ZipFile(io.BytesIO(contents)) as archive:
+                    entries = [entry for entry in archive.infolist()
+                               if not entry.is_dir() and entry.filename.lower().endswith(IMAGE_EXTENSIONS)]
+                    total_bytes += sum(entry.file_size for entry in entries)
+                    check_limits(len(images) + len(entries), total_bytes)
+                    # zipfile never inflates an entry past its declared file_size
+                    for entry in entries:
+                        images.append((entry.filename, archive.read(entry)))
+            except zipfile.BadZipFile:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                  detail=f"Invalid zip archive: {file.filename}")
+        else:
+            images.append((file.filename, contents))
+            total_bytes += len(contents)
+        check_limits(len(images), total_bytes)
+    return images
+
+@router.post("/recognize/batch", dependencies=[Depends(get_api_key)])
+async def recognize_batch(files: List[UploadFile] = File(...)):
+    images = await read_batch_images(files)
+    
+    try:
+        # Encode every image concurrently on the compute pool
+        outcomes = await asyncio.gather(
+            *(encode_faces(image_bytes) for _, image_bytes in images),
+            return_exceptions=True
+        )
+        
+        results = []
+        queries = []
+        for (filename, _), encodings in zip(images, outcomes):
+            if isinstance(encodings, Exception):
+                results.append({"filename": filename, "error": f"Face recognition failed: {str(encodings)}"})
+            elif single_face_error(encodings):
+                results.append({"filename": filename, "error": single_face_error(encodings)})
+            else:
+                results.append({"filename": filename})
+                queries.append((len(results) - 1, encodings[0]))
+        
+        # Match all query encodings against the gallery in one (Q, N) operation
+        if queries:
+            matches = gallery.best_matches([encoding for _, encoding in queries])
+            for (i, _), match in zip(queries, matches):
+                results[i].update(match_response(match))
+        
+        return {"results": results}
+    
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                          detail=f"Batch recognition failed: {str(e)}")
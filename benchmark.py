@@ -0,0 +1,443 @@
+"""Offline benchmarks for matching, detection and enrollment.
+
+    python benchmark.py [--sizes 1000,100000,1000000] [--output results.json]
+                        [--compare baseline.json] [--only match,detect,...]
+
+Scenarios:
+
+    match         gallery matching behind /recognize, one query at a time,
+                  on synthetic galleries of random 128-d encodings
+    match_batch   the same in blocks of queries, as /recognize/batch does
+    detect        POST /detect requests per second
+    ws_detect     /ws/detect frames per second, one frame in flight like a
+                  camera client waiting for boxes (also ?mode=track)
+    ws_register   duration of a whole /ws/register session (needs face_recognition)
+
+PostgreSQL is replaced by in-memory stand-ins for both connection pools, so
+nothing but the Python dependencies is needed. Results are printed and
+written as JSON; --compare checks them against an earlier run and exits
+non-zero if a scenario got slower by more than --tolerance.
+"""
+import argparse
+import datetime
+import importlib.util
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import uuid
+from contextlib import asynccontextmanager
+from unittest import mock
+
+import numpy as np
+
+IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests", "images")
+DEFAULT_SIZES = (1000, 100000, 1000000)
+SCENARIOS = ("match", "match_batch", "detect", "ws_detect", "ws_register")
+# Frames per /ws/register session; the server requires at least 5
+REGISTER_IMAGES = 5
+# Synthetic galleries are generated in chunks of this many rows
+GENERATE_CHUNK = 100000
+
+
+class OfflinePool:
+    """Stands in for psycopg2's pool so db.py imports without a server.
+
+    The benchmarks never use the synchronous pool; anything that tries to
+    fails loudly instead of waiting on a connection.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._used = {}
+        self._pool = []
+
+    def getconn(self, key=None):
+        raise RuntimeError("No PostgreSQL server in benchmark mode")
+
+    def putconn(self, conn, key=None, close=False):
+        pass
+
+    def closeall(self):
+        pass
+
+
+class MemoryConnection:
+    """The statements db_async issues, answered from a MemoryPool's tables"""
+
+    def __init__(self, store):
+        self.store = store
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def fetchval(self, query, *args):
+        if query.startswith("INSERT INTO users"):
+            return self.store.users.setdefault(args[0], uuid.uuid4())
+        if query.startswith("SELECT 1 FROM cancel_points"):
+            return 1 if args[0] in self.store.cancel_points else None
+        if query == "SELECT 1":
+            return 1
+        raise NotImplementedError(f"MemoryConnection cannot run: {query}")
+
+    async def execute(self, query, *args):
+        if query.startswith("INSERT INTO cancel_points"):
+            self.store.cancel_points.add(args[0])
+            return "INSERT 0 1"
+        raise NotImplementedError(f"MemoryConnection cannot run: {query}")
+
+    async def copy_records_to_table(self, table, columns, records):
+        self.store.tables.setdefault(table, []).extend(records)
+        return f"COPY {len(records)}"
+
+
+class MemoryPool:
+    """In-memory stand-in for the asyncpg pool behind db_async.database"""
+
+    def __init__(self):
+        self.users = {}
+        self.cancel_points = set()
+        self.tables = {}
+
+    async def acquire(self, timeout=None):
+        return MemoryConnection(self)
+
+    async def release(self, conn):
+        pass
+
+    async def close(self):
+        pass
+
+    def get_size(self):
+        return 1
+
+    def get_idle_size(self):
+        return 1
+
+
+def import_db_offline():
+    """Import db.py with OfflinePool in place of the pool it connects on import"""
+    with mock.patch("psycopg2.pool.ThreadedConnectionPool", OfflinePool):
+        import db
+    return db
+
+
+def install_offline_database():
+    """Import the application against the in-memory database stand-ins.
+
+    Must run before anything imports db.py, whose pool connects on import.
+    """
+    import_db_offline()
+    import db_async
+
+    db_async.database.pool = MemoryPool()
+    return db_async.database.pool
+
+
+def summarize(samples):
+    """Latency percentiles in ms and throughput for durations in seconds"""
+    ms = 1000 * np.asarray(samples, dtype=np.float64)
+    return {
+        "count": len(ms),
+        "mean_ms": round(float(ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "max_ms": round(float(ms.max()), 3),
+        "per_second": round(len(ms) / (ms.sum() / 1000), 2) if ms.sum() else None,
+    }
+
+
+def synthetic_encodings(size, shots_per_user=5, seed=0):
+    """(encodings, user_codes) with shots clustered around per-user centroids like real encodings"""
+    from gallery import ENCODING_SIZE
+
+    rng = np.random.default_rng(seed)
+    users = max(1, size // shots_per_user)
+    # dlib encodings have components of about +-0.1; shots of one person sit ~0.4 apart
+    centroids = rng.normal(scale=0.1, size=(users, ENCODING_SIZE))
+    user_codes = np.arange(size, dtype=np.int64) % users
+    encodings = np.empty((size, ENCODING_SIZE), dtype=np.float64)
+    for start in range(0, size, GENERATE_CHUNK):
+        end = min(size, start + GENERATE_CHUNK)
+        encodings[start:end] = centroids[user_codes[start:end]]
+        encodings[start:end] += rng.normal(scale=0.025, size=(end - start, ENCODING_SIZE))
+    return encodings, user_codes
+
+
+def load_synthetic_gallery(gallery, size, seed=0):
+    """Replace the gallery with size synthetic encodings; returns the seconds it took"""
+    encodings, user_codes = synthetic_encodings(size, seed=seed)
+    users = int(user_codes.max()) + 1 if size else 0
+    face_ids = np.array([str(uuid.UUID(int=i)) for i in range(size)], dtype=object)
+    user_ids = [str(uuid.UUID(int=(1 << 64) + i)) for i in range(users)]
+    names = [f"user-{i}" for i in range(users)]
+    started = time.perf_counter()
+    gallery.replace_arrays(encodings, face_ids, user_codes, user_ids, names)
+    return time.perf_counter() - started
+
+
+def match_queries(gallery, count, seed=1):
+    """Half perturbed gallery rows (matches), half fresh random encodings (misses)"""
+    rng = np.random.default_rng(seed)
+    with gallery.view() as (encodings, _):
+        hits = encodings[rng.integers(0, len(encodings), count - count // 2)]
+        hits = hits + rng.normal(scale=0.01, size=hits.shape)
+    misses = rng.normal(scale=0.1, size=(count // 2, hits.shape[1]))
+    queries = np.concatenate([hits, misses])
+    rng.shuffle(queries)
+    return queries
+
+
+def bench_match(sizes, queries, index=None):
+    """Per-query and batched matching latency for each gallery size"""
+    from api import match_response
+    from gallery import gallery
+
+    results = []
+    for size in sizes:
+        load_seconds = load_synthetic_gallery(gallery, size)
+        extra = {"gallery_size": size, "load_s": round(load_seconds, 3)}
+        if index == "ivf":
+            import ann
+
+            with gallery.view() as (encodings, _):
+                index_obj = ann.IVFIndex.train(encodings)
+            gallery.attach_index(index_obj)
+            extra.update(index="ivf", recall=ann.measure_recall(gallery, index_obj)["recall"])
+        probes = match_queries(gallery, queries)
+
+        samples = []
+        for probe in probes:
+            started = time.perf_counter()
+            match_response(gallery.best_match(probe))
+            samples.append(time.perf_counter() - started)
+        results.append({"name": f"match/{size}", **extra, **summarize(samples)})
+
+        block = 32
+        samples = []
+        for start in range(0, len(probes), block):
+            chunk = probes[start:start + block]
+            started = time.perf_counter()
+            [match_response(match) for match in gallery.best_matches(chunk)]
+            # Per query, so the figures compare with the one-at-a-time run
+            samples.extend([(time.perf_counter() - started) / len(chunk)] * len(chunk))
+        results.append({"name": f"match_batch/{size}", "batch": block, **extra, **summarize(samples)})
+        gallery.attach_index(None)
+        print_result(results[-2])
+        print_result(results[-1])
+    return results
+
+
+def jittered_frames(path, count, seed=0):
+    """Distinct JPEG frames of one image, so repeated frames never hit the encoding cache"""
+    import cv2
+
+    image = cv2.imread(path)
+    if image is None:
+        raise SystemExit(f"Could not read image {path}")
+    rng = np.random.default_rng(seed)
+    frames = []
+    for _ in range(count):
+        noisy = cv2.add(image, rng.integers(0, 3, image.shape, dtype=np.uint8))
+        ok, buffer = cv2.imencode(".jpg", noisy, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        frames.append(buffer.tobytes())
+    return frames
+
+
+def bench_detect(client, frames):
+    samples = []
+    for frame in frames:
+        started = time.perf_counter()
+        response = client.post("/detect", files={"file": ("frame.jpg", frame, "image/jpeg")})
+        samples.append(time.perf_counter() - started)
+        response.raise_for_status()
+    return {"name": "detect", "faces": len(response.json()["faces"]), **summarize(samples)}
+
+
+def bench_ws_detect(client, frames, mode=None):
+    from frames import BINARY_SUBPROTOCOL, pack_frame
+
+    url = "/ws/detect" + (f"?mode={mode}" if mode else "")
+    samples = []
+    with client.websocket_connect(url, subprotocols=[BINARY_SUBPROTOCOL]) as websocket:
+        for seq, frame in enumerate(frames):
+            started = time.perf_counter()
+            websocket.send_bytes(pack_frame(frame, seq))
+            response = websocket.receive_json()
+            samples.append(time.perf_counter() - started)
+            if response.get("type") != "faces":
+                raise RuntimeError(f"/ws/detect failed: {response}")
+    name = "ws_detect" + (f"_{mode}" if mode else "")
+    return {"name": name, "faces": len(response["faces"]), **summarize(samples)}
+
+
+def bench_ws_register(client, sessions):
+    """Time one /ws/register session per list of frames in sessions"""
+    from frames import BINARY_SUBPROTOCOL, pack_frame
+
+    samples = []
+    for session, frames in enumerate(sessions):
+        started = time.perf_counter()
+        with client.websocket_connect("/ws/register", subprotocols=[BINARY_SUBPROTOCOL]) as websocket:
+            websocket.send_json({"type": "start", "name": f"benchmark-{session}"})
+            websocket.receive_json()
+            for seq, frame in enumerate(frames):
+                websocket.send_bytes(pack_frame(frame, seq))
+            websocket.send_json({"type": "finish"})
+            while True:
+                response = websocket.receive_json()
+                if response["type"] in ("done", "error", "stopped"):
+                    break
+        if response["type"] != "done":
+            raise RuntimeError(f"/ws/register failed: {response}")
+        samples.append(time.perf_counter() - started)
+    return {"name": "ws_register", "images": len(frames), **summarize(samples)}
+
+
+def print_result(result):
+    if "skipped" in result:
+        print(f"{result['name']:<24} skipped: {result['skipped']}", file=sys.stderr)
+        return
+    print(
+        f"{result['name']:<24} p50 {result['p50_ms']:>9.3f} ms  p95 {result['p95_ms']:>9.3f} ms  "
+        f"{result['per_second'] or 0:>9.1f}/s",
+        file=sys.stderr,
+    )
+
+
+def environment():
+    """What the results depend on besides the code, for comparing runs"""
+    import compute
+    import detector
+    import gallery
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "encode_executor": compute.ENCODE_EXECUTOR,
+        "encode_pipeline": compute.ENCODE_PIPELINE,
+        "detector_backend": detector.DETECTOR_BACKEND,
+        "detect_working_size": detector.DETECT_WORKING_SIZE,
+        "match_strategy": gallery.MATCH_STRATEGY,
+    }
+
+
+def run(sizes=DEFAULT_SIZES, scenarios=SCENARIOS, queries=200, frames=50, sessions=3,
+        detect_image=None, register_image=None, index=None):
+    """Run the selected scenarios and return {"environment": ..., "results": [...]}"""
+    install_offline_database()
+    import compute
+
+    results = []
+    if "match" in scenarios or "match_batch" in scenarios:
+        results.extend(
+            r for r in bench_match(sizes, queries, index)
+            if r["name"].split("/")[0] in scenarios
+        )
+
+    client = None
+    if any(s in scenarios for s in ("detect", "ws_detect", "ws_register")):
+        from fastapi.testclient import TestClient
+        from main import app
+
+        # Without the lifespan: the compute pools start on first use
+        client = TestClient(app)
+        detect_frames = jittered_frames(detect_image or os.path.join(IMAGES_DIR, "multi_face.png"), frames)
+
+    try:
+        if "detect" in scenarios:
+            results.append(bench_detect(client, detect_frames))
+            print_result(results[-1])
+        if "ws_detect" in scenarios:
+            for mode in (None, "track"):
+                results.append(bench_ws_detect(client, detect_frames, mode))
+                print_result(results[-1])
+        if "ws_register" in scenarios:
+            if importlib.util.find_spec("face_recognition") is None:
+                results.append({"name": "ws_register", "skipped": "face_recognition is not installed"})
+            else:
+                register_frames = jittered_frames(
+                    register_image or os.path.join(IMAGES_DIR, "one_face.jpg"), REGISTER_IMAGES * (sessions + 1), seed=1)
+                frame_sets = [register_frames[i:i + REGISTER_IMAGES]
+                              for i in range(0, len(register_frames), REGISTER_IMAGES)]
+                # The first session also pays for loading the dlib models and is not timed
+                bench_ws_register(client, frame_sets[:1])
+                results.append(bench_ws_register(client, frame_sets[1:]))
+            print_result(results[-1])
+    finally:
+        compute.shutdown_executors()
+
+    return {"environment": environment(), "results": results}
+
+
+def compare(baseline, current, tolerance=0.2):
+    """Messages for every scenario that got slower than baseline by more than tolerance"""
+    previous = {result["name"]: result for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        old = previous.get(result["name"])
+        if old is None or "skipped" in old or "skipped" in result:
+            continue
+        for key in ("p50_ms", "p95_ms"):
+            if result[key] > old[key] * (1 + tolerance):
+                regressions.append(f"{result['name']}: {key} {old[key]:.3f} -> {result[key]:.3f}")
+        if old["per_second"] and result["per_second"] < old["per_second"] * (1 - tolerance):
+            regressions.append(f"{result['name']}: per_second {old['per_second']:.1f} -> {result['per_second']:.1f}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark matching, detection and enrollment without a database")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES),
+                        help="comma-separated synthetic gallery sizes")
+    parser.add_argument("--only", default=",".join(SCENARIOS), help="comma-separated scenarios to run")
+    parser.add_argument("--queries", type=int, default=200, help="match queries per gallery size")
+    parser.add_argument("--frames", type=int, default=50, help="frames per detection scenario")
+    parser.add_argument("--sessions", type=int, default=3, help="timed /ws/register sessions")
+    parser.add_argument("--index", choices=["flat", "ivf"], default="flat", help="gallery search for match scenarios")
+    parser.add_argument("--detect-image", help="image for the detection scenarios")
+    parser.add_argument("--register-image", help="single-face image for /ws/register")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="earlier results JSON to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown as a fraction")
+    args = parser.parse_args()
+    # The test client logs every request it makes
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    scenarios = [s for s in args.only.split(",") if s]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    report = run(
+        sizes=[int(s) for s in args.sizes.split(",") if s], scenarios=scenarios, queries=args.queries,
+        frames=args.frames, sessions=args.sessions, detect_image=args.detect_image,
+        register_image=args.register_image, index=args.index,
+    )
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.tolerance)
+        for message in regressions:
+            print(f"REGRESSION {message}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -1,80 +1,198 @@
+import asyncio
 import logging
-from db import get_db_cursor, get_db_connection
+import os
+import time
+from db import get_db_connection
+from gallery_sync import TOMBSTONE_RETENTION_HOURS
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def cleanup_cancelled_registrations():
-    """Clean up face data from cancelled registrations"""
-    try:
-        logger.info("Starting cleanup of cancelled registrations")
-        
-        # Get all cancelled registration IDs
-        cancelled_ids = []
-        with get_db_cursor() as cur:
-            cur.execute("SELECT registration_id FROM cancel_points")
-            cancelled_ids = [row[0] for row in cur.fetchall()]
-            
-        if not cancelled_ids:
-            logger.info("No cancelled registrations to clean up")
-            return
-            
-        logger.info(f"Found {len(cancelled_ids)} cancelled registrations to clean up")
-        
-        # Process each cancelled registration
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                for reg_id in cancelled_ids:
-                    try:
-                        # Find and delete user_faces with this registration_id
-                        cur.execute("DELETE FROM user_faces WHERE registration_id = %s RETURNING user_id", (reg_id,))
-                        affected_users = {row[0] for row in cur.fetchall()}
-                        
-                        # Check if any users no longer have face data and should be removed
-                        for user_id in affected_users:
-                            cur.execute("SELECT COUNT(*) FROM user_faces WHERE user_id = %s", (user_id,))
-                            if cur.fetchone()[0] == 0:
-                                cur.execute("DELETE FROM users WHERE id = %s", (user_id,))
-                                logger.info(f"Deleted user {user_id} with no remaining face data")
-                        
-                        # Remove the cancel point
-                        cur.execute("DELETE FROM cancel_points WHERE registration_id = %s", (reg_id,))
-                        logger.info(f"Successfully processed cancelled registration: {reg_id}")
-                    
-                    except Exception as e:
-                        logger.error(f"Error cleaning up registration {reg_id}: {e}")
-                        # Continue with other registrations even if one fails
-        
-        logger.info("Cleanup completed successfully")
-    
-    except Exception as e:
-        logger.error(f"Error during cleanup process: {e}")
-        raise
-
-def cleanup_orphaned_faces():
-    """Clean up face data that has no associated user (could happen from failed transactions)"""
-    try:
-        logger.info("Starting cleanup of orphaned face records")
-        
-        with get_db_cursor() as cur:
-            # Delete face data where the user_id doesn't exist
+# Rows (or cancel points) handled per transaction, so no run holds locks for long
+CLEANUP_BATCH_SIZE = int(os.getenv('CLEANUP_BATCH_SIZE', '1000'))
+# Seconds between cleanup runs inside the server; 0 disables the scheduler
+CLEANUP_INTERVAL = float(os.getenv('CLEANUP_INTERVAL', '3600'))
+
+# Arbitrary key for the advisory lock that keeps concurrent runs (several
+# server workers, or the script next to a server) from doing the same work
+CLEANUP_LOCK_KEY = 7305841
+
+def cleanup_cancelled_registrations(conn, batch_size=CLEANUP_BATCH_SIZE):
+    """Clean up face data from cancelled registrations, a batch of cancel points per transaction"""
+    totals = {"registrations": 0, "faces_deleted": 0, "users_deleted": 0, "batches": 0}
+    logger.info("Starting cleanup of cancelled registrations")
+    while True:
+        with conn.cursor() as cur:
+            # Faces and cancel points of a whole batch go in one statement;
+            # SKIP LOCKED leaves cancel points another transaction holds
             cur.execute("""
-                DELETE FROM user_faces
-                WHERE user_id NOT IN (SELECT id FROM users)
-                RETURNING id
-            """)
-            deleted = cur.fetchall()
-            
-            if deleted:
-                logger.info(f"Deleted {len(deleted)} orphaned face records")
-            else:
-                logger.info("No orphaned face records found")
-    
-    except Exception as e:
-        logger.error(f"Error cleaning up orphaned faces: {e}")
+                WITH batch AS (
+                    SELECT registration_id FROM cancel_points
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                ), deleted_faces AS (
+                    DELETE FROM user_faces uf USING batch
+                    WHERE uf.registration_id = batch.registration_id
+                    RETURNING uf.user_id
+                ), deleted_points AS (
+                    DELETE FROM cancel_points cp USING batch
+                    WHERE cp.registration_id = batch.registration_id
+                    RETURNING cp.registration_id
+                )
+                SELECT
+                    (SELECT COUNT(*) FROM deleted_points),
+                    (SELECT COUNT(*) FROM deleted_faces),
+                    ARRAY(SELECT DISTINCT user_id FROM deleted_faces WHERE user_id IS NOT NULL)
+            """, (batch_size,))
+            registrations, faces, user_ids = cur.fetchone()
+            users = 0
+            if user_ids:
+                # A separate statement, so it sees the faces deleted above
+                cur.execute("""
+                    DELETE FROM users u
+                    WHERE u.id = ANY(%s::uuid[])
+                    AND NOT EXISTS (SELECT 1 FROM user_faces uf WHERE uf.user_id = u.id)
+                """, (user_ids,))
+                users = cur.rowcount
+        conn.commit()
+        if not registrations:
+            break
+        totals["registrations"] += registrations
+        totals["faces_deleted"] += faces
+        totals["users_deleted"] += users
+        totals["batches"] += 1
+        if registrations < batch_size:
+            break
+    logger.info(
+        f"Cleaned up {totals['registrations']} cancelled registrations: "
+        f"{totals['faces_deleted']} faces and {totals['users_deleted']} users deleted"
+    )
+    return totals
+
+def _delete_in_batches(conn, query, batch_size, *params):
+    """Run a DELETE ... LIMIT-style statement until it deletes fewer rows than a batch"""
+    deleted = 0
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(query, params + (batch_size,))
+            count = cur.rowcount
+        conn.commit()
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+def cleanup_orphaned_faces(conn, batch_size=CLEANUP_BATCH_SIZE):
+    """Clean up face data that has no associated user (could happen from failed transactions)"""
+    logger.info("Starting cleanup of orphaned face records")
+    # NOT EXISTS is an index anti-join; NOT IN never matched NULL user ids
+    deleted = _delete_in_batches(conn, """
+        DELETE FROM user_faces WHERE id IN (
+            SELECT uf.id FROM user_faces uf
+            WHERE uf.user_id IS NULL
+            OR NOT EXISTS (SELECT 1 FROM users u WHERE u.id = uf.user_id)
+            LIMIT %s
+        )
+    """, batch_size)
+    logger.info(f"Deleted {deleted} orphaned face records")
+    return deleted
+
+def cleanup_tombstones(conn, batch_size=CLEANUP_BATCH_SIZE):
+    """Prune deletion tombstones that every gallery replica has already caught up on"""
+    logger.info("Starting cleanup of gallery tombstones")
+    deleted = _delete_in_batches(conn, """
+        DELETE FROM user_face_tombstones WHERE face_id IN (
+            SELECT face_id FROM user_face_tombstones
+            WHERE deleted_at < LOCALTIMESTAMP - %s * INTERVAL '1 hour'
+            LIMIT %s
+        )
+    """, batch_size, TOMBSTONE_RETENTION_HOURS)
+    logger.info(f"Deleted {deleted} gallery tombstones")
+    return deleted
+
+def run_cleanup(batch_size=CLEANUP_BATCH_SIZE):
+    """Run every cleanup step once and return the run's metrics"""
+    started = time.perf_counter()
+    metrics = {"started_at": time.time(), "skipped": False}
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (CLEANUP_LOCK_KEY,))
+            locked = cur.fetchone()[0]
+        conn.commit()
+        if not locked:
+            logger.info("Another cleanup run is in progress, skipping")
+            metrics["skipped"] = True
+        else:
+            try:
+                metrics.update(cleanup_cancelled_registrations(conn, batch_size))
+                metrics["orphaned_faces_deleted"] = cleanup_orphaned_faces(conn, batch_size)
+                metrics["tombstones_deleted"] = cleanup_tombstones(conn, batch_size)
+            finally:
+                conn.rollback()
+                with conn.cursor() as cur:
+                    cur.execute("SELECT pg_advisory_unlock(%s)", (CLEANUP_LOCK_KEY,))
+                conn.commit()
+    metrics["duration_ms"] = round(1000 * (time.perf_counter() - started), 2)
+    return metrics
+
+class CleanupScheduler:
+    """Runs run_cleanup every CLEANUP_INTERVAL seconds from the server's event loop.
+
+    Each run happens on a worker thread and its metrics are kept for
+    /health; a failed run is logged and retried at the next interval.
+    """
+
+    def __init__(self, interval=CLEANUP_INTERVAL, batch_size=CLEANUP_BATCH_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.runs = 0
+        self.failures = 0
+        self.last_run = None
+        self.last_error = None
+        self._task = None
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.run_once()
+
+    async def run_once(self):
+        try:
+            self.last_run = await asyncio.to_thread(run_cleanup, self.batch_size)
+            self.last_error = None
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e)
+            logger.error(f"Scheduled cleanup failed: {e}")
+        finally:
+            self.runs += 1
+        return self.last_run
+
+    def stats(self):
+        return {
+            "interval": self.interval,
+            "runs": self.runs,
+            "failures": self.failures,
+            "last_run": self.last_run,
+            "last_error": self.last_error,
+        }
+
+# Process-wide scheduler, started in the application lifespan
+cleanup_scheduler = CleanupScheduler()
 
 if __name__ == "__main__":
-    cleanup_cancelled_registrations()
-    cleanup_orphaned_faces()
-    print("Cleanup process completed.")
+    metrics = run_cleanup()
+    print(f"Cleanup process completed: {metrics}")
@@ -0,0 +1,362 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+import detector
+import metrics
+import preprocess
+import profiling
+from encoding_cache import encoding_cache
+from metrics import stage
+from tracking import iou
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+CPU_COUNT = os.cpu_count() or 1
+
+# dlib encoding holds the GIL, so it runs in worker processes by default
+ENCODE_EXECUTOR = os.getenv('ENCODE_EXECUTOR', 'process').lower()
+ENCODE_WORKERS = int(os.getenv('ENCODE_WORKERS', str(CPU_COUNT)))
+# OpenCV releases the GIL, so detection only needs threads
+DETECT_WORKERS = int(os.getenv('DETECT_WORKERS', str(CPU_COUNT)))
+# How faces are found before encoding: "two_stage" runs the cheap detector
+# cascade and then HOG only on padded crops around its boxes; "full" runs
+# face_recognition's HOG detector over the whole image
+ENCODE_PIPELINE = os.getenv('ENCODE_PIPELINE', 'two_stage').lower()
+# Margin added on every side of a candidate box before HOG, as a fraction of its size
+ENCODE_CROP_PADDING = float(os.getenv('ENCODE_CROP_PADDING', '0.5'))
+# Candidates whose refined locations overlap more than this are the same face
+ENCODE_DUPLICATE_IOU = 0.5
+# Side of the synthetic image each worker runs its warm-up inference on
+WARMUP_IMAGE_SIZE = 160
+
+# Model load and warm-up timings of this process, set by load_models
+_models = None
+
+def _location_box(location):
+    top, right, bottom, left = location
+    return (left, top, right - left, bottom - top)
+
+
+def refine_face_locations(rgb, boxes, padding=ENCODE_CROP_PADDING):
+    """HOG face locations inside padded crops around candidate (x, y, width, height) boxes.
+
+    Boxes and the returned (top, right, bottom, left) locations are in rgb's
+    pixels. Candidates HOG does not confirm are dropped, which filters the
+    cascade's false positives and gives the encoder the box framing it was
+    trained with.
+    """
+    import face_recognition
+
+    height, width = rgb.shape[:2]
+    locations = []
+    for (x, y, w, h) in boxes:
+        pad_x, pad_y = int(w * padding), int(h * padding)
+        left, top = max(0, x - pad_x), max(0, y - pad_y)
+        right, bottom = min(width, x + w + pad_x), min(height, y + h + pad_y)
+        if right <= left or bottom <= top:
+            continue
+        crop = np.ascontiguousarray(rgb[top:bottom, left:right])
+        for (t, r, b, l) in face_recognition.face_locations(crop):
+            location = (t + top, r + left, b + top, l + left)
+            # Overlapping candidates find the same face twice
+            box = _location_box(location)
+            if all(iou(box, _location_box(other)) <= ENCODE_DUPLICATE_IOU for other in locations):
+                locations.append(location)
+    return locations
+
+
+def find_face_locations(img, boxes=None, pipeline=ENCODE_PIPELINE):
+    """(top, right, bottom, left) face locations in a PreparedImage's working pixels.
+
+    boxes are optional candidate (x, y, width, height) boxes in original
+    pixels, e.g. from a previous /detect call; they replace the cascade pass.
+    """
+    import face_recognition
+
+    if boxes is None:
+        if pipeline == "full":
+            with stage("locate"):
+                return face_recognition.face_locations(img.rgb)
+        boxes = [(b["x"], b["y"], b["width"], b["height"])
+                 for b in detector.detect_faces(img.bgr, scale=img.scale)]
+    working = [tuple(int(round(v * img.scale)) for v in box) for box in boxes]
+    with stage("locate"):
+        return refine_face_locations(img.rgb, working)
+
+
+def face_locations_and_encodings_from_bytes(image_bytes, boxes=None):
+    """Locations (in original pixels) and encodings of every face, detecting faces only once"""
+    import face_recognition
+
+    img = preprocess.load_image(image_bytes)
+    locations = find_face_locations(img, boxes)
+    with stage("encode"):
+        encodings = face_recognition.face_encodings(img.rgb, known_face_locations=locations)
+    return [img.location_to_original(location) for location in locations], encodings
+
+
+def single_face_error(encodings):
+    """Why an image cannot be used for registration or single-face recognition, or None"""
+    if len(encodings) == 0:
+        return "No face detected in the image."
+    if len(encodings) > 1:
+        return "Multiple faces detected. Please upload an image with a single face."
+    return None
+
+
+def face_encodings_at_from_bytes(image_bytes, boxes):
+    """One encoding per already-known (x, y, width, height) face box, or None.
+
+    Each box is refined with HOG as in the two-stage pipeline, so the
+    encodings are framed like the gallery's; a box HOG does not confirm
+    gets None.
+    """
+    import face_recognition
+
+    img = preprocess.load_image(image_bytes)
+    locations = []
+    with stage("locate"):
+        for box in boxes:
+            working = tuple(int(round(v * img.scale)) for v in box)
+            # A padded crop can also catch a neighbouring face; keep the one on the box
+            found = [(iou(working, _location_box(location)), location)
+                     for location in refine_face_locations(img.rgb, [working])]
+            best = max(found, default=(0, None))
+            locations.append(best[1] if best[0] > 0 else None)
+    confirmed = [location for location in locations if location is not None]
+    with stage("encode"):
+        encodings = iter(face_recognition.face_encodings(img.rgb, known_face_locations=confirmed))
+    return [next(encodings) if location is not None else None for location in locations]
+
+
+def detect_faces_from_bytes(image_bytes):
+    """Run the shared face detector on an encoded image; returns None if it cannot be decoded"""
+    try:
+        img = preprocess.load_image(image_bytes, max_side=detector.DETECT_WORKING_SIZE)
+    except preprocess.ImageDecodeError:
+        return None
+    return detector.detect_faces(img.bgr, scale=img.scale)
+
+
+def track_faces_from_bytes(tracker, image_bytes):
+    """Advance a FaceTracker by one encoded frame; returns None if it cannot be decoded"""
+    try:
+        img = preprocess.load_image(image_bytes, max_side=detector.DETECT_WORKING_SIZE)
+    except preprocess.ImageDecodeError:
+        return None
+    # The tracker works in working-image pixels; clients get original ones
+    tracks, full_detection = tracker.update(img.bgr, scale=img.scale)
+    return [img.box_to_original(track) for track in tracks], full_detection
+
+
+def load_models():
+    """Load the dlib models of this worker process and run each of them once.
+
+    face_recognition loads its detector, shape predictor and encoder when
+    it is first imported, and the first inference is slower still. Pools
+    run this when a worker starts, so no request pays for either.
+    """
+    global _models
+    if _models is None:
+        started = time.perf_counter()
+        import face_recognition
+
+        loaded = time.perf_counter()
+        image = np.full((WARMUP_IMAGE_SIZE, WARMUP_IMAGE_SIZE, 3), 128, dtype=np.uint8)
+        face_recognition.face_locations(image)
+        # A fixed box runs the landmark and encoding networks whatever the image shows
+        margin = WARMUP_IMAGE_SIZE // 10
+        face_recognition.face_encodings(image, known_face_locations=[
+            (margin, WARMUP_IMAGE_SIZE - margin, WARMUP_IMAGE_SIZE - margin, margin)
+        ])
+        detector.preload()
+        _models = {
+            "pid": os.getpid(),
+            "load_ms": round(1000 * (loaded - started), 1),
+            "warmup_ms": round(1000 * (time.perf_counter() - loaded), 1),
+        }
+    return _models
+
+
+def _worker_models():
+    """load_models() result tagged with the worker it ran in"""
+    return {**load_models(), "thread": threading.get_ident()}
+
+
+class ComputeExecutor:
+    """Runs CPU-bound work off the event loop and tracks its load.
+
+    in_flight counts submitted jobs that have not finished; whatever exceeds
+    the worker count is waiting in the pool's queue.
+    """
+
+    def __init__(self, name, kind, max_workers, initializer=None):
+        self.name = name
+        self.kind = kind
+        self.max_workers = max(1, max_workers)
+        # Run in every worker as it starts
+        self.initializer = initializer
+        self.in_flight = 0
+        self.completed = 0
+        self._pool = None
+
+    def start(self):
+        if self._pool is None:
+            if self.kind == "process":
+                # spawn avoids forking the server's threads and DB connections
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=self.initializer
+                )
+            else:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix=self.name,
+                    initializer=self.initializer
+                )
+            logger.info(f"Started {self.name} executor with {self.max_workers} {self.kind} workers")
+        return self._pool
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def run(self, fn, *args):
+        """Await fn(*args) on the pool, recording the stages it timed and its queue wait"""
+        pool = self.start()
+        self.in_flight += 1
+        started = time.perf_counter()
+        profile = profiling.current()
+        try:
+            if profile is None:
+                result, stages, ran = await asyncio.get_running_loop().run_in_executor(
+                    pool, metrics.run_collecting, fn, *args)
+            else:
+                # Profiled in the worker, where the decode and dlib time is spent
+                (result, stages, ran), stats = await asyncio.get_running_loop().run_in_executor(
+                    pool, profiling.run_profiled, metrics.run_collecting, fn, *args)
+                profile.add_worker_stats(stats)
+            metrics.record_stages(stages)
+            # Whatever the worker did not spend running fn went to queueing and transfer
+            metrics.observe_stage(f"{self.name}_queue", max(0.0, time.perf_counter() - started - ran))
+            return result
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+
+    @property
+    def queue_depth(self):
+        return max(0, self.in_flight - self.max_workers)
+
+    def stats(self):
+        return {
+            "kind": self.kind,
+            "workers": self.max_workers,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "completed": self.completed,
+        }
+
+
+encode_executor = ComputeExecutor("encode", ENCODE_EXECUTOR, ENCODE_WORKERS, initializer=load_models)
+# Detector models are per thread (see detector.py)
+detect_executor = ComputeExecutor("detect", "thread", DETECT_WORKERS, initializer=detector.preload)
+
+metrics.registry.gauge(
+    "face_executor_in_flight", "Jobs submitted to a compute pool and not finished",
+    lambda: {e.name: e.in_flight for e in (encode_executor, detect_executor)}, ["executor"])
+metrics.registry.gauge(
+    "face_executor_queue_depth", "Jobs waiting for a free compute worker",
+    lambda: {e.name: e.queue_depth for e in (encode_executor, detect_executor)}, ["executor"])
+
+
+def start_executors():
+    encode_executor.start()
+    detect_executor.start()
+
+
+async def warm_up(rounds=3):
+    """Start every encode and detect worker, returning the encode workers' model timings.
+
+    Pools only start a worker when a job finds none idle, so jobs are sent
+    in rounds of one per worker until each worker has answered, or rounds
+    run out.
+    """
+    workers = {}
+    for _ in range(rounds):
+        results = await asyncio.gather(*(
+            encode_executor.run(_worker_models) for _ in range(encode_executor.max_workers)
+        ))
+        workers.update(((r["pid"], r["thread"]), r) for r in results)
+        if len(workers) >= encode_executor.max_workers:
+            break
+    await asyncio.gather(*(detect_executor.run(detector.preload) for _ in range(detect_executor.max_workers)))
+    return list(workers.values())
+
+
+def shutdown_executors():
+    encode_executor.shutdown()
+    detect_executor.shutdown()
+
+
+def executor_stats():
+    return {
+        "encode": encode_executor.stats(),
+        "detect": detect_executor.stats(),
+    }
+
+
+def _picklable(image_bytes):
+    # Worker processes receive their arguments pickled, which memoryviews are not
+    if encode_executor.kind == "process" and isinstance(image_bytes, memoryview):
+        return bytes(image_bytes)
+    return image_bytes
+
+
+async def encode_faces(image_bytes, boxes=None):
+    """Face encodings for an uploaded image, computed on the encode pool"""
+    _, encodings = await locate_and_encode_faces(image_bytes, boxes)
+    return encodings
+
+
+async def _locate_and_encode_uncached(image_bytes, boxes=None):
+    return await encode_executor.run(face_locations_and_encodings_from_bytes, _picklable(image_bytes), boxes)
+
+
+async def locate_and_encode_faces(image_bytes, boxes=None):
+    """(locations, encodings) for an uploaded image, computed on the encode pool.
+
+    Results are cached by image content, so a retried upload or the same
+    photo sent to register and then recognize is only encoded once.
+    Requests with client-supplied candidate boxes bypass the cache.
+    """
+    if boxes is not None:
+        return await _locate_and_encode_uncached(image_bytes, boxes)
+    locations, encodings = await encoding_cache.get_or_compute(image_bytes, _locate_and_encode_uncached)
+    # Fresh lists, so callers cannot change what the cache holds
+    return list(locations), list(encodings)
+
+
+async def encode_faces_at(image_bytes, boxes):
+    """One encoding (or None) per given face box, computed on the encode pool"""
+    return await encode_executor.run(face_encodings_at_from_bytes, _picklable(image_bytes), boxes)
+
+
+async def detect_faces(image_bytes):
+    """Face detections for an uploaded image, computed on the detect pool"""
+    return await detect_executor.run(detect_faces_from_bytes, image_bytes)
+
+
+async def track_faces(tracker, image_bytes):
+    """(tracks, full_detection) for the next frame of a tracked stream, computed on the detect pool"""
+    return await detect_executor.run(track_faces_from_bytes, tracker, image_bytes)
@@ -3,6 +3,7 @@ import psycopg2.pool
 import os
 from dotenv import load_dotenv
 from contextlib import contextmanager
+from metrics import registry
 
 load_dotenv()
 
@@ -12,8 +13,9 @@ DB_NAME = os.getenv('DB_NAME', 'facedb')
 DB_USER = os.getenv('DB_USER', 'faceuser')
 DB_PASS = os.getenv('DB_PASS', 'facepass')
 
-# Connection pool to efficiently manage database connections
-pool = psycopg2.pool.SimpleConnectionPool(
+# Connection pool for the synchronous callers (gallery loading, cleanup, CLIs);
+# thread-safe because gallery loads can run on background threads
+pool = psycopg2.pool.ThreadedConnectionPool(
     minconn=1,
     maxconn=10,
     host=DB_HOST,
@@ -23,6 +25,10 @@ pool = psycopg2.pool.SimpleConnectionPool(
     password=DB_PASS
 )
 
+registry.gauge(
+    "face_db_sync_pool_connections", "Connections of the synchronous psycopg2 pool by state",
+    lambda: {"used": len(pool._used), "idle": len(pool._pool)}, ["state"])
+
 @contextmanager
 def get_db_connection():
     """Get a database connection from the pool with context management"""
@@ -57,30 +63,82 @@ def get_db_conn():
         password=DB_PASS
     )
 
+# Arbitrary key for the advisory lock that serializes schema setup, so
+# workers and replicas starting together do not run the DDL concurrently
+SCHEMA_LOCK_KEY = 7305840
+
+# Schema statements shared by init_tables and the async layer in db_async.py;
+# callers run SCHEMA_SQL and NOTIFY_TRIGGER_SQL in one transaction, which
+# holds the lock until it commits
+SCHEMA_SQL = f'''
+    SELECT pg_advisory_xact_lock({SCHEMA_LOCK_KEY});
+    CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
+    CREATE TABLE IF NOT EXISTS users (
+        id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+        name TEXT NOT NULL UNIQUE,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS user_faces (
+        id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+        user_id UUID REFERENCES users(id) ON DELETE CASCADE,
+        face_encoding BYTEA NOT NULL,
+        registration_id UUID,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS cancel_points (
+        registration_id UUID PRIMARY KEY,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS user_face_tombstones (
+        face_id UUID PRIMARY KEY,
+        deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_user_faces_created_at ON user_faces (created_at);
+    CREATE INDEX IF NOT EXISTS idx_user_faces_registration_id ON user_faces (registration_id);
+    CREATE INDEX IF NOT EXISTS idx_user_faces_user_id ON user_faces (user_id);
+    CREATE INDEX IF NOT EXISTS idx_user_face_tombstones_deleted_at ON user_face_tombstones (deleted_at);
+'''
+
+# Publish inserts/deletes so in-memory galleries can sync incrementally;
+# tombstones let a replica that missed notifications catch up on deletes
+NOTIFY_TRIGGER_SQL = '''
+    CREATE OR REPLACE FUNCTION notify_user_faces_change() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            INSERT INTO user_face_tombstones (face_id) VALUES (OLD.id)
+            ON CONFLICT (face_id) DO UPDATE SET deleted_at = EXCLUDED.deleted_at;
+            PERFORM pg_notify('user_faces_changed',
+                json_build_object('op', 'DELETE', 'id', OLD.id)::text);
+            RETURN OLD;
+        END IF;
+        PERFORM pg_notify('user_faces_changed',
+            json_build_object('op', 'INSERT', 'id', NEW.id)::text);
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+    -- Only created when missing: dropping and recreating it would lock
+    -- user_faces against reads and writes on every start
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_trigger
+            WHERE tgname = 'user_faces_change' AND tgrelid = 'user_faces'::regclass
+        ) THEN
+            CREATE TRIGGER user_faces_change
+                AFTER INSERT OR DELETE ON user_faces
+                FOR EACH ROW EXECUTE FUNCTION notify_user_faces_change();
+        END IF;
+    END;
+    $$;
+'''
+
 def init_tables():
     """Initialize database tables"""
     try:
         with get_db_connection() as conn:
             with conn.cursor() as cur:
-                cur.execute('''
-                    CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
-                    CREATE TABLE IF NOT EXISTS users (
-                        id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
-                        name TEXT NOT NULL UNIQUE,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    );
-                    CREATE TABLE IF NOT EXISTS user_faces (
-                        id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
-                        user_id UUID REFERENCES users(id) ON DELETE CASCADE,
-                        face_encoding BYTEA NOT NULL,
-                        registration_id UUID,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    );
-                    CREATE TABLE IF NOT EXISTS cancel_points (
-                        registration_id UUID PRIMARY KEY,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    );
-                ''')
+                cur.execute(SCHEMA_SQL)
+                cur.execute(NOTIFY_TRIGGER_SQL)
     except Exception as e:
         print(f"Error initializing tables: {e}")
         raise
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+import asyncpg
+
+from metrics import registry, stage, observe_stage
+from db import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASS, SCHEMA_SQL, NOTIFY_TRIGGER_SQL
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '2'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '20'))
+# Seconds a request waits for a free connection before failing with 503
+DB_ACQUIRE_TIMEOUT = float(os.getenv('DB_ACQUIRE_TIMEOUT', '5'))
+# Seconds before a single statement is cancelled
+DB_COMMAND_TIMEOUT = float(os.getenv('DB_COMMAND_TIMEOUT', '30'))
+# Idle connections are closed after this many seconds, so dead ones do not linger
+DB_MAX_IDLE = float(os.getenv('DB_MAX_IDLE', '300'))
+
+
+class PoolTimeout(Exception):
+    """No database connection became free within DB_ACQUIRE_TIMEOUT"""
+
+
+class AsyncDatabase:
+    """asyncpg connection pool used by the request handlers.
+
+    Unlike the psycopg2 pool in db.py, waiting for a connection or a query
+    never blocks the event loop, so a slow database only delays the
+    requests that use it. Acquisitions are timed so pool saturation shows
+    up in stats() before it shows up as timeouts.
+    """
+
+    def __init__(self, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+                 acquire_timeout=DB_ACQUIRE_TIMEOUT):
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.pool = None
+        self.acquisitions = 0
+        self.timeouts = 0
+        self.waiting = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    async def start(self):
+        if self.pool is None:
+            self.pool = await asyncpg.create_pool(
+                host=DB_HOST,
+                port=DB_PORT,
+                database=DB_NAME,
+                user=DB_USER,
+                password=DB_PASS,
+                min_size=self.min_size,
+                max_size=self.max_size,
+                command_timeout=DB_COMMAND_TIMEOUT,
+                max_inactive_connection_lifetime=DB_MAX_IDLE,
+            )
+            logger.info(f"Started async database pool ({self.min_size}-{self.max_size} connections)")
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    @asynccontextmanager
+    async def connection(self):
+        """A pooled connection, raising PoolTimeout if none frees up in time"""
+        if self.pool is None:
+            raise RuntimeError("Async database pool is not started")
+        started = time.perf_counter()
+        self.waiting += 1
+        try:
+            conn = await self.pool.acquire(timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise PoolTimeout(f"No database connection available within {self.acquire_timeout}s")
+        finally:
+            self.waiting -= 1
+        waited = time.perf_counter() - started
+        observe_stage("db_acquire", waited)
+        self.acquisitions += 1
+        self.wait_seconds_total += waited
+        self.wait_seconds_max = max(self.wait_seconds_max, waited)
+        try:
+            yield conn
+        finally:
+            await self.pool.release(conn)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """A pooled connection inside a transaction, committed on success"""
+        with stage("db"):
+            async with self.connection() as conn:
+                async with conn.transaction():
+                    yield conn
+
+    async def ping(self):
+        """Round-trip time of a trivial query in ms, for health checks"""
+        started = time.perf_counter()
+        async with self.connection() as conn:
+            await conn.fetchval("SELECT 1")
+        return round(1000 * (time.perf_counter() - started), 2)
+
+    def stats(self):
+        started = self.pool is not None
+        return {
+            "size": self.pool.get_size() if started else 0,
+            "idle": self.pool.get_idle_size() if started else 0,
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "waiting": self.waiting,
+            "acquisitions": self.acquisitions,
+            "timeouts": self.timeouts,
+            "wait_ms_avg": round(1000 * self.wait_seconds_total / self.acquisitions, 3) if self.acquisitions else 0.0,
+            "wait_ms_max": round(1000 * self.wait_seconds_max, 3),
+        }
+
+
+async def init_tables(database):
+    """Create the schema and the user_faces change trigger"""
+    async with database.transaction() as conn:
+        await conn.execute(SCHEMA_SQL)
+        await conn.execute(NOTIFY_TRIGGER_SQL)
+
+
+async def upsert_user(conn, name):
+    """Id of the user with this name, creating it if needed, in one round trip"""
+    # DO UPDATE (rather than DO NOTHING) makes RETURNING yield the existing row
+    return await conn.fetchval(
+        "INSERT INTO users (name) VALUES ($1) ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name RETURNING id",
+        name
+    )
+
+
+async def insert_faces(conn, user_id, encodings, registration_id):
+    """COPY all encodings of a registration in one round trip; returns their ids in order"""
+    # Ids are generated here because COPY cannot return them
+    face_ids = [uuid.uuid4() for _ in encodings]
+    await conn.copy_records_to_table(
+        "user_faces",
+        columns=["id", "user_id", "face_encoding", "registration_id"],
+        records=[
+            (face_id, user_id, encoding.tobytes(), uuid.UUID(str(registration_id)))
+            for face_id, encoding in zip(face_ids, encodings)
+        ],
+    )
+    return face_ids
+
+
+async def is_cancelled(conn, registration_id):
+    return await conn.fetchval(
+        "SELECT 1 FROM cancel_points WHERE registration_id = $1", uuid.UUID(str(registration_id))
+    ) is not None
+
+
+async def mark_cancelled(conn, registration_id):
+    await conn.execute(
+        "INSERT INTO cancel_points (registration_id) VALUES ($1) ON CONFLICT DO NOTHING",
+        uuid.UUID(str(registration_id))
+    )
+
+
+# Process-wide pool, started in the application lifespan
+database = AsyncDatabase()
+
+registry.gauge(
+    "face_db_pool_connections", "Connections of the asyncpg pool by state",
+    lambda: {"open": database.stats()["size"], "idle": database.stats()["idle"],
+             "waiting": database.stats()["waiting"]}, ["state"])
+registry.gauge(
+    "face_db_pool_acquisitions_total", "Connections handed out by the asyncpg pool",
+    lambda: database.acquisitions, kind="counter")
+registry.gauge(
+    "face_db_pool_timeouts_total", "Requests that gave up waiting for an asyncpg connection",
+    lambda: database.timeouts, kind="counter")
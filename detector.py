@@ -0,0 +1,149 @@
+import logging
+import os
+import threading
+
+import cv2
+
+from metrics import stage
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# "haar" (OpenCV cascade) or "hog" (dlib frontal face detector)
+DETECTOR_BACKEND = os.getenv('DETECTOR_BACKEND', 'haar').lower()
+# Images are downscaled so their longest side is at most this many pixels
+# before detection; 0 disables downscaling
+DETECT_WORKING_SIZE = int(os.getenv('DETECT_WORKING_SIZE', '640'))
+
+CASCADE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "haarcascade_frontalface_default.xml")
+
+
+class FaceDetector:
+    """Detector backend interface.
+
+    detect() takes a BGR image and returns (x, y, width, height) boxes in that
+    image's coordinates. Backend models are not safe to share between
+    threads, so each thread lazily gets its own instance, created once.
+    """
+
+    name = None
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _model(self):
+        model = getattr(self._local, "model", None)
+        if model is None:
+            model = self._local.model = self.load()
+        return model
+
+    def load(self):
+        raise NotImplementedError
+
+    def detect(self, image):
+        raise NotImplementedError
+
+
+class HaarDetector(FaceDetector):
+    name = "haar"
+
+    def __init__(self, cascade_path=CASCADE_PATH, scale_factor=1.1, min_neighbors=5, min_size=30):
+        super().__init__()
+        self.cascade_path = cascade_path
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_size = min_size
+
+    def load(self):
+        cascade = cv2.CascadeClassifier(self.cascade_path)
+        if cascade.empty():
+            raise RuntimeError(f"Could not load Haar cascade from {self.cascade_path}")
+        return cascade
+
+    def detect(self, image, min_size=None):
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        size = min_size or self.min_size
+        faces = self._model().detectMultiScale(
+            gray,
+            scaleFactor=self.scale_factor,
+            minNeighbors=self.min_neighbors,
+            minSize=(size, size)
+        )
+        return [tuple(int(v) for v in face) for face in faces]
+
+
+class HogDetector(FaceDetector):
+    name = "hog"
+
+    def __init__(self, upsample=0):
+        super().__init__()
+        self.upsample = upsample
+
+    def load(self):
+        import dlib
+
+        return dlib.get_frontal_face_detector()
+
+    def detect(self, image, min_size=None):
+        rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB) if image.ndim == 3 else image
+        rects = self._model()(rgb, self.upsample)
+        return [(r.left(), r.top(), r.right() - r.left(), r.bottom() - r.top()) for r in rects]
+
+
+BACKENDS = {
+    HaarDetector.name: HaarDetector,
+    HogDetector.name: HogDetector,
+}
+
+_detectors = {}
+_detectors_lock = threading.Lock()
+
+
+def get_detector(backend=None):
+    """Shared detector for a backend, created on first use"""
+    backend = backend or DETECTOR_BACKEND
+    with _detectors_lock:
+        detector = _detectors.get(backend)
+        if detector is None:
+            if backend not in BACKENDS:
+                raise ValueError(f"Unknown detector backend: {backend}")
+            detector = _detectors[backend] = BACKENDS[backend]()
+    return detector
+
+
+def preload(backend=None):
+    """Load the backend model in the calling thread so startup fails early if it is missing"""
+    get_detector(backend)._model()
+
+
+def detect_faces(image, backend=None, working_size=DETECT_WORKING_SIZE, scale=1.0):
+    """Detect faces in a BGR image, returning boxes as dicts in original coordinates.
+
+    Large images are downscaled to working_size first and the boxes are
+    mapped back, which cuts detection time roughly with the pixel count.
+    scale is how much image was already reduced from the original (see
+    preprocess.py), so boxes and the minimum face size stay in original
+    pixels either way.
+    """
+    detector = get_detector(backend)
+    height, width = image.shape[:2]
+    if working_size and max(height, width) > working_size:
+        reduce = working_size / max(height, width)
+        scale *= reduce
+        image = cv2.resize(image, (max(1, round(width * reduce)), max(1, round(height * reduce))),
+                           interpolation=cv2.INTER_AREA)
+
+    # Keep the minimum face size in original pixels, but never below the
+    # cascade's 24px window
+    min_size = max(24, round(30 * scale))
+    with stage("detect"):
+        faces = detector.detect(image, min_size=min_size)
+    return [
+        {
+            "x": int(round(x / scale)),
+            "y": int(round(y / scale)),
+            "width": int(round(w / scale)),
+            "height": int(round(h / scale)),
+        }
+        for (x, y, w, h) in faces
+    ]
@@ -0,0 +1,158 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import registry
+
+# Memory budget for cached face locations and encodings; 0 disables the cache
+ENCODING_CACHE_BYTES = int(os.getenv('ENCODING_CACHE_BYTES', str(64 * 1024 * 1024)))
+# Seconds an entry stays valid after it was computed
+ENCODING_CACHE_TTL = float(os.getenv('ENCODING_CACHE_TTL', '300'))
+
+# Rough per-entry bookkeeping cost on top of the arrays themselves
+ENTRY_OVERHEAD = 256
+
+
+def content_key(image_bytes):
+    """Fast 128-bit digest of the image bytes"""
+    return hashlib.blake2b(image_bytes, digest_size=16).digest()
+
+
+def _entry_size(value):
+    locations, encodings = value
+    return ENTRY_OVERHEAD + sum(e.nbytes for e in encodings) + 32 * len(locations)
+
+
+def _cancelling():
+    """Whether the running task itself has been asked to cancel"""
+    task = asyncio.current_task()
+    return bool(task is not None and getattr(task, "cancelling", lambda: 0)())
+
+
+class EncodingCache:
+    """LRU cache of (locations, encodings) keyed by image content.
+
+    Bounded by an approximate byte budget rather than an entry count, so a
+    burst of many-face images cannot grow it unchecked, and entries expire
+    after a TTL. Concurrent requests for the same image share one
+    computation instead of each running dlib.
+    """
+
+    def __init__(self, max_bytes=ENCODING_CACHE_BYTES, ttl=ENCODING_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, size, expires = entry
+            if expires <= time.monotonic():
+                self._drop(key)
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        size = _entry_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (value, size, time.monotonic() + self.ttl)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    async def get_or_compute(self, image_bytes, compute):
+        """Cached (locations, encodings) for image_bytes, awaiting compute(image_bytes) on a miss"""
+        if self.max_bytes <= 0:
+            return await compute(image_bytes)
+        key = content_key(image_bytes)
+        while True:
+            value = self.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            pending = self._pending.get(key)
+            if pending is None:
+                break
+            # The same image is already being encoded for another request
+            try:
+                value = await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if pending.cancelled() and not _cancelling():
+                    # That request was cancelled, not this one: take over the work
+                    continue
+                raise
+            self.hits += 1
+            return value
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            value = await compute(image_bytes)
+        except asyncio.CancelledError:
+            # Waiters see a cancelled future and retry rather than fail
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Nobody else may be waiting; keep the loop from warning about it
+            future.exception()
+            raise
+        finally:
+            del self._pending[key]
+        future.set_result(value)
+        self.put(key, value)
+        return value
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+# Process-wide cache used by compute.locate_and_encode_faces
+encoding_cache = EncodingCache()
+
+registry.gauge(
+    "face_encoding_cache_lookups_total", "Encoding cache lookups by result",
+    lambda: {"hit": encoding_cache.hits, "miss": encoding_cache.misses}, ["result"], kind="counter")
+registry.gauge("face_encoding_cache_bytes", "Approximate memory held by the encoding cache",
+               lambda: encoding_cache.bytes)
@@ -0,0 +1,291 @@
+"""Bulk enrollment of face photos from a directory or zip archive.
+
+    python enroll.py PHOTOS [--state FILE] [--workers N] [--batch-size N]
+
+PHOTOS is a directory or a .zip archive. The directory a photo is in names
+its person (people/alice/1.jpg is enrolled as "alice"); photos directly
+inside PHOTOS are named after their file (people/bob.jpg is "bob"). Each
+photo must show exactly one face, as for /api/v1/register; the others are
+reported and left out.
+
+Photos are encoded in a pool of worker processes and written a batch at a
+time: users with one INSERT, faces with one COPY, one transaction per
+batch. With --state, every handled photo is appended to the state file
+once its batch is committed, and a later run with the same file skips
+them, so an interrupted import resumes where it stopped. Registration ids
+are derived from a photo's person and content, so the same photo of the
+same person is never stored twice, even if a batch was committed but not
+yet recorded in the state file.
+
+Running servers pick up the new faces through gallery sync.
+"""
+import argparse
+import csv
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import time
+import uuid
+import zipfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import compute
+from preprocess import IMAGE_EXTENSIONS
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Photos handled per batch; each batch of faces is one COPY and one transaction
+ENROLL_BATCH_SIZE = int(os.getenv('ENROLL_BATCH_SIZE', '1000'))
+# Encoding processes; 0 encodes in the calling process
+ENROLL_WORKERS = int(os.getenv('ENROLL_WORKERS', str(compute.ENCODE_WORKERS)))
+
+# Namespace of the registration ids derived from a photo's person and content
+REGISTRATION_NAMESPACE = uuid.UUID("359262d8-a044-42a6-bce7-88c61c849647")
+
+# Source opened by _init_worker in each encoding process
+_source = None
+_archive = None
+
+
+def list_photos(source):
+    """Paths of the images in a directory (relative to it) or zip archive, in a stable order"""
+    if os.path.isdir(source):
+        photos = []
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for filename in sorted(files):
+                if filename.lower().endswith(IMAGE_EXTENSIONS):
+                    photos.append(os.path.relpath(os.path.join(root, filename), source).replace(os.sep, "/"))
+        return photos
+    with zipfile.ZipFile(source) as archive:
+        return sorted(
+            entry.filename for entry in archive.infolist()
+            if not entry.is_dir() and entry.filename.lower().endswith(IMAGE_EXTENSIONS)
+        )
+
+
+def person_name(path):
+    """Name a photo is enrolled under: its directory, or its file name at the top level"""
+    parts = path.split("/")
+    if len(parts) > 1:
+        return parts[-2]
+    return os.path.splitext(parts[0])[0]
+
+
+def _init_worker(source):
+    """Open the source and load the models once per encoding process"""
+    global _source, _archive
+    _source = source
+    _archive = None if os.path.isdir(source) else zipfile.ZipFile(source)
+    compute.load_models()
+
+
+def _close_source():
+    global _source, _archive
+    if _archive is not None:
+        _archive.close()
+    _source = _archive = None
+
+
+def _read(path):
+    if _archive is not None:
+        return _archive.read(path)
+    with open(os.path.join(_source, path), "rb") as f:
+        return f.read()
+
+
+def encode_photo(path):
+    """Encode one photo, applying register_face's single-face rule"""
+    result = {"path": path, "name": person_name(path), "error": None}
+    try:
+        image_bytes = _read(path)
+        _, encodings = compute.face_locations_and_encodings_from_bytes(image_bytes)
+    except Exception as e:
+        result["error"] = f"Face encoding failed: {e}"
+        return result
+    result["error"] = compute.single_face_error(encodings)
+    if result["error"] is None:
+        digest = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+        result["registration_id"] = str(uuid.uuid5(REGISTRATION_NAMESPACE, f"{result['name']}\0{digest}"))
+        result["encoding"] = encodings[0].tobytes()
+    return result
+
+
+def write_batch(conn, photos):
+    """Store a batch of encoded photos in one transaction; returns how many faces were new"""
+    # Two copies of one photo under one person share a registration id
+    photos = list({photo["registration_id"]: photo for photo in photos}.values())
+    names = sorted({photo["name"] for photo in photos})
+    with conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO users (name) SELECT unnest(%s::text[]) ON CONFLICT (name) DO NOTHING",
+            (names,)
+        )
+        cur.execute("SELECT name, id FROM users WHERE name = ANY(%s)", (names,))
+        user_ids = dict(cur.fetchall())
+        # Photos stored by an earlier run whose state file missed them
+        cur.execute(
+            "SELECT registration_id FROM user_faces WHERE registration_id = ANY(%s::uuid[])",
+            ([photo["registration_id"] for photo in photos],)
+        )
+        stored = {str(registration_id) for registration_id, in cur.fetchall()}
+        new = [photo for photo in photos if photo["registration_id"] not in stored]
+        if new:
+            rows = io.StringIO()
+            writer = csv.writer(rows)
+            for photo in new:
+                writer.writerow((user_ids[photo["name"]], "\\x" + photo["encoding"].hex(), photo["registration_id"]))
+            rows.seek(0)
+            cur.copy_expert(
+                "COPY user_faces (user_id, face_encoding, registration_id) FROM STDIN WITH (FORMAT csv)", rows
+            )
+    conn.commit()
+    return len(new)
+
+
+def load_state(path):
+    """Paths of the photos earlier runs recorded in the state file"""
+    done = set()
+    if path and os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)["path"])
+                except (ValueError, KeyError):
+                    # A line cut short when a run was killed
+                    continue
+    return done
+
+
+def enroll(source, state_path=None, batch_size=ENROLL_BATCH_SIZE, workers=ENROLL_WORKERS):
+    """Enroll every photo under source that the state file has not recorded; returns a report"""
+    # Imported here so the encoding processes, which import this module, open no connections
+    from db import get_db_connection
+
+    started = time.perf_counter()
+    photos = list_photos(source)
+    done = load_state(state_path)
+    pending = [path for path in photos if path not in done]
+    report = {
+        "source": source,
+        "photos": len(photos),
+        "skipped": len(photos) - len(pending),
+        "encoded": 0,
+        "enrolled": 0,
+        "already_stored": 0,
+        "people": 0,
+        "rejected": Counter(),
+        "batches": 0,
+        "workers": workers,
+        "write_seconds": 0.0,
+    }
+    logger.info(f"Enrolling {len(pending)} of {len(photos)} photos from {source} with {workers} workers")
+
+    people = set()
+    handled = []
+    state = open(state_path, "a") if state_path else None
+
+    def flush():
+        encoded = [photo for photo in handled if photo["error"] is None]
+        if encoded:
+            write_started = time.perf_counter()
+            with get_db_connection() as conn:
+                new = write_batch(conn, encoded)
+            report["write_seconds"] += time.perf_counter() - write_started
+            report["enrolled"] += new
+            report["already_stored"] += len(encoded) - new
+            report["batches"] += 1
+            people.update(photo["name"] for photo in encoded)
+        if state:
+            for photo in handled:
+                state.write(json.dumps({"path": photo["path"], "error": photo["error"]}) + "\n")
+            state.flush()
+        report["encoded"] += len(handled)
+        handled.clear()
+        elapsed = time.perf_counter() - started
+        logger.info(f"{report['encoded']}/{len(pending)} photos, {report['enrolled']} faces enrolled, "
+                    f"{report['encoded'] / elapsed:.1f} photos/s")
+
+    pool = None
+    try:
+        if workers > 0:
+            # spawn, as for the server's compute pools; a worker that cannot
+            # load the models breaks the pool instead of being restarted forever
+            pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(source,)
+            )
+            # Small chunks keep every worker busy until the end; encoding dwarfs the IPC
+            results = pool.map(encode_photo, pending, chunksize=4)
+        else:
+            _init_worker(source)
+            results = map(encode_photo, pending)
+        for photo in results:
+            if photo["error"] is not None:
+                report["rejected"][photo["error"]] += 1
+            handled.append(photo)
+            if len(handled) >= batch_size:
+                flush()
+        if handled:
+            flush()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        else:
+            _close_source()
+        if state:
+            state.close()
+
+    report["people"] = len(people)
+    report["rejected"] = dict(report["rejected"])
+    report["seconds"] = round(time.perf_counter() - started, 2)
+    report["write_seconds"] = round(report["write_seconds"], 2)
+    report["photos_per_second"] = round(report["encoded"] / report["seconds"], 2) if report["seconds"] else 0.0
+    return report
+
+
+def format_report(report):
+    lines = [
+        f"Enrolled {report['enrolled']} faces of {report['people']} people from {report['source']}",
+        f"  photos:      {report['photos']} found, {report['skipped']} skipped (earlier runs), "
+        f"{report['encoded']} encoded",
+        f"  throughput:  {report['photos_per_second']} photos/s over {report['seconds']} s "
+        f"with {report['workers']} workers",
+        f"  database:    {report['batches']} batches in {report['write_seconds']} s, "
+        f"{report['already_stored']} faces already stored",
+    ]
+    rejected = sum(report["rejected"].values())
+    lines.append(f"  rejected:    {rejected}")
+    for error, count in sorted(report["rejected"].items(), key=lambda item: -item[1]):
+        lines.append(f"    {count:>8}  {error}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Enroll a directory or zip archive of face photos")
+    parser.add_argument("source", help="directory or .zip archive of photos")
+    parser.add_argument("--state", help="state file recording handled photos, for resuming")
+    parser.add_argument("--workers", type=int, default=ENROLL_WORKERS, help="encoding processes (0: none)")
+    parser.add_argument("--batch-size", type=int, default=ENROLL_BATCH_SIZE, help="photos per transaction")
+    parser.add_argument("--report", help="also write the report as JSON to this file")
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.source) and not zipfile.is_zipfile(args.source):
+        parser.error(f"{args.source} is neither a directory nor a zip archive")
+
+    report = enroll(args.source, args.state, args.batch_size, args.workers)
+    print(format_report(report))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import base64
+import json
+import struct
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+# Clients that offer this subprotocol send image frames as binary messages:
+# a 6-byte header (version, frame type, sequence number) followed by the raw
+# JPEG/PNG bytes. Control messages stay JSON text in both modes.
+BINARY_SUBPROTOCOL = "face-frames.v1"
+
+FRAME_HEADER = struct.Struct(">BBI")
+FRAME_VERSION = 1
+FRAME_IMAGE = 1
+
+
+class FrameError(ValueError):
+    """A binary message that does not follow the frame protocol"""
+
+
+def negotiate_subprotocol(websocket: WebSocket):
+    """The binary subprotocol if the client offered it, else None (JSON mode)"""
+    offered = websocket.scope.get("subprotocols") or []
+    return BINARY_SUBPROTOCOL if BINARY_SUBPROTOCOL in offered else None
+
+
+def pack_frame(image_bytes, seq=0, frame_type=FRAME_IMAGE):
+    return FRAME_HEADER.pack(FRAME_VERSION, frame_type, seq) + image_bytes
+
+
+def parse_frame(data):
+    """Split a binary message into a message dict without copying the image bytes"""
+    if len(data) <= FRAME_HEADER.size:
+        raise FrameError("Binary frame too short.")
+    version, frame_type, seq = FRAME_HEADER.unpack_from(data)
+    if version != FRAME_VERSION:
+        raise FrameError(f"Unsupported frame version {version}.")
+    if frame_type != FRAME_IMAGE:
+        raise FrameError(f"Unsupported frame type {frame_type}.")
+    return {"type": "image", "seq": seq, "image_bytes": memoryview(data)[FRAME_HEADER.size:]}
+
+
+async def receive_message(websocket: WebSocket):
+    """Next client message as a dict, from either a JSON text or a binary frame"""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    if message.get("bytes") is not None:
+        return parse_frame(message["bytes"])
+    return json.loads(message["text"])
+
+
+def image_bytes_of(data):
+    """Image payload of a message: raw frame bytes, or the base64 "image" field of JSON mode"""
+    if data.get("image_bytes") is not None:
+        return data["image_bytes"]
+    img_b64 = data.get("image")
+    if not img_b64:
+        return None
+    return base64.b64decode(img_b64)
@@ -0,0 +1,534 @@
+import logging
+import os
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+import numpy as np
+
+from db import get_db_cursor
+from metrics import registry, stage
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+ENCODING_SIZE = 128
+# Upper bound on (queries x gallery rows) distances held in memory at once
+MATCH_BLOCK_ELEMENTS = 1 << 22
+
+# Threshold for a match (same as compare_faces default tolerance=0.6)
+MATCH_TOLERANCE = float(os.getenv('MATCH_TOLERANCE', '0.6'))
+
+# How a user's shots are combined into one distance:
+#   min      - distance of the user's closest shot
+#   mean_knn - mean distance of the user's MATCH_STRATEGY_K closest shots
+#   centroid - distance to the mean of all the user's shots
+#   vote     - users ranked by how many of the MATCH_STRATEGY_K nearest rows are theirs
+MATCH_STRATEGIES = ("min", "mean_knn", "centroid", "vote")
+MATCH_STRATEGY = os.getenv('MATCH_STRATEGY', 'min').lower()
+MATCH_STRATEGY_K = int(os.getenv('MATCH_STRATEGY_K', '3'))
+
+if MATCH_STRATEGY not in MATCH_STRATEGIES:
+    raise ValueError(f"MATCH_STRATEGY must be one of {', '.join(MATCH_STRATEGIES)}")
+
+Match = namedtuple("Match", ["user_id", "name", "distance", "votes"], defaults=[None])
+
+
+def exact_distances(encodings, face_encoding):
+    """Euclidean distances, computed exactly like face_recognition.face_distance"""
+    if len(encodings) == 0:
+        return np.empty(0)
+    return np.linalg.norm(encodings - face_encoding, axis=1)
+
+
+def _resized(array, capacity, used):
+    grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+    grown[:used] = array[:used]
+    return grown
+
+
+class FacePositions:
+    """Gallery row of each face id.
+
+    Rows mapped from a snapshot are found by binary search in its sorted
+    face id column, which is memory-mapped and shared between processes;
+    only ids added, moved or removed since then are kept in a dict.
+    Galleries built in memory keep every id in the dict.
+    """
+
+    def __init__(self, rows=None, sorted_ids=None, sorted_rows=None):
+        # face id -> row, or None for a mapped row removed since
+        self._rows = rows if rows is not None else {}
+        self._sorted_ids = sorted_ids
+        self._sorted_rows = sorted_rows
+
+    def get(self, face_id):
+        if face_id in self._rows:
+            return self._rows[face_id]
+        if self._sorted_ids is None or len(self._sorted_ids) == 0:
+            return None
+        k = int(np.searchsorted(self._sorted_ids, face_id))
+        if k < len(self._sorted_ids) and self._sorted_ids[k] == face_id:
+            return int(self._sorted_rows[k])
+        return None
+
+    def __contains__(self, face_id):
+        return self.get(face_id) is not None
+
+    def __setitem__(self, face_id, row):
+        self._rows[face_id] = row
+
+    def pop(self, face_id):
+        row = self.get(face_id)
+        if row is not None:
+            if self._sorted_ids is None:
+                del self._rows[face_id]
+            else:
+                self._rows[face_id] = None
+        return row
+
+
+class FaceGallery:
+    """In-memory index of every enrolled face encoding.
+
+    All encodings live in one contiguous (N, 128) float64 matrix with parallel
+    face id and user code arrays, so a query is answered with a single
+    vectorized distance computation instead of a table scan per request.
+    Rows are grouped per user with segment reductions over the user codes
+    (see MATCH_STRATEGY). An optional ANN index (see ann.py) can be attached
+    to shortlist rows for very large galleries.
+    """
+
+    def __init__(self, initial_capacity=1024):
+        self._lock = threading.RLock()
+        self._size = 0
+        self._encodings = np.empty((initial_capacity, ENCODING_SIZE), dtype=np.float64)
+        self._sq_norms = np.empty(initial_capacity, dtype=np.float64)
+        self._face_ids = np.empty(initial_capacity, dtype=object)
+        self._user_codes = np.empty(initial_capacity, dtype=np.int64)
+        self._positions = FacePositions()
+        self._reset_users()
+        self.loaded = False
+        self.loaded_at = None
+        self.index = None
+        # Bumped on every change, so a publisher can tell when to republish
+        self.version = 0
+        # Set in workers that map a gallery published by another process
+        # (see shared_gallery.py); changes then arrive only from the writer
+        self.read_only = False
+        # Journal of add/remove calls for drain_changes(), once record_changes()
+        # has been called; True in _changes_reset when the rows were replaced
+        self._changes = None
+        self._changes_reset = False
+
+    def _reset_users(self, capacity=1024):
+        # Per-user tables indexed by user code; codes are never reused
+        self._codes = {}
+        self._user_ids = []
+        self._names = []
+        self._shot_counts = np.zeros(capacity, dtype=np.int64)
+        self._shot_sums = np.zeros((capacity, ENCODING_SIZE), dtype=np.float64)
+        self._centroids = None
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, face_id):
+        return str(face_id) in self._positions
+
+    @property
+    def user_count(self):
+        return int(np.count_nonzero(self._shot_counts[:len(self._user_ids)]))
+
+    def load(self, conn=None):
+        """Replace the gallery contents with every row of user_faces.
+
+        Uses a pooled connection unless a dedicated one is passed in, e.g.
+        from a background thread that must not touch the shared pool.
+        """
+        if conn is None:
+            with get_db_cursor() as cur:
+                self._load(cur)
+        else:
+            with conn.cursor() as cur:
+                self._load(cur)
+
+    def _load(self, cur):
+        # High-water mark for incremental sync, taken before the snapshot
+        cur.execute("SELECT LOCALTIMESTAMP")
+        loaded_at = cur.fetchone()[0]
+        cur.execute("""
+            SELECT uf.id, u.id, u.name, uf.face_encoding
+            FROM users u JOIN user_faces uf ON u.id = uf.user_id
+        """)
+        self.replace(cur.fetchall())
+        self.loaded_at = loaded_at
+
+    def replace(self, rows):
+        """Rebuild the gallery from (face_id, user_id, name, encoding_bytes) rows"""
+        count = len(rows)
+        capacity = max(count, 1024)
+        encodings = np.empty((capacity, ENCODING_SIZE), dtype=np.float64)
+        face_ids = np.empty(capacity, dtype=object)
+        user_codes = np.empty(capacity, dtype=np.int64)
+        codes, user_ids, names = {}, [], []
+        if count:
+            # One copy of all encodings instead of one np.frombuffer per row
+            encodings[:count] = np.frombuffer(
+                b"".join(bytes(row[3]) for row in rows), dtype=np.float64
+            ).reshape(count, ENCODING_SIZE)
+            face_ids[:count] = [str(row[0]) for row in rows]
+            for i, row in enumerate(rows):
+                user_id = str(row[1])
+                code = codes.get(user_id)
+                if code is None:
+                    code = codes[user_id] = len(user_ids)
+                    user_ids.append(user_id)
+                    names.append(row[2])
+                user_codes[i] = code
+        self.replace_arrays(encodings, face_ids, user_codes, user_ids, names, count=count)
+
+    def replace_arrays(self, encodings, face_ids, user_codes, user_ids, names,
+                       count=None, sq_norms=None, shot_sums=None, face_index=None):
+        """Rebuild the gallery from column arrays without copying the encodings.
+
+        encodings and face_ids may be copy-on-write memory maps (see
+        snapshot.py): they are only copied into RAM once an add() outgrows
+        them. Precomputed squared norms and per-user shot sums skip a pass
+        over every encoding, and face_index, the face ids in sorted order
+        with their rows, replaces a per-row dict of positions.
+        """
+        count = len(face_ids) if count is None else count
+        user_ids, names = list(user_ids), list(names)
+        if sq_norms is None:
+            sq_norms = np.empty(len(encodings), dtype=np.float64)
+            sq_norms[:count] = np.einsum("ij,ij->i", encodings[:count], encodings[:count])
+
+        if shot_sums is not None and len(shot_sums) >= max(len(user_ids), 1):
+            user_capacity = len(shot_sums)
+        else:
+            user_capacity = max(len(user_ids), 1024)
+            shot_sums = np.zeros((user_capacity, ENCODING_SIZE), dtype=np.float64)
+            np.add.at(shot_sums, user_codes[:count], encodings[:count])
+        shot_counts = np.zeros(user_capacity, dtype=np.int64)
+        shot_counts[:len(user_ids)] = np.bincount(user_codes[:count], minlength=len(user_ids))
+
+        with self._lock:
+            self._encodings = encodings
+            self._sq_norms = sq_norms
+            self._face_ids = face_ids
+            self._user_codes = user_codes
+            self._codes = {user_id: code for code, user_id in enumerate(user_ids)}
+            self._user_ids = user_ids
+            self._names = names
+            self._shot_counts = shot_counts
+            self._shot_sums = shot_sums
+            self._centroids = None
+            if face_index is not None:
+                self._positions = FacePositions(sorted_ids=face_index[0], sorted_rows=face_index[1])
+            else:
+                self._positions = FacePositions({face_id: i for i, face_id in enumerate(face_ids[:count])})
+            self._size = count
+            self.loaded = True
+            self.version += 1
+            if self._changes is not None:
+                self._changes = []
+                self._changes_reset = True
+            if self.index is not None:
+                self.index.rebuild(encodings[:count], face_ids[:count])
+
+    def _user_code(self, user_id, name):
+        code = self._codes.get(user_id)
+        if code is None:
+            code = self._codes[user_id] = len(self._user_ids)
+            self._user_ids.append(user_id)
+            self._names.append(name)
+            if code == len(self._shot_counts):
+                capacity = 2 * len(self._shot_counts)
+                self._shot_counts = _resized(self._shot_counts, capacity, code)
+                self._shot_sums = _resized(self._shot_sums, capacity, code)
+        return code
+
+    def add(self, face_id, user_id, name, encoding):
+        """Append one encoding; returns False if the face is already present"""
+        face_id = str(face_id)
+        encoding = np.asarray(encoding, dtype=np.float64).reshape(ENCODING_SIZE)
+        with self._lock:
+            if self.read_only or face_id in self._positions:
+                return False
+            if self._size == len(self._encodings):
+                self._grow()
+            i = self._size
+            code = self._user_code(str(user_id), name)
+            self._encodings[i] = encoding
+            self._sq_norms[i] = encoding @ encoding
+            self._face_ids[i] = face_id
+            self._user_codes[i] = code
+            self._shot_counts[code] += 1
+            self._shot_sums[code] += encoding
+            self._centroids = None
+            self._positions[face_id] = i
+            self._size = i + 1
+            self.version += 1
+            if self._changes is not None:
+                self._changes.append(("add", face_id, str(user_id), name, encoding.tobytes()))
+            if self.index is not None:
+                self.index.add(i, encoding)
+            return True
+
+    def remove(self, face_ids):
+        """Drop encodings by face id in O(len(face_ids)); returns how many were removed.
+
+        The last row is swapped into each vacated slot so the matrix stays
+        contiguous without shifting the rest of the gallery.
+        """
+        removed = 0
+        with self._lock:
+            if self.read_only:
+                return 0
+            for face_id in face_ids:
+                i = self._positions.pop(str(face_id))
+                if i is None:
+                    continue
+                code = self._user_codes[i]
+                self._shot_counts[code] -= 1
+                if self._shot_counts[code]:
+                    self._shot_sums[code] -= self._encodings[i]
+                else:
+                    # Avoid accumulating rounding error in an empty sum
+                    self._shot_sums[code] = 0.0
+                self._centroids = None
+                last = self._size - 1
+                if self.index is not None:
+                    self.index.remove(i, last)
+                if i != last:
+                    self._encodings[i] = self._encodings[last]
+                    self._sq_norms[i] = self._sq_norms[last]
+                    self._face_ids[i] = self._face_ids[last]
+                    self._user_codes[i] = self._user_codes[last]
+                    self._positions[str(self._face_ids[i])] = i
+                # None in object arrays, "" in fixed-width mapped ones
+                self._face_ids[last] = self._face_ids.dtype.type()
+                self._size = last
+                removed += 1
+                if self._changes is not None:
+                    self._changes.append(("remove", str(face_id)))
+            if removed:
+                self.version += 1
+        return removed
+
+    def record_changes(self):
+        """Start journaling add() and remove() calls for drain_changes()"""
+        with self._lock:
+            self._changes = []
+            self._changes_reset = False
+
+    def drain_changes(self):
+        """(reset, changes) since the last call.
+
+        changes are ("add", face_id, user_id, name, encoding bytes) and
+        ("remove", face_id) tuples in the order they happened; reset means
+        the rows were replaced wholesale and the changes alone do not say
+        what the gallery holds.
+        """
+        with self._lock:
+            changes, reset = self._changes or [], self._changes_reset
+            if self._changes is not None:
+                self._changes = []
+            self._changes_reset = False
+            return reset, changes
+
+    def apply_changes(self, changes):
+        """Replay changes from another gallery's drain_changes(), even on a read-only gallery"""
+        with self._lock:
+            read_only, self.read_only = self.read_only, False
+            try:
+                for change in changes:
+                    if change[0] == "add":
+                        _, face_id, user_id, name, encoding = change
+                        self.add(face_id, user_id, name, np.frombuffer(encoding, dtype=np.float64))
+                    else:
+                        self.remove([change[1]])
+            finally:
+                self.read_only = read_only
+
+    def attach_index(self, index):
+        """Route matching through an ANN index; None restores flat search"""
+        with self._lock:
+            if index is not None:
+                index.rebuild(self._encodings[:self._size], self._face_ids[:self._size])
+            self.index = index
+
+    @contextmanager
+    def view(self):
+        """Hold the gallery lock and yield (encodings, face_ids) views of the current rows"""
+        with self._lock:
+            n = self._size
+            yield self._encodings[:n], self._face_ids[:n]
+
+    def columns(self):
+        """Copies of the current rows and user table, e.g. for writing a snapshot"""
+        with self._lock:
+            n, users = self._size, len(self._user_ids)
+            return {
+                "encodings": self._encodings[:n].copy(),
+                "sq_norms": self._sq_norms[:n].copy(),
+                "face_ids": self._face_ids[:n].copy(),
+                "user_codes": self._user_codes[:n].copy(),
+                "shot_sums": self._shot_sums[:users].copy(),
+                "users": [[user_id, name] for user_id, name in zip(self._user_ids, self._names)],
+                "version": self.version,
+            }
+
+    def _grow(self):
+        capacity = max(2 * len(self._encodings), 1024)
+        self._encodings = _resized(self._encodings, capacity, self._size)
+        self._sq_norms = _resized(self._sq_norms, capacity, self._size)
+        self._face_ids = _resized(self._face_ids, capacity, self._size)
+        self._user_codes = _resized(self._user_codes, capacity, self._size)
+
+    def distances(self, face_encoding):
+        """Distances from one encoding to every gallery row.
+
+        Uses |a-b|^2 = |a|^2 - 2ab + |b|^2 with cached row norms, so the
+        whole gallery costs one matrix-vector product and no (N, 128) temporary.
+        """
+        return self._distance_block(np.asarray(face_encoding, dtype=np.float64)[None, :])[0]
+
+    def _distance_block(self, queries):
+        """(Q, N) distances from a block of queries to every gallery row"""
+        with self._lock:
+            n = self._size
+            sq = self._sq_norms[:n] - 2.0 * (queries @ self._encodings[:n].T)
+        sq += np.einsum("ij,ij->i", queries, queries)[:, None]
+        np.maximum(sq, 0.0, out=sq)
+        return np.sqrt(sq, out=sq)
+
+    def best_match(self, face_encoding, strategy=None):
+        """Return the closest user's Match, or None if the gallery is empty"""
+        return self.best_matches([face_encoding], strategy)[0]
+
+    def best_matches(self, face_encodings, strategy=None):
+        """Closest user's Match for each of Q encodings (None entries if the gallery is empty)"""
+        return [matches[0] if matches else None for matches in self.top_k(face_encodings, 1, strategy)]
+
+    def top_k(self, face_encodings, k, strategy=None):
+        """The k closest users for each of Q encodings, nearest first.
+
+        Each user's shots are combined with the given MATCH_STRATEGY, so a
+        user enrolled with many shots still appears once. Flat search works
+        on blocks of queries sized so the (Q, N) distance matrix stays under
+        MATCH_BLOCK_ELEMENTS.
+        """
+        strategy = strategy or MATCH_STRATEGY
+        if strategy not in MATCH_STRATEGIES:
+            raise ValueError(f"Unknown match strategy: {strategy}")
+        queries = np.asarray(face_encodings, dtype=np.float64).reshape(-1, ENCODING_SIZE)
+        with stage("match"), self._lock:
+            n = self._size
+            if k <= 0 or n == 0:
+                return [[] for _ in queries]
+            if strategy == "centroid":
+                return self._top_k_centroids(queries, k)
+            if self.index is not None:
+                results = []
+                for query in queries:
+                    rows = self.index.candidates(query)
+                    if len(rows) == 0:
+                        rows = np.arange(n)
+                    # Exact re-ranking of the ANN shortlist
+                    distances = exact_distances(self._encodings[rows], query)
+                    results.append(self._aggregate(self._user_codes[rows], distances, k, strategy))
+                return results
+
+            results = []
+            block = max(1, MATCH_BLOCK_ELEMENTS // n)
+            codes = self._user_codes[:n]
+            for start in range(0, len(queries), block):
+                for distances in self._distance_block(queries[start:start + block]):
+                    results.append(self._aggregate(codes, distances, k, strategy))
+            return results
+
+    def _aggregate(self, codes, distances, k, strategy):
+        """Per-user scores from per-row distances via segment reductions over user codes"""
+        users = len(self._user_ids)
+        votes = None
+        if strategy == "min":
+            scores = np.full(users, np.inf)
+            np.minimum.at(scores, codes, distances)
+        elif strategy == "mean_knn":
+            # A user's mean is never below its closest shot, so only users whose
+            # closest shot beats the k-th best mean among the k closest users
+            # can make the top k; the per-user sort only runs on their rows
+            mins = np.full(users, np.inf)
+            np.minimum.at(mins, codes, distances)
+            finite = np.flatnonzero(np.isfinite(mins))
+            seeds = finite[np.argpartition(mins[finite], min(k, len(finite)) - 1)[:k]]
+            seed_scores = self._mean_of_nearest(codes, distances, seeds, users)
+            bound = np.max(seed_scores[seeds])
+            scores = self._mean_of_nearest(codes, distances, np.flatnonzero(mins <= bound), users)
+        else:  # vote
+            voters = min(MATCH_STRATEGY_K, len(distances))
+            nearest = np.argpartition(distances, voters - 1)[:voters]
+            votes = np.bincount(codes[nearest], minlength=users)
+            scores = np.full(users, np.inf)
+            np.minimum.at(scores, codes[nearest], distances[nearest])
+
+        candidates = np.flatnonzero(np.isfinite(scores))
+        if votes is not None:
+            # Most votes first, closest shot breaks ties
+            ranked = candidates[np.lexsort((scores[candidates], -votes[candidates]))][:k]
+        else:
+            if len(candidates) > k:
+                candidates = candidates[np.argpartition(scores[candidates], k - 1)[:k]]
+            ranked = candidates[np.argsort(scores[candidates])]
+        return [
+            Match(self._user_ids[code], self._names[code], float(scores[code]),
+                  None if votes is None else int(votes[code]))
+            for code in ranked
+        ]
+
+    @staticmethod
+    def _mean_of_nearest(codes, distances, users_subset, users):
+        """Mean distance of the MATCH_STRATEGY_K closest shots of each user in users_subset"""
+        selected = np.zeros(users, dtype=bool)
+        selected[users_subset] = True
+        rows = np.flatnonzero(selected[codes])
+        codes, distances = codes[rows], distances[rows]
+        # Rank every row within its user, then average ranks < K
+        order = np.lexsort((distances, codes))
+        sorted_codes = codes[order]
+        group_start = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        rank = np.arange(len(order)) - np.repeat(group_start, np.diff(np.r_[group_start, len(order)]))
+        keep = order[rank < MATCH_STRATEGY_K]
+        sums = np.bincount(codes[keep], weights=distances[keep], minlength=users)
+        counts = np.bincount(codes[keep], minlength=users)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(counts > 0, sums / counts, np.inf)
+
+    def _top_k_centroids(self, queries, k):
+        if self._centroids is None:
+            # Rebuilt lazily after the gallery changes
+            counts = self._shot_counts[:len(self._user_ids)]
+            active = np.flatnonzero(counts)
+            self._centroids = (active, self._shot_sums[active] / counts[active, None])
+        active, centroids = self._centroids
+        results = []
+        for query in queries:
+            distances = exact_distances(centroids, query)
+            kk = min(k, len(active))
+            keep = np.argpartition(distances, kk - 1)[:kk]
+            keep = keep[np.argsort(distances[keep])]
+            results.append([
+                Match(self._user_ids[active[j]], self._names[active[j]], float(distances[j]))
+                for j in keep
+            ])
+        return results
+
+
+# Process-wide gallery, loaded in the application lifespan
+gallery = FaceGallery()
+
+registry.gauge("face_gallery_encodings", "Encodings in the in-memory gallery", lambda: len(gallery))
+registry.gauge("face_gallery_users", "Users with at least one encoding in the gallery",
+               lambda: gallery.user_count)
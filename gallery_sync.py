@@ -0,0 +1,182 @@
+import datetime
+import json
+import logging
+import os
+import select
+import threading
+
+import numpy as np
+import psycopg2.extensions
+
+from db import get_db_conn
+from gallery import gallery as default_gallery
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Channel used by the notify_user_faces_change trigger in db.init_tables
+CHANNEL = "user_faces_changed"
+
+GALLERY_SYNC_ENABLED = os.getenv('GALLERY_SYNC_ENABLED', 'true').lower() == 'true'
+# Seconds between catch-up queries when no notifications arrive
+GALLERY_SYNC_INTERVAL = float(os.getenv('GALLERY_SYNC_INTERVAL', '30'))
+# created_at is the inserting transaction's start time, so re-read a window
+# behind the high-water mark to pick up rows that committed late
+GALLERY_SYNC_OVERLAP = float(os.getenv('GALLERY_SYNC_OVERLAP', '60'))
+# How long cleanup keeps tombstones; a replica further behind than this reloads fully
+TOMBSTONE_RETENTION_HOURS = float(os.getenv('TOMBSTONE_RETENTION_HOURS', '24'))
+
+FACE_ROWS_QUERY = """
+    SELECT uf.id, u.id, u.name, uf.face_encoding
+    FROM user_faces uf JOIN users u ON u.id = uf.user_id
+"""
+
+
+class GallerySync:
+    """Keeps an in-memory FaceGallery in step with user_faces.
+
+    A background thread LISTENs for the insert/delete notifications published
+    by the user_faces trigger and applies each change to the gallery in
+    O(delta). Every GALLERY_SYNC_INTERVAL seconds, and after reconnecting, it
+    also runs a catch-up query on created_at and the tombstone table so
+    changes missed while disconnected are still applied.
+    """
+
+    def __init__(self, gallery, interval=GALLERY_SYNC_INTERVAL, overlap=GALLERY_SYNC_OVERLAP):
+        self.gallery = gallery
+        self.interval = interval
+        self.overlap = datetime.timedelta(seconds=overlap)
+        self.high_water_mark = None
+        self.inserts_applied = 0
+        self.deletes_applied = 0
+        self.last_sync = None
+        self._conn = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the listener thread (the gallery must already be loaded)"""
+        if self._thread is not None:
+            return
+        self.high_water_mark = self.gallery.loaded_at
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="gallery-sync", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _connect(self):
+        # LISTEN needs a dedicated connection that is never returned to the pool
+        conn = get_db_conn()
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cur:
+            cur.execute(f"LISTEN {CHANNEL}")
+        return conn
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    def _run(self):
+        backoff = 1
+        while not self._stop.is_set():
+            try:
+                if self._conn is None:
+                    self._conn = self._connect()
+                    # Anything committed while we were not listening
+                    self.catch_up()
+                    backoff = 1
+                    next_catch_up = self._now() + self.interval
+                if select.select([self._conn], [], [], 1.0) != ([], [], []):
+                    self._conn.poll()
+                    notifies = self._conn.notifies[:]
+                    del self._conn.notifies[:]
+                    self.apply_notifications(notifies)
+                if self._now() >= next_catch_up:
+                    self.catch_up()
+                    next_catch_up = self._now() + self.interval
+            except Exception as e:
+                logger.error(f"Gallery sync error, reconnecting in {backoff}s: {e}")
+                self._close()
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 60)
+        self._close()
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.now().timestamp()
+
+    def apply_notifications(self, notifies):
+        """Apply a batch of trigger notifications to the gallery"""
+        inserted, deleted = [], []
+        for notify in notifies:
+            try:
+                payload = json.loads(notify.payload)
+            except ValueError:
+                logger.warning(f"Ignoring malformed gallery notification: {notify.payload!r}")
+                continue
+            if payload.get("op") == "INSERT":
+                inserted.append(payload["id"])
+            elif payload.get("op") == "DELETE":
+                deleted.append(payload["id"])
+
+        # Skip faces this process already added itself (e.g. its own registrations)
+        inserted = [face_id for face_id in inserted if face_id not in self.gallery]
+        if inserted:
+            with self._conn.cursor() as cur:
+                cur.execute(FACE_ROWS_QUERY + " WHERE uf.id = ANY(%s::uuid[])", (inserted,))
+                self._add_rows(cur.fetchall())
+        if deleted:
+            self.deletes_applied += self.gallery.remove(deleted)
+        self.last_sync = datetime.datetime.now()
+
+    def catch_up(self, conn=None):
+        """Apply rows and tombstones newer than the high-water mark.
+
+        Runs on the listener connection unless one is passed in, e.g. to
+        bring a gallery loaded from a snapshot up to date at startup.
+        """
+        conn = conn or self._conn
+        with conn.cursor() as cur:
+            cur.execute("SELECT LOCALTIMESTAMP")
+            now = cur.fetchone()[0]
+            retention = datetime.timedelta(hours=TOMBSTONE_RETENTION_HOURS)
+            if self.high_water_mark is None or now - self.high_water_mark > retention:
+                # Tombstones we would need may already be pruned
+                logger.info("Gallery too far behind for incremental sync, reloading")
+                self.gallery.load(conn)
+                self.high_water_mark = self.gallery.loaded_at
+                self.last_sync = datetime.datetime.now()
+                return
+            since = self.high_water_mark - self.overlap
+            cur.execute(FACE_ROWS_QUERY + " WHERE uf.created_at > %s", (since,))
+            self._add_rows(cur.fetchall())
+            cur.execute("SELECT face_id FROM user_face_tombstones WHERE deleted_at > %s", (since,))
+            self.deletes_applied += self.gallery.remove(str(row[0]) for row in cur.fetchall())
+        self.high_water_mark = self.gallery.loaded_at = now
+        self.last_sync = datetime.datetime.now()
+
+    def _add_rows(self, rows):
+        for face_id, user_id, name, encoding_bytes in rows:
+            if self.gallery.add(face_id, user_id, name, np.frombuffer(encoding_bytes, dtype=np.float64)):
+                self.inserts_applied += 1
+
+    def stats(self):
+        return {
+            "high_water_mark": self.high_water_mark.isoformat() if self.high_water_mark else None,
+            "last_sync": self.last_sync.isoformat() if self.last_sync else None,
+            "inserts_applied": self.inserts_applied,
+            "deletes_applied": self.deletes_applied,
+        }
+
+
+# Process-wide sync for the shared gallery, started in the application lifespan
+gallery_sync = GallerySync(default_gallery)
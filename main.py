@@ -1,16 +1,26 @@
-from fastapi import FastAPI, Depends, Request, HTTPException, File, UploadFile
+from fastapi import FastAPI, Request, File, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from contextlib import asynccontextmanager
 import logging
 import time
-from db import init_tables, pool
+from db import pool
+from db_async import database, init_tables
+from gallery import gallery
+from gallery_sync import gallery_sync, GALLERY_SYNC_ENABLED
+import ann
+import snapshot
+from shared_gallery import shared_gallery, GALLERY_SHARED
+import compute
+import metrics
+import profiling
+from readiness import readiness
+from encoding_cache import encoding_cache
+from cleanup import cleanup_scheduler
+import detector
 from api import router as api_router
-from ws import websocket_register, websocket_detect
+from ws import websocket_register, websocket_detect, websocket_recognize
 import os
-import cv2
-import numpy as np
-import io
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -28,9 +38,34 @@ logger = logging.getLogger(__name__)
 async def lifespan(app: FastAPI):
     # Startup
     try:
-        logger.info("Initializing database tables")
-        init_tables()
+        with readiness.step("database"):
+            await database.start()
+            logger.info("Initializing database tables")
+            await init_tables(database)
         logger.info("Database initialized successfully")
+        logger.info("Loading face gallery")
+        with readiness.step("gallery"):
+            if GALLERY_SHARED:
+                # One worker loads and syncs the gallery, the others map its copy
+                shared_gallery.start(GALLERY_SYNC_ENABLED)
+                logger.info(f"Shared face gallery {shared_gallery.role} with {len(gallery)} encodings")
+            else:
+                source = snapshot.load_gallery(gallery, gallery_sync)
+                logger.info(f"Face gallery loaded from {source} with {len(gallery)} encodings")
+        if ann.GALLERY_INDEX == "ivf":
+            with readiness.step("ann_index"):
+                ann.load_or_build(gallery)
+        compute.start_executors()
+        with readiness.step("detector"):
+            detector.preload()
+        logger.info(f"Face detector '{detector.DETECTOR_BACKEND}' loaded")
+        # Workers load and warm up the dlib models while the server starts
+        # answering; /ready reports ready once they are done
+        readiness.start_warm_up()
+        if GALLERY_SYNC_ENABLED and not GALLERY_SHARED:
+            gallery_sync.start()
+            logger.info("Gallery sync started")
+        cleanup_scheduler.start()
     except Exception as e:
         logger.error(f"Error during startup: {e}")
         raise
@@ -39,7 +74,13 @@ async def lifespan(app: FastAPI):
     
     # Shutdown
     try:
+        await readiness.stop()
+        await cleanup_scheduler.stop()
+        shared_gallery.stop()
+        gallery_sync.stop()
+        compute.shutdown_executors()
         logger.info("Shutting down connection pool")
+        await database.close()
         if pool:
             pool.closeall()
             logger.info("Database connection pool closed")
@@ -63,6 +104,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Opt-in request profiling; not installed unless a trigger is configured
+if profiling.PROFILING_ENABLED:
+    app.add_middleware(profiling.ProfilingMiddleware)
+
 # Add request timing middleware
 @app.middleware("http")
 async def add_process_time_header(request: Request, call_next):
@@ -70,6 +115,9 @@ async def add_process_time_header(request: Request, call_next):
     response = await call_next(request)
     process_time = time.time() - start_time
     response.headers["X-Process-Time"] = str(process_time)
+    # Label by route template, not raw path, so ids in URLs do not multiply series
+    route = request.scope.get("route")
+    metrics.observe_request(request.method, route.path if route else "other", response.status_code, process_time)
     return response
 
 # Root endpoint
@@ -84,16 +132,40 @@ app.include_router(
     tags=["face-recognition"]
 )
 
+# Admin endpoints for stored profiles
+app.include_router(profiling.router, prefix="/admin", tags=["admin"])
+
 # Add WebSocket endpoint
 app.add_api_websocket_route("/ws/register", websocket_register)
 
 # Add WebSocket endpoint for detection
 app.add_api_websocket_route("/ws/detect", websocket_detect)
 
+# Add WebSocket endpoint for streaming recognition
+app.add_api_websocket_route("/ws/recognize", websocket_recognize)
+
 # Add a health check endpoint
 @app.get("/health", tags=["health"])
 async def health_check():
-    return {"status": "healthy", "version": "1.0.0"}
+    return {
+        "status": "healthy",
+        "version": "1.0.0",
+        "executors": compute.executor_stats(),
+        "encoding_cache": encoding_cache.stats(),
+        "db_pool": database.stats(),
+        "cleanup": cleanup_scheduler.stats(),
+    }
+
+# Readiness probe: 503 until models, gallery and database are usable
+@app.get("/ready", tags=["health"])
+async def ready_check():
+    ready, report = await readiness.check(database, gallery)
+    return JSONResponse(status_code=200 if ready else 503, content=report)
+
+# Prometheus scrape endpoint
+@app.get("/metrics", tags=["health"])
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 # Add configuration endpoint for frontend
 @app.get("/config", tags=["config"])
@@ -108,37 +180,16 @@ async def get_client_config():
 @app.post("/detect")
 async def detect_faces(file: UploadFile = File(...)):
     try:
-        # Read image from request
+        # Read image from request and detect on the compute pool
         contents = await file.read()
-        np_arr = np.frombuffer(contents, np.uint8)
-        img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+        face_list = await compute.detect_faces(contents)
         
-        if img is None:
+        if face_list is None:
             return JSONResponse(
                 status_code=400,
                 content={"success": False, "error": "Could not decode image"}
             )
         
-        # Convert to grayscale for face detection
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        
-        # Load the cascade classifier
-        cascade_path = os.path.join(os.path.dirname(__file__), "haarcascade_frontalface_default.xml")
-        face_cascade = cv2.CascadeClassifier(cascade_path)
-        
-        # Detect faces
-        faces = face_cascade.detectMultiScale(
-            gray,
-            scaleFactor=1.1,
-            minNeighbors=5,
-            minSize=(30, 30)
-        )
-        
-        # Process results
-        face_list = []
-        for (x, y, w, h) in faces:
-            face_list.append({"x": int(x), "y": int(y), "width": int(w), "height": int(h)})
-        
         return {"success": True, "faces": face_list}
     
     except Exception as e:
@@ -0,0 +1,217 @@
+"""In-process metrics exposed in Prometheus text format on /metrics.
+
+Histograms record how long each pipeline stage (upload read, decode,
+detection, encoding, database, matching), each HTTP endpoint and each
+WebSocket frame takes. Gauges are read from their owners (pools, gallery,
+caches) when /metrics is scraped, so they cost nothing in between.
+
+Stages that run in compute worker processes are timed there and shipped
+back with the result (see run_collecting), so the parent process holds
+every series. Each uvicorn worker exposes its own metrics.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+
+# Upper bounds in seconds, from a cached hit to a slow full-size encode
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Cumulative-bucket histogram with one series per label combination"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts (the last one is +Inf), then sum
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            series[1] += value
+
+    def snapshot(self):
+        """{labels: (cumulative bucket counts, sum, count)} for reports and tests"""
+        with self._lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self._series.items()]
+        result = {}
+        for key, counts, total in items:
+            cumulative = []
+            running = 0
+            for count in counts:
+                running += count
+                cumulative.append(running)
+            result[key] = (cumulative, total, running)
+        return result
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, (cumulative, total, count) in sorted(self.snapshot().items()):
+            for bound, value in zip(self.buckets + (float("inf"),), cumulative):
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {value}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Gauge:
+    """Value read from a callback at scrape time.
+
+    The callback returns a number, or a {label value(s): number} dict when
+    the gauge has labels. Counters that only grow use kind="counter".
+    """
+
+    def __init__(self, name, documentation, callback, labelnames=(), kind="gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        value = self.callback()
+        if not self.labelnames:
+            lines.append(f"{self.name} {_format_value(value)}")
+            return lines
+        for key, item in sorted(value.items()):
+            key = key if isinstance(key, tuple) else (key,)
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(item)}")
+        return lines
+
+
+class Registry:
+    """Named metrics rendered together in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            # Re-registering (e.g. a module reloaded in tests) replaces the old one
+            self._metrics[metric.name] = metric
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, callback, labelnames=(), kind="gauge"):
+        return self._register(Gauge(name, documentation, callback, labelnames, kind))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                # A gauge whose owner is not started yet is left out of this scrape
+                continue
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram(
+    "face_stage_seconds", "Time spent in each pipeline stage", ["stage"])
+REQUEST_SECONDS = registry.histogram(
+    "face_http_request_seconds", "HTTP request latency by endpoint", ["method", "endpoint", "status"])
+WS_FRAME_SECONDS = registry.histogram(
+    "face_ws_frame_seconds", "Time to handle one WebSocket frame by endpoint", ["endpoint"])
+
+_local = threading.local()
+
+
+@contextmanager
+def stage(name):
+    """Time a block as one pipeline stage.
+
+    Inside run_collecting (a compute worker) the timing is collected for the
+    parent process; otherwise it is recorded here directly.
+    """
+    if not METRICS_ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        collected = getattr(_local, "stages", None)
+        if collected is not None:
+            collected.append((name, elapsed))
+        else:
+            STAGE_SECONDS.observe(elapsed, stage=name)
+
+
+def run_collecting(fn, *args):
+    """Run fn(*args) in a pool worker, returning (result, [(stage, seconds), ...], seconds run)"""
+    _local.stages = []
+    started = time.perf_counter()
+    try:
+        return fn(*args), _local.stages, time.perf_counter() - started
+    finally:
+        _local.stages = None
+
+
+def observe_stage(name, seconds):
+    if METRICS_ENABLED:
+        STAGE_SECONDS.observe(seconds, stage=name)
+
+
+def record_stages(stages):
+    """Record stage timings collected by run_collecting in a worker"""
+    for name, elapsed in stages:
+        observe_stage(name, elapsed)
+
+
+def observe_request(method, endpoint, status, seconds):
+    if METRICS_ENABLED:
+        REQUEST_SECONDS.observe(seconds, method=method, endpoint=endpoint, status=status)
+
+
+def observe_frame(endpoint, seconds):
+    if METRICS_ENABLED:
+        WS_FRAME_SECONDS.observe(seconds, endpoint=endpoint)
+
+
+def render():
+    return registry.render()
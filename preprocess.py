@@ -0,0 +1,86 @@
+"""Image decoding shared by every endpoint.
+
+Uploads and frames are decoded exactly once, straight to a capped working
+resolution: JPEGs are decoded at a reduced DCT scale (1/2, 1/4 or 1/8) so a
+12-megapixel photo never exists at full size in memory, and EXIF
+orientation is applied so boxes match the image as the user sees it.
+Detection and encoding run on the working image; locations are mapped back
+to original coordinates with the image's scale.
+"""
+import io
+import os
+from collections import namedtuple
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+from metrics import stage
+
+# Longest side of the working image used for encoding; 0 keeps full resolution
+PREPROCESS_MAX_SIDE = int(os.getenv('PREPROCESS_MAX_SIDE', '1280'))
+
+# File names treated as images inside zip uploads and bulk imports
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+# EXIF orientations that swap width and height
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+class ImageDecodeError(ValueError):
+    """The bytes are not an image we can decode"""
+
+
+class PreparedImage(namedtuple("PreparedImage", ["rgb", "scale", "original_size"])):
+    """A decoded working image.
+
+    rgb is an (H, W, 3) uint8 array, scale is working size / original size
+    and original_size is the (width, height) after EXIF orientation.
+    """
+
+    __slots__ = ()
+
+    @property
+    def bgr(self):
+        """The working image in OpenCV channel order"""
+        return np.ascontiguousarray(self.rgb[:, :, ::-1])
+
+    def location_to_original(self, location):
+        """A face_recognition (top, right, bottom, left) location in original pixels"""
+        return tuple(int(round(v / self.scale)) for v in location)
+
+    def location_to_working(self, location):
+        return tuple(int(round(v * self.scale)) for v in location)
+
+    def box_to_original(self, box):
+        """An {"x", "y", "width", "height"} box (extra keys kept) in original pixels"""
+        return {**box, **{k: int(round(box[k] / self.scale)) for k in ("x", "y", "width", "height")}}
+
+
+def load_image(image_bytes, max_side=PREPROCESS_MAX_SIDE):
+    """Decode image bytes once into an RGB working image no larger than max_side"""
+    with stage("decode"):
+        return _load_image(image_bytes, max_side)
+
+
+def _load_image(image_bytes, max_side):
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        width, height = image.size
+        orientation = image.getexif().get(0x0112, 1)
+        if orientation in _TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+        scale = 1.0
+        if max_side and max(width, height) > max_side:
+            scale = max_side / max(width, height)
+            # JPEG only: decode at the smallest DCT scale still at least this big
+            image.draft("RGB", (int(np.ceil(image.size[0] * scale)), int(np.ceil(image.size[1] * scale))))
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        rgb = np.asarray(image)
+    except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+        raise ImageDecodeError(f"Could not decode image: {e}") from e
+
+    target = (max(1, round(width * scale)), max(1, round(height * scale)))
+    if (rgb.shape[1], rgb.shape[0]) != target:
+        rgb = cv2.resize(rgb, target, interpolation=cv2.INTER_AREA)
+    return PreparedImage(rgb, target[0] / width, (width, height))
@@ -0,0 +1,297 @@
+"""Opt-in profiling of single HTTP requests and WebSocket sessions.
+
+A request is profiled when it carries an X-Profile header equal to
+ADMIN_API_KEY, or at random with probability PROFILE_SAMPLE_RATE. The
+event loop thread runs under cProfile for the request's duration, and jobs
+it sends to the compute pools (decode, detection, dlib encoding) are
+profiled inside the worker and merged into the same report. Reports are
+kept in memory, optionally dumped as .prof files to PROFILE_DIR, and served
+under /admin/profiles to holders of ADMIN_API_KEY.
+
+Profiling slows down everything else on the event loop, so a WebSocket
+session is only profiled for its first PROFILE_WS_MAX_MESSAGES messages or
+PROFILE_WS_MAX_SECONDS seconds, whichever comes first.
+
+When neither trigger is configured the middleware is not installed and
+nothing is profiled.
+"""
+import asyncio
+import cProfile
+import contextvars
+import io
+import itertools
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import PlainTextResponse
+from fastapi.security.api_key import APIKeyHeader
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Key for /admin endpoints and the X-Profile header; unset disables both
+ADMIN_API_KEY = os.getenv('ADMIN_API_KEY', '')
+# Fraction of requests and WebSocket sessions profiled without the header
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+# Reports kept in memory, oldest dropped first
+PROFILE_MAX_REPORTS = int(os.getenv('PROFILE_MAX_REPORTS', '50'))
+# Directory for pstats dumps (open with snakeviz or pstats); unset keeps reports in memory only
+PROFILE_DIR = os.getenv('PROFILE_DIR', '')
+# Functions listed in a text report
+PROFILE_TOP = int(os.getenv('PROFILE_TOP', '40'))
+# Limits on how much of a WebSocket session is profiled
+PROFILE_WS_MAX_MESSAGES = int(os.getenv('PROFILE_WS_MAX_MESSAGES', '50'))
+PROFILE_WS_MAX_SECONDS = float(os.getenv('PROFILE_WS_MAX_SECONDS', '10'))
+
+PROFILE_HEADER = b"x-profile"
+PROFILING_ENABLED = bool(ADMIN_API_KEY) or PROFILE_SAMPLE_RATE > 0
+
+_current = contextvars.ContextVar("profile", default=None)
+
+
+class _CollectedStats:
+    """pstats input built from a worker profiler's stats dict"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def run_profiled(fn, *args):
+    """Run fn(*args) under cProfile in a pool worker, returning (result, raw stats)"""
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Python 3.12+ allows one profiler per interpreter, and a thread
+        # worker shares it with the event loop's
+        return fn(*args), {}
+    try:
+        result = fn(*args)
+    finally:
+        profiler.disable()
+    profiler.create_stats()
+    return result, profiler.stats
+
+
+def current():
+    """The profile of the request running in this context, if it is still being profiled"""
+    profile = _current.get()
+    return profile if profile is not None and profile.running else None
+
+
+class RequestProfile:
+    """One profiled request or WebSocket session"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, kind, path, trigger):
+        self.id = f"{int(time.time())}-{next(self._ids)}"
+        self.kind = kind
+        self.path = path
+        self.trigger = trigger
+        self.started_at = time.time()
+        self.duration_ms = None
+        self.status = None
+        self.worker_jobs = 0
+        self.messages = 0
+        self.running = False
+        self._profiler = cProfile.Profile()
+        self._worker_stats = []
+        self._stats = None
+
+    def add_worker_stats(self, stats):
+        if not self.running:
+            # A job that outlived the profiled part of a session
+            return
+        self.worker_jobs += 1
+        self._worker_stats.append(stats)
+
+    def start(self):
+        self._started = time.perf_counter()
+        self.running = True
+        self._profiler.enable()
+
+    def finish(self, status_code=None):
+        self._profiler.disable()
+        self.running = False
+        self.duration_ms = round(1000 * (time.perf_counter() - self._started), 2)
+        self.status = status_code
+        self._stats = pstats.Stats(self._profiler)
+        for stats in self._worker_stats:
+            self._stats.add(_CollectedStats(stats))
+        self._worker_stats = []
+        if PROFILE_DIR:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            self._stats.dump_stats(os.path.join(PROFILE_DIR, f"{self.id}.prof"))
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "path": self.path,
+            "trigger": self.trigger,
+            "started_at": self.started_at,
+            "duration_ms": self.duration_ms,
+            "status": self.status,
+            "worker_jobs": self.worker_jobs,
+            "messages": self.messages,
+        }
+
+    def report(self, sort="cumulative", limit=PROFILE_TOP):
+        out = io.StringIO()
+        out.write(f"{self.kind} {self.path}: {self.duration_ms} ms, {self.worker_jobs} compute jobs\n")
+        if self.kind == "websocket":
+            out.write(f"Covers the first {self.messages} messages of the session.\n")
+        out.write("Event-loop time includes anything else the loop ran meanwhile.\n\n")
+        self._stats.stream = out
+        self._stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+
+class ProfileStore:
+    """Finished profiles, newest last, bounded by PROFILE_MAX_REPORTS"""
+
+    def __init__(self, max_reports=PROFILE_MAX_REPORTS):
+        self.max_reports = max_reports
+        self.skipped = 0
+        self._profiles = OrderedDict()
+        self._lock = threading.Lock()
+        # cProfile can only profile the event loop thread once at a time
+        self.active = None
+
+    def add(self, profile):
+        with self._lock:
+            self._profiles[profile.id] = profile
+            while len(self._profiles) > self.max_reports:
+                self._profiles.popitem(last=False)
+
+    def get(self, profile_id):
+        return self._profiles.get(profile_id)
+
+    def summaries(self):
+        with self._lock:
+            return [profile.summary() for profile in reversed(self._profiles.values())]
+
+
+profiles = ProfileStore()
+
+
+def _trigger(scope):
+    for name, value in scope.get("headers", ()):
+        if name == PROFILE_HEADER:
+            if ADMIN_API_KEY and value.decode("latin-1") == ADMIN_API_KEY:
+                return "header"
+            return None
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return "sample"
+    return None
+
+
+class ProfilingMiddleware:
+    """ASGI middleware profiling selected HTTP requests and WebSocket sessions.
+
+    Profiled HTTP responses carry an X-Profile-Id header naming the report.
+    WebSocket sessions are profiled up to PROFILE_WS_MAX_MESSAGES messages
+    or PROFILE_WS_MAX_SECONDS seconds and then carry on unprofiled. Only one
+    request is profiled at a time; triggers that arrive meanwhile are
+    counted as skipped.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+        trigger = _trigger(scope)
+        if trigger is None:
+            return await self.app(scope, receive, send)
+        if profiles.active is not None:
+            profiles.skipped += 1
+            return await self.app(scope, receive, send)
+
+        profile = RequestProfile(scope["type"], scope["path"], trigger)
+        status_code = None
+
+        async def send_with_id(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message = {**message, "headers": list(message.get("headers", [])) +
+                           [(b"x-profile-id", profile.id.encode())]}
+            await send(message)
+
+        def stop():
+            if not profile.running:
+                return
+            profile.finish(status_code)
+            profiles.active = None
+            profiles.add(profile)
+            logger.info(f"Profiled {profile.kind} {profile.path} in {profile.duration_ms} ms as {profile.id}")
+
+        async def receive_capped():
+            message = await receive()
+            if message["type"] == "websocket.receive" and profile.running:
+                if profile.messages >= PROFILE_WS_MAX_MESSAGES:
+                    stop()
+                else:
+                    profile.messages += 1
+            return message
+
+        token = _current.set(profile)
+        profiles.active = profile
+        profile.start()
+        timer = None
+        try:
+            if scope["type"] == "http":
+                await self.app(scope, receive, send_with_id)
+            else:
+                # Stops the profile even if the session goes quiet
+                timer = asyncio.get_running_loop().call_later(PROFILE_WS_MAX_SECONDS, stop)
+                await self.app(scope, receive_capped, send)
+        finally:
+            if timer is not None:
+                timer.cancel()
+            stop()
+            _current.reset(token)
+
+
+admin_key_header = APIKeyHeader(name='X-Admin-Key')
+
+
+def get_admin_key(admin_key: str = Depends(admin_key_header)):
+    if not ADMIN_API_KEY or admin_key != ADMIN_API_KEY:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid admin key")
+
+
+router = APIRouter(dependencies=[Depends(get_admin_key)])
+
+
+@router.get("/profiles")
+async def list_profiles():
+    return {
+        "enabled": PROFILING_ENABLED,
+        "sample_rate": PROFILE_SAMPLE_RATE,
+        "skipped": profiles.skipped,
+        "profiles": profiles.summaries(),
+    }
+
+
+@router.get("/profiles/{profile_id}")
+async def get_profile(profile_id: str, sort: str = "cumulative", limit: int = PROFILE_TOP):
+    profile = profiles.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+    try:
+        return PlainTextResponse(profile.report(sort, limit))
+    except KeyError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown sort key: {sort}")
@@ -0,0 +1,85 @@
+"""Startup progress and the checks behind /ready.
+
+/health only says the process is up. /ready succeeds once the database
+answers, the gallery is loaded and every encode worker has loaded and
+warmed up its models, so a load balancer can keep traffic away from a
+cold instance. Each startup step's duration is reported with it.
+"""
+import asyncio
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+import compute
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Seconds /ready waits for the database to answer before reporting it down
+READY_DB_TIMEOUT = float(os.getenv('READY_DB_TIMEOUT', '2'))
+
+
+class Readiness:
+    """Records startup steps and decides whether the instance can take traffic"""
+
+    def __init__(self):
+        self.steps = {}
+        self.errors = {}
+        self.models_ready = False
+        self.workers = []
+        self._warm_up_task = None
+
+    @contextmanager
+    def step(self, name):
+        """Time one startup step, recording its error if it fails"""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.errors[name] = str(e)
+            raise
+        finally:
+            self.steps[name] = round(1000 * (time.perf_counter() - started), 1)
+
+    def start_warm_up(self):
+        """Load the models in every compute worker in the background"""
+        if self._warm_up_task is None:
+            self._warm_up_task = asyncio.create_task(self._warm_up())
+
+    async def _warm_up(self):
+        try:
+            with self.step("models"):
+                self.workers = await compute.warm_up()
+            self.models_ready = True
+            logger.info(f"Models warm in {len(self.workers)} encode workers after {self.steps['models']} ms")
+        except Exception as e:
+            logger.error(f"Model warm-up failed: {e}")
+
+    async def stop(self):
+        if self._warm_up_task is not None:
+            self._warm_up_task.cancel()
+            try:
+                await self._warm_up_task
+            except asyncio.CancelledError:
+                pass
+            self._warm_up_task = None
+
+    async def check(self, database, gallery):
+        """(ready, report) from the models, the gallery and a database round trip"""
+        try:
+            db_ms = await asyncio.wait_for(database.ping(), READY_DB_TIMEOUT)
+            db_ok, db_detail = True, {"ping_ms": db_ms}
+        except Exception as e:
+            db_ok, db_detail = False, {"error": str(e) or type(e).__name__}
+        checks = {
+            "models": {"ok": self.models_ready, "workers": self.workers},
+            "gallery": {"ok": bool(gallery.loaded), "encodings": len(gallery)},
+            "database": {"ok": db_ok, **db_detail},
+        }
+        ready = all(check["ok"] for check in checks.values())
+        return ready, {"ready": ready, "checks": checks, "startup_ms": self.steps, "errors": self.errors}
+
+
+# Process-wide startup state, filled in by the application lifespan
+readiness = Readiness()
@@ -0,0 +1,327 @@
+"""One gallery copy shared by every uvicorn worker process.
+
+The first worker to take an exclusive lock on GALLERY_SHM_DIR/writer.lock
+becomes the writer: it loads the gallery (snapshot.load_gallery), runs the
+usual GallerySync, and publishes the gallery as a snapshot directory under
+GALLERY_SHM_DIR, by default on tmpfs. Every other worker is a reader that
+memory-maps the latest published snapshot, so the encoding and face id
+pages exist once in RAM however many workers there are.
+
+Each published snapshot is a generation. Later changes are appended to the
+generation's delta log (deltas.log, one JSON line per add or remove), and
+readers replay the new lines through FaceGallery.add/remove, so an
+enrollment costs every worker O(1) work instead of a full remap. Generation
+files carry unused rows that these appends fill in their copy-on-write
+maps. A new full generation is only written when the gallery is replaced
+wholesale, or when the deltas are using up the spare rows, and then no
+more often than every GALLERY_SHM_COMPACT_INTERVAL seconds unless the
+rows are exhausted.
+
+A small mapped counter file holds the current generation and the length of
+its delta log. The writer only bumps either after the data they point at
+is complete, so a reader that sees a new value can use it without further
+coordination. Readers take over the lock, and with it the writer role, if
+the writer process exits.
+"""
+import base64
+import datetime
+import fcntl
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import snapshot
+from gallery import gallery as default_gallery
+from gallery_sync import gallery_sync as default_sync
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+GALLERY_SHARED = os.getenv('GALLERY_SHARED', 'false').lower() == 'true'
+GALLERY_SHM_DIR = os.getenv(
+    'GALLERY_SHM_DIR',
+    os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'face-gallery')
+)
+# Seconds between the writer's publishes (when the gallery changed) and readers' checks
+GALLERY_SHM_INTERVAL = float(os.getenv('GALLERY_SHM_INTERVAL', '1'))
+# How long a reader waits at startup for the writer's first generation
+GALLERY_SHM_WAIT = float(os.getenv('GALLERY_SHM_WAIT', '300'))
+# Minimum seconds between full generations while spare rows remain
+GALLERY_SHM_COMPACT_INTERVAL = float(os.getenv('GALLERY_SHM_COMPACT_INTERVAL', '60'))
+
+# Spare rows (and users) in each generation, as a fraction of its size
+SPARE_FRACTION = 0.125
+MIN_SPARE = 1024
+
+WRITER = "writer"
+READER = "reader"
+
+
+def _spare(count):
+    return max(MIN_SPARE, int(count * SPARE_FRACTION))
+
+
+def _encode_change(change):
+    if change[0] == "add":
+        _, face_id, user_id, name, encoding = change
+        record = {"op": "add", "face_id": face_id, "user_id": user_id, "name": name,
+                  "encoding": base64.b64encode(encoding).decode("ascii")}
+    else:
+        record = {"op": "remove", "face_id": change[1]}
+    return json.dumps(record).encode() + b"\n"
+
+
+def _decode_change(line):
+    record = json.loads(line)
+    if record["op"] == "add":
+        return ("add", record["face_id"], record["user_id"], record["name"], base64.b64decode(record["encoding"]))
+    return ("remove", record["face_id"])
+
+
+class SharedGallery:
+    """Publishes or maps a FaceGallery shared between worker processes"""
+
+    def __init__(self, gallery, sync, directory=GALLERY_SHM_DIR, interval=GALLERY_SHM_INTERVAL):
+        self.gallery = gallery
+        self.sync = sync
+        self.directory = directory
+        self.interval = interval
+        self.role = None
+        self.generation = 0
+        self.refreshes = 0
+        self.full_publishes = 0
+        self.deltas = 0
+        # Writer: bytes and records in the current generation's delta log,
+        # and adds it can take before readers run out of spare rows
+        # Reader: bytes of the mapped generation's delta log already applied
+        self._delta_length = 0
+        self._delta_records = 0
+        self._spare_rows = 0
+        self._published_at = 0.0
+        self._lock_file = None
+        self._counter = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _generation_path(self, generation):
+        return os.path.join(self.directory, f"gen-{generation}")
+
+    def _delta_path(self, generation):
+        return os.path.join(self._generation_path(generation), "deltas.log")
+
+    def _open_counter(self):
+        # [generation, bytes in its delta log]
+        path = os.path.join(self.directory, "generation")
+        if not os.path.exists(path) or os.path.getsize(path) != 16:
+            # Created under a temporary name so nobody maps a short file
+            tmp_path = f"{path}.{os.getpid()}"
+            np.zeros(2, dtype=np.int64).tofile(tmp_path)
+            os.replace(tmp_path, path)
+        self._counter = np.memmap(path, dtype=np.int64, mode="r+", shape=(2,))
+
+    def _published(self):
+        """(generation, delta log length) as last written by the writer, or None mid-update"""
+        generation = int(self._counter[0])
+        length = int(self._counter[1])
+        if int(self._counter[0]) != generation:
+            return None
+        return generation, length
+
+    def _next_generation(self):
+        """One past every generation published so far, by this or an earlier writer"""
+        published = [int(name[4:]) for name in os.listdir(self.directory)
+                     if name.startswith("gen-") and name[4:].isdigit()]
+        return max(published + [self.generation, int(self._counter[0])]) + 1
+
+    def _try_lock(self):
+        if self._lock_file is None:
+            self._lock_file = open(os.path.join(self.directory, "writer.lock"), "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def start(self, sync_enabled=True):
+        """Take the writer or reader role and make the gallery available"""
+        os.makedirs(self.directory, exist_ok=True)
+        self._open_counter()
+        if self._try_lock():
+            self._become_writer(sync_enabled)
+        else:
+            self.role = READER
+            self.gallery.read_only = True
+            self._wait_for_writer()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(sync_enabled,), name="shared-gallery", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _become_writer(self, sync_enabled):
+        self.role = WRITER
+        # Readers may already map a later generation than this worker did;
+        # numbering past all of them makes every reader remap ours
+        generation = self._next_generation()
+        # Generations left by a previous writer may be stale; 0 means "not ready"
+        self._counter[0] = 0
+        self._counter.flush()
+        self.gallery.read_only = False
+        if not self.gallery.loaded:
+            snapshot.load_gallery(self.gallery, self.sync)
+        self.gallery.record_changes()
+        self._publish_full(generation)
+        for name in os.listdir(self.directory):
+            if name.startswith("gen-") and name != f"gen-{self.generation}":
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        if sync_enabled:
+            self.sync.start()
+        logger.info(f"Shared gallery writer (pid {os.getpid()}) published {len(self.gallery)} encodings")
+
+    def _wait_for_writer(self):
+        deadline = time.monotonic() + GALLERY_SHM_WAIT
+        while not self.refresh():
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"No shared gallery published in {self.directory} after {GALLERY_SHM_WAIT}s")
+            time.sleep(min(self.interval, 0.5))
+        logger.info(f"Shared gallery reader (pid {os.getpid()}) mapped generation {self.generation}")
+
+    def publish(self):
+        """Publish the gallery's changes since the last call; returns whether anything was published.
+
+        Adds and removes go to the current generation's delta log. A full
+        generation is written when the gallery was replaced, or to compact
+        the deltas once they use half the spare rows (forced when all of
+        them are used).
+        """
+        reset, changes = self.gallery.drain_changes()
+        if not reset and not changes:
+            return False
+        records = self._delta_records + len(changes)
+        due = time.monotonic() - self._published_at >= GALLERY_SHM_COMPACT_INTERVAL
+        if reset or records >= self._spare_rows or (due and records >= self._spare_rows // 2):
+            # The full copy includes these changes; any made between the drain
+            # and the copy are also journaled again, and replaying an add or
+            # remove that is already applied does nothing
+            self._publish_full()
+        else:
+            self._append_deltas(changes)
+        return True
+
+    def _append_deltas(self, changes):
+        data = b"".join(_encode_change(change) for change in changes)
+        with open(self._delta_path(self.generation), "ab") as f:
+            f.write(data)
+        self._delta_length += len(data)
+        self._delta_records += len(changes)
+        self.deltas += len(changes)
+        self._counter[1] = self._delta_length
+        self._counter.flush()
+
+    def _publish_full(self, generation=None):
+        """Write the whole gallery as a new generation with an empty delta log"""
+        generation = generation or self._next_generation()
+        columns = self.gallery.columns()
+        count, users = len(columns["face_ids"]), len(columns["users"])
+        snapshot.write(
+            self._generation_path(generation), columns["encodings"], columns["face_ids"],
+            columns["user_codes"], columns["users"], self.gallery.loaded_at or datetime.datetime.now(),
+            sq_norms=columns["sq_norms"], shot_sums=columns["shot_sums"],
+            capacity=count + _spare(count), user_capacity=users + _spare(users),
+        )
+        open(self._delta_path(generation), "wb").close()
+        # Length first: a reader that still sees the old generation then
+        # reads nothing new, instead of reading the new log's length
+        self._counter[1] = 0
+        self._counter[0] = generation
+        self._counter.flush()
+        previous = self._generation_path(self.generation)
+        self.generation = generation
+        self._delta_length = self._delta_records = 0
+        self._spare_rows = _spare(count)
+        self._published_at = time.monotonic()
+        self.full_publishes += 1
+        # Readers still mapping the old files keep them alive until they remap
+        if previous != self._generation_path(generation):
+            shutil.rmtree(previous, ignore_errors=True)
+
+    def refresh(self):
+        """Catch up with the writer: map a newer generation, then apply new deltas"""
+        published = self._published()
+        if published is None or published[0] == 0:
+            return False
+        generation, length = published
+        mapped = False
+        if generation != self.generation:
+            try:
+                snapshot.load(self.gallery, self._generation_path(generation))
+            except (OSError, ValueError) as e:
+                # Replaced by a newer generation while we were opening it
+                logger.debug(f"Shared gallery generation {generation} unavailable: {e}")
+                return False
+            self.generation = generation
+            self._delta_length = 0
+            self.refreshes += 1
+            mapped = True
+        return self._apply_deltas(length) or mapped
+
+    def _apply_deltas(self, length):
+        if length <= self._delta_length:
+            return False
+        try:
+            with open(self._delta_path(self.generation), "rb") as f:
+                f.seek(self._delta_length)
+                data = f.read(length - self._delta_length)
+        except OSError:
+            # Compacted into a newer generation; the next refresh maps it
+            return False
+        end = data.rfind(b"\n") + 1
+        if not end:
+            return False
+        changes = [_decode_change(line) for line in data[:end].splitlines()]
+        self.gallery.apply_changes(changes)
+        self._delta_length += end
+        self.deltas += len(changes)
+        return True
+
+    def _run(self, sync_enabled):
+        while not self._stop.wait(self.interval):
+            try:
+                if self.role == WRITER:
+                    self.publish()
+                elif self._try_lock():
+                    logger.info("Shared gallery writer went away, taking over")
+                    # Start from everything the old writer published
+                    self.refresh()
+                    self._become_writer(sync_enabled)
+                else:
+                    self.refresh()
+            except Exception as e:
+                logger.error(f"Shared gallery {self.role} error: {e}")
+
+    def stats(self):
+        return {
+            "role": self.role,
+            "generation": self.generation,
+            "refreshes": self.refreshes,
+            "full_publishes": self.full_publishes,
+            "deltas": self.deltas,
+            "directory": self.directory,
+        }
+
+
+# Process-wide role for the shared gallery, started in the application lifespan
+shared_gallery = SharedGallery(default_gallery, default_sync)
@@ -0,0 +1,256 @@
+"""Memory-mapped gallery snapshots for fast startup.
+
+A snapshot is a directory holding the gallery as flat .npy columns plus a
+meta.json with the format version, row count, user table and the
+high-water mark of the database snapshot it was taken from:
+
+    encodings.npy        (N, 128) float64, memory-mapped copy-on-write at startup
+    sq_norms.npy         (N,) float64 squared row norms
+    face_ids.npy         (N,) fixed-width face UUIDs
+    user_codes.npy       (N,) int64 index into meta.json's users
+    shot_sums.npy        (U, 128) float64 per-user encoding sums
+    sorted_face_ids.npy  (N,) face UUIDs in sorted order, for finding a face's row
+    sorted_rows.npy      (N,) int64 row of each sorted face UUID
+
+Loading maps the files instead of pulling every BYTEA row through
+psycopg2; only rows newer than the high-water mark are then read from the
+database. Build a snapshot from user_faces with:
+
+    python snapshot.py build [--path DIR]
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+import psycopg2.extensions
+
+from db import get_db_conn, get_db_connection
+from gallery import ENCODING_SIZE
+from gallery_sync import FACE_ROWS_QUERY
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Snapshot directory; startup falls back to a full database load if it is missing
+GALLERY_SNAPSHOT_PATH = os.getenv('GALLERY_SNAPSHOT_PATH', 'gallery_snapshot')
+
+SNAPSHOT_VERSION = 2
+FETCH_SIZE = 10000
+COLUMNS = ("encodings", "sq_norms", "face_ids", "user_codes", "shot_sums")
+FACE_ID_DTYPE = "U36"
+
+
+def _column_path(path, column):
+    return os.path.join(path, f"{column}.npy")
+
+
+def build(path=GALLERY_SNAPSHOT_PATH):
+    """Write a snapshot of user_faces to path, replacing any previous one"""
+    start = time.perf_counter()
+    tmp_path = f"{path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    conn = get_db_conn()
+    try:
+        # One consistent view: the count, the rows and LOCALTIMESTAMP all
+        # belong to the same database snapshot
+        conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+        with conn.cursor() as cur:
+            cur.execute("SELECT LOCALTIMESTAMP")
+            high_water_mark = cur.fetchone()[0]
+            cur.execute("SELECT COUNT(*) FROM user_faces uf JOIN users u ON u.id = uf.user_id")
+            count = cur.fetchone()[0]
+
+        encodings = np.lib.format.open_memmap(
+            _column_path(tmp_path, "encodings"), mode="w+", dtype=np.float64, shape=(count, ENCODING_SIZE)
+        )
+        face_ids = np.empty(count, dtype=FACE_ID_DTYPE)
+        user_codes = np.empty(count, dtype=np.int64)
+        codes, users = {}, []
+
+        # Server-side cursor so rows are streamed instead of fetched all at once
+        with conn.cursor(name="gallery_snapshot") as cur:
+            cur.itersize = FETCH_SIZE
+            cur.execute(FACE_ROWS_QUERY)
+            row_count = 0
+            while True:
+                rows = cur.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                end = row_count + len(rows)
+                encodings[row_count:end] = np.frombuffer(
+                    b"".join(bytes(row[3]) for row in rows), dtype=np.float64
+                ).reshape(len(rows), ENCODING_SIZE)
+                face_ids[row_count:end] = [str(row[0]) for row in rows]
+                for i, row in enumerate(rows, row_count):
+                    user_id = str(row[1])
+                    code = codes.get(user_id)
+                    if code is None:
+                        code = codes[user_id] = len(users)
+                        users.append([user_id, row[2]])
+                    user_codes[i] = code
+                row_count = end
+        conn.rollback()
+    finally:
+        conn.close()
+
+    if row_count != count:
+        raise RuntimeError(f"Expected {count} rows but read {row_count}")
+    _finish(tmp_path, path, encodings, face_ids, user_codes, users, high_water_mark)
+    logger.info(f"Wrote snapshot of {count} encodings to {path} in {time.perf_counter() - start:.1f}s")
+    return count
+
+
+def _padded(column, capacity):
+    if len(column) >= capacity:
+        return column
+    padded = np.zeros((capacity,) + column.shape[1:], dtype=column.dtype)
+    padded[:len(column)] = column
+    return padded
+
+
+def write(path, encodings, face_ids, user_codes, users, high_water_mark, sq_norms=None, shot_sums=None,
+          capacity=None, user_capacity=None):
+    """Write a snapshot from in-memory columns; users is a list of [user_id, name].
+
+    capacity and user_capacity leave unused rows after the real ones, so a
+    gallery mapping the snapshot can append rows and users into its
+    copy-on-write map without copying it. Unused encoding rows are a sparse
+    hole in the file and take no space.
+    """
+    tmp_path = f"{path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    count = len(face_ids)
+    capacity = max(capacity or count, count)
+    encodings = np.asarray(encodings, dtype=np.float64).reshape(-1, ENCODING_SIZE)
+    user_codes = np.asarray(user_codes, dtype=np.int64)
+    if sq_norms is None:
+        sq_norms = np.einsum("ij,ij->i", encodings, encodings)
+    if shot_sums is None:
+        shot_sums = np.zeros((len(users), ENCODING_SIZE), dtype=np.float64)
+        np.add.at(shot_sums, user_codes, encodings)
+    mapped = np.lib.format.open_memmap(
+        _column_path(tmp_path, "encodings"), mode="w+", dtype=np.float64, shape=(capacity, ENCODING_SIZE)
+    )
+    mapped[:count] = encodings
+    face_ids = np.asarray([str(face_id) for face_id in face_ids], dtype=FACE_ID_DTYPE)
+    _finish(tmp_path, path, mapped, _padded(face_ids, capacity), _padded(user_codes, capacity), users,
+            high_water_mark, _padded(sq_norms, capacity), _padded(shot_sums, user_capacity or 0), count=count)
+    del mapped
+
+
+def _finish(tmp_path, path, encodings, face_ids, user_codes, users, high_water_mark, sq_norms=None, shot_sums=None,
+            count=None):
+    if sq_norms is None:
+        sq_norms = np.einsum("ij,ij->i", encodings, encodings)
+    if shot_sums is None:
+        shot_sums = np.zeros((len(users), ENCODING_SIZE), dtype=np.float64)
+        np.add.at(shot_sums, user_codes, encodings)
+    if isinstance(encodings, np.memmap):
+        encodings.flush()
+    count = len(face_ids) if count is None else count
+    sorted_rows = np.argsort(face_ids[:count], kind="stable")
+    np.save(_column_path(tmp_path, "sq_norms"), sq_norms)
+    np.save(_column_path(tmp_path, "face_ids"), face_ids)
+    np.save(_column_path(tmp_path, "sorted_face_ids"), face_ids[sorted_rows])
+    np.save(_column_path(tmp_path, "sorted_rows"), sorted_rows.astype(np.int64))
+    np.save(_column_path(tmp_path, "user_codes"), user_codes)
+    np.save(_column_path(tmp_path, "shot_sums"), shot_sums)
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({
+            "version": SNAPSHOT_VERSION,
+            "count": count,
+            "capacity": len(face_ids),
+            "high_water_mark": high_water_mark.isoformat(),
+            "built_at": datetime.datetime.now().isoformat(),
+            "users": users,
+        }, f)
+
+    # Swap directories so a reader never sees a half-written snapshot
+    old_path = f"{path}.old"
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def read(path=GALLERY_SNAPSHOT_PATH):
+    """Snapshot columns and metadata; every column is mapped, not read.
+
+    The sorted face id index is mapped read-only, the other columns
+    copy-on-write, so a process only holds private copies of the pages its
+    own changes touch.
+    """
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    if meta.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version {meta.get('version')}")
+    columns = {
+        # Copy-on-write so gallery updates never reach the file, and pages
+        # stay shared between processes mapping the same snapshot
+        "encodings": np.load(_column_path(path, "encodings"), mmap_mode="c"),
+        "shot_sums": np.load(_column_path(path, "shot_sums"), mmap_mode="c"),
+        "sq_norms": np.load(_column_path(path, "sq_norms"), mmap_mode="c"),
+        "user_codes": np.load(_column_path(path, "user_codes"), mmap_mode="c"),
+        "face_ids": np.load(_column_path(path, "face_ids"), mmap_mode="c"),
+        "sorted_face_ids": np.load(_column_path(path, "sorted_face_ids"), mmap_mode="r"),
+        "sorted_rows": np.load(_column_path(path, "sorted_rows"), mmap_mode="r"),
+    }
+    if any(len(columns[c]) != meta["capacity"] for c in COLUMNS if c != "shot_sums") \
+            or any(len(columns[c]) != meta["count"] for c in ("sorted_face_ids", "sorted_rows")):
+        raise ValueError("Snapshot columns do not match its row count")
+    return columns, meta
+
+
+def load(gallery, path=GALLERY_SNAPSHOT_PATH):
+    """Replace the gallery contents with a snapshot; returns its row count"""
+    columns, meta = read(path)
+    users = meta["users"]
+    gallery.replace_arrays(
+        columns["encodings"], columns["face_ids"], columns["user_codes"],
+        [user[0] for user in users], [user[1] for user in users],
+        count=meta["count"], sq_norms=columns["sq_norms"], shot_sums=columns["shot_sums"],
+        face_index=(columns["sorted_face_ids"], columns["sorted_rows"]),
+    )
+    gallery.loaded_at = datetime.datetime.fromisoformat(meta["high_water_mark"])
+    return meta["count"]
+
+
+def load_gallery(gallery, sync, path=GALLERY_SNAPSHOT_PATH):
+    """Load the gallery from a snapshot plus newer database rows, or fully from the database.
+
+    sync is the GallerySync whose catch-up query applies the rows and
+    tombstones written after the snapshot was taken.
+    """
+    if path and os.path.exists(os.path.join(path, "meta.json")):
+        try:
+            start = time.perf_counter()
+            count = load(gallery, path)
+            logger.info(f"Mapped gallery snapshot of {count} encodings in {time.perf_counter() - start:.2f}s")
+            sync.high_water_mark = gallery.loaded_at
+            with get_db_connection() as conn:
+                sync.catch_up(conn)
+            logger.info(f"Gallery caught up to {len(gallery)} encodings")
+            return "snapshot"
+        except Exception as e:
+            logger.warning(f"Could not load gallery snapshot from {path}, loading from the database: {e}")
+    gallery.load()
+    return "database"
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Build a memory-mapped gallery snapshot from user_faces")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("--path", default=GALLERY_SNAPSHOT_PATH)
+    args = parser.parse_args()
+    count = build(args.path)
+    print(f"Saved snapshot of {count} encodings to {args.path}")
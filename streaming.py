@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+from frames import receive_message
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class LatestFrameScheduler:
+    """Latest-frame-wins mailbox for one streaming WebSocket connection.
+
+    A reader task drains the socket as fast as the client sends and keeps
+    only the newest frame; the processing loop always picks up that frame
+    and the ones it replaced are counted as dropped. Memory is bounded to a
+    single pending frame and latency to roughly one processing time,
+    whatever the client's frame rate.
+    """
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.dropped_total = 0
+        self._dropped = 0
+        self._pending = None
+        self._ready = asyncio.Event()
+        self._closed = False
+        self._send_lock = asyncio.Lock()
+        self._reader = None
+
+    async def __aenter__(self):
+        self._reader = asyncio.create_task(self._read())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._reader.cancel()
+        try:
+            await self._reader
+        except (asyncio.CancelledError, Exception):
+            pass
+
+    async def _read(self):
+        try:
+            while True:
+                try:
+                    data = await receive_message(self.websocket)
+                except ValueError as e:
+                    await self.send_json({"type": "error", "message": f"Invalid message: {str(e)}"})
+                    continue
+                if self._pending is not None:
+                    self._dropped += 1
+                    self.dropped_total += 1
+                self._pending = (data, time.perf_counter())
+                self._ready.set()
+        except WebSocketDisconnect:
+            pass
+        except Exception as e:
+            logger.error(f"Error reading streaming frames: {e}")
+        finally:
+            self._closed = True
+            self._ready.set()
+
+    async def next_frame(self):
+        """(message, received_at, dropped_since_last) for the newest frame, or None once closed"""
+        while self._pending is None:
+            if self._closed:
+                return None
+            self._ready.clear()
+            await self._ready.wait()
+        data, received_at = self._pending
+        dropped = self._dropped
+        self._pending = None
+        self._dropped = 0
+        return data, received_at, dropped
+
+    async def send_json(self, message):
+        # The reader and the processing loop both send on the same socket
+        async with self._send_lock:
+            await self.websocket.send_json(message)
+
+    def stats(self, received_at, dropped):
+        """Per-response backpressure fields"""
+        return {
+            "dropped": dropped,
+            "dropped_total": self.dropped_total,
+            "latency_ms": round(1000 * (time.perf_counter() - received_at), 2),
+        }
@@ -0,0 +1,13 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import psycopg2
+
+# db.py connects on import, which most test modules pull in through gallery,
+# db_async or main; without a server they get the benchmark's offline pool,
+# so only the tests that really use the database fail
+try:
+    import db  # noqa: F401
+except psycopg2.OperationalError:
+    import benchmark
+    benchmark.import_db_offline()
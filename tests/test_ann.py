@@ -0,0 +1,56 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import numpy as np
+from gallery import FaceGallery
+from ann import IVFIndex, measure_recall
+
+def clustered_rows(people=200, shots=5, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(scale=0.1, size=(people, 128))
+    encodings = np.repeat(centers, shots, axis=0) + rng.normal(scale=0.02, size=(people * shots, 128))
+    rows = [(f"face-{i}", f"user-{i // shots}", f"name-{i // shots}", encodings[i].tobytes())
+            for i in range(len(encodings))]
+    return rows, encodings
+
+def make_gallery(nprobe):
+    rows, encodings = clustered_rows()
+    gallery = FaceGallery()
+    gallery.replace(rows)
+    with gallery.view() as (view, _):
+        index = IVFIndex.train(view, nlist=16, nprobe=nprobe)
+    gallery.attach_index(index)
+    return gallery, index, encodings
+
+def test_probing_every_list_matches_brute_force():
+    gallery, index, _ = make_gallery(nprobe=16)
+    assert measure_recall(gallery, index, queries=50)["recall"] == 1.0
+
+def test_index_follows_adds_and_removes():
+    gallery, index, encodings = make_gallery(nprobe=4)
+    gallery.remove([f"face-{i}" for i in range(0, 1000, 3)])
+    gallery.add("face-new", "user-new", "new", encodings[0])
+    assert sorted(row for members in index.lists for row in members) == list(range(len(gallery)))
+    for i in (1, 500, 998):
+        match = gallery.best_match(encodings[i])
+        assert match.user_id == f"user-{i // 5}"
+    assert gallery.best_match(encodings[0]).user_id == "user-new"
+
+def test_gallery_smaller_than_nlist_gets_one_list_per_encoding():
+    rows, encodings = clustered_rows(people=2, shots=5)
+    gallery = FaceGallery()
+    gallery.replace(rows)
+    with gallery.view() as (view, _):
+        index = IVFIndex.train(view, nlist=16, nprobe=16)
+    assert index.nlist == 10
+    gallery.attach_index(index)
+    assert measure_recall(gallery, index, queries=10)["recall"] == 1.0
+
+def test_save_and_load_reuses_assignments(tmp_path):
+    gallery, index, _ = make_gallery(nprobe=4)
+    path = str(tmp_path / "ivf.npz")
+    with gallery.view() as (_, face_ids):
+        index.save(path, face_ids.tolist())
+    loaded = IVFIndex.load(path)
+    gallery.attach_index(loaded)
+    assert [sorted(m) for m in loaded.lists] == [sorted(m) for m in index.lists]
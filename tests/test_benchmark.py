@@ -0,0 +1,60 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import asyncio
+import uuid
+import numpy as np
+import benchmark
+from benchmark import MemoryPool, compare, summarize
+from db_async import upsert_user, insert_faces, is_cancelled, mark_cancelled
+from gallery import FaceGallery
+
+def test_summarize_reports_percentiles_and_throughput():
+    result = summarize([0.01] * 99 + [0.1])
+    assert result["count"] == 100
+    assert result["p50_ms"] == 10.0 and result["max_ms"] == 100.0
+    assert abs(result["per_second"] - 100 / 1.09) < 0.01
+
+def test_compare_flags_only_slowdowns_beyond_tolerance():
+    baseline = {"results": [
+        {"name": "match/1000", "p50_ms": 1.0, "p95_ms": 2.0, "per_second": 1000.0},
+        {"name": "detect", "p50_ms": 50.0, "p95_ms": 60.0, "per_second": 20.0},
+        {"name": "ws_register", "skipped": "face_recognition is not installed"},
+    ]}
+    current = {"results": [
+        {"name": "match/1000", "p50_ms": 1.1, "p95_ms": 2.1, "per_second": 950.0},
+        {"name": "detect", "p50_ms": 80.0, "p95_ms": 60.0, "per_second": 12.0},
+        {"name": "ws_register", "p50_ms": 900.0, "p95_ms": 950.0, "per_second": 1.0},
+    ]}
+    regressions = compare(baseline, current, tolerance=0.2)
+    assert len(regressions) == 2
+    assert all(message.startswith("detect:") for message in regressions)
+
+def test_synthetic_gallery_matches_perturbed_rows():
+    gallery = FaceGallery()
+    benchmark.load_synthetic_gallery(gallery, 500)
+    assert len(gallery) == 500 and gallery.user_count == 100
+    with gallery.view() as (encodings, face_ids):
+        query = encodings[42] + 0.001
+        expected_user = 42 % 100
+    assert gallery.best_match(query).name == f"user-{expected_user}"
+
+def test_memory_pool_answers_the_registration_statements():
+    pool = MemoryPool()
+    registration_id = str(uuid.uuid4())
+
+    async def scenario():
+        conn = await pool.acquire()
+        async with conn.transaction():
+            user_id = await upsert_user(conn, "alice")
+            assert await upsert_user(conn, "alice") == user_id
+            face_ids = await insert_faces(conn, user_id, [np.zeros(128), np.ones(128)], registration_id)
+        assert not await is_cancelled(conn, registration_id)
+        await mark_cancelled(conn, registration_id)
+        assert await is_cancelled(conn, registration_id)
+        return face_ids
+
+    face_ids = asyncio.run(scenario())
+    rows = pool.tables["user_faces"]
+    assert [row[0] for row in rows] == face_ids
+    assert np.frombuffer(rows[1][2]).sum() == 128
@@ -0,0 +1,39 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import asyncio
+import cleanup
+from cleanup import CleanupScheduler
+
+def test_scheduler_records_runs_and_failures(monkeypatch):
+    results = [{"registrations": 3, "skipped": False}, RuntimeError("database down")]
+
+    def fake_run_cleanup(batch_size):
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return dict(result, batch_size=batch_size)
+
+    monkeypatch.setattr(cleanup, "run_cleanup", fake_run_cleanup)
+    scheduler = CleanupScheduler(interval=0, batch_size=50)
+
+    async def run():
+        await scheduler.run_once()
+        await scheduler.run_once()
+
+    asyncio.run(run())
+    stats = scheduler.stats()
+    assert stats["runs"] == 2 and stats["failures"] == 1
+    assert stats["last_error"] == "database down"
+    # The last successful run's metrics are kept
+    assert stats["last_run"] == {"registrations": 3, "skipped": False, "batch_size": 50}
+
+def test_scheduler_with_zero_interval_does_not_start():
+    async def run():
+        scheduler = CleanupScheduler(interval=0)
+        scheduler.start()
+        started = scheduler._task is not None
+        await scheduler.stop()
+        return started
+
+    assert not asyncio.run(run())
@@ -0,0 +1,61 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import asyncio
+import pytest
+from db_async import AsyncDatabase, PoolTimeout
+
+class FakePool:
+    def __init__(self, size):
+        self._free = asyncio.Queue()
+        for i in range(size):
+            self._free.put_nowait(f"conn-{i}")
+        self.size = size
+
+    async def acquire(self, timeout=None):
+        return await asyncio.wait_for(self._free.get(), timeout)
+
+    async def release(self, conn):
+        self._free.put_nowait(conn)
+
+    def get_size(self):
+        return self.size
+
+    def get_idle_size(self):
+        return self._free.qsize()
+
+def test_acquire_times_out_when_pool_is_exhausted():
+    async def run():
+        database = AsyncDatabase(min_size=1, max_size=1, acquire_timeout=0.05)
+        database.pool = FakePool(1)
+        async with database.connection() as conn:
+            assert conn == "conn-0"
+            assert database.stats()["idle"] == 0
+            with pytest.raises(PoolTimeout):
+                async with database.connection():
+                    pass
+        # The connection went back to the pool
+        async with database.connection() as conn:
+            assert conn == "conn-0"
+        return database.stats()
+
+    stats = asyncio.run(run())
+    assert stats["acquisitions"] == 2
+    assert stats["timeouts"] == 1
+    assert stats["waiting"] == 0 and stats["idle"] == 1
+
+def test_waiters_record_wait_time():
+    async def run():
+        database = AsyncDatabase(min_size=1, max_size=1, acquire_timeout=1)
+        database.pool = FakePool(1)
+
+        async def hold():
+            async with database.connection():
+                await asyncio.sleep(0.05)
+
+        await asyncio.gather(hold(), hold())
+        return database.stats()
+
+    stats = asyncio.run(run())
+    assert stats["acquisitions"] == 2
+    assert stats["wait_ms_max"] >= 40
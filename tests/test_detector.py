@@ -0,0 +1,35 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import cv2
+import threading
+import detector
+
+def load_image(filename):
+    return cv2.imread(os.path.join(os.path.dirname(__file__), "images", filename))
+
+def test_downscaled_boxes_map_back_to_original_coordinates():
+    image = load_image("multi_face.png")
+    native = detector.detect_faces(image, working_size=0)
+    upscaled = cv2.resize(image, None, fx=4, fy=4, interpolation=cv2.INTER_CUBIC)
+    mapped = detector.detect_faces(upscaled, working_size=max(image.shape[:2]))
+    assert len(mapped) == len(native) > 1
+    for box in mapped:
+        # Every box lands on a face found at native resolution, scaled by 4
+        assert any(abs(box["x"] - 4 * face["x"]) <= 8 and abs(box["width"] - 4 * face["width"]) <= 8
+                   for face in native)
+
+def test_each_thread_gets_its_own_cascade():
+    haar = detector.get_detector("haar")
+    assert detector.get_detector("haar") is haar
+    models = []
+    threads = [threading.Thread(target=lambda: models.append(haar._model())) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert models[0] is not models[1]
+    assert haar._model() is haar._model()
+
+def test_no_face_image_has_no_detections():
+    assert detector.detect_faces(load_image("no_face.jpg")) == []
@@ -0,0 +1,149 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import asyncio
+import numpy as np
+import pytest
+import encoding_cache
+from encoding_cache import EncodingCache, ENTRY_OVERHEAD
+
+def result(faces=1):
+    return [(0, 10, 10, 0)] * faces, [np.zeros(128) for _ in range(faces)]
+
+def test_repeated_image_is_computed_once():
+    cache = EncodingCache(max_bytes=1 << 20, ttl=60)
+    calls = []
+
+    async def compute(image_bytes):
+        calls.append(image_bytes)
+        return result()
+
+    async def run():
+        first = await cache.get_or_compute(b"image", compute)
+        second = await cache.get_or_compute(memoryview(b"image"), compute)
+        await cache.get_or_compute(b"other", compute)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert second is first
+    assert len(calls) == 2
+    stats = cache.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 2 and stats["entries"] == 2
+
+def test_concurrent_requests_share_one_computation():
+    cache = EncodingCache(max_bytes=1 << 20, ttl=60)
+    calls = []
+
+    async def compute(image_bytes):
+        calls.append(image_bytes)
+        await asyncio.sleep(0.01)
+        return result()
+
+    async def run():
+        return await asyncio.gather(*(cache.get_or_compute(b"image", compute) for _ in range(5)))
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(r is results[0] for r in results)
+
+def test_cancelled_owner_does_not_fail_other_waiters():
+    cache = EncodingCache(max_bytes=1 << 20, ttl=60)
+    calls = []
+
+    async def compute(image_bytes):
+        calls.append(image_bytes)
+        await asyncio.sleep(0.05)
+        return result()
+
+    async def run():
+        owner = asyncio.create_task(cache.get_or_compute(b"image", compute))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(cache.get_or_compute(b"image", compute))
+        await asyncio.sleep(0.01)
+        # The client that started the encoding disconnects
+        owner.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await owner
+        return await waiter
+
+    locations, encodings = asyncio.run(run())
+    assert len(calls) == 2 and len(encodings) == 1
+
+def test_cancelled_waiter_leaves_the_computation_running():
+    cache = EncodingCache(max_bytes=1 << 20, ttl=60)
+
+    async def compute(image_bytes):
+        await asyncio.sleep(0.02)
+        return result()
+
+    async def run():
+        owner = asyncio.create_task(cache.get_or_compute(b"image", compute))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(cache.get_or_compute(b"image", compute))
+        await asyncio.sleep(0.005)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        return await owner
+
+    assert asyncio.run(run()) is not None
+    assert cache.stats()["entries"] == 1
+
+def test_evicts_least_recently_used_within_byte_budget():
+    entry = ENTRY_OVERHEAD + 128 * 8 + 32
+    cache = EncodingCache(max_bytes=2 * entry, ttl=60)
+    cache.put(b"a", result())
+    cache.put(b"b", result())
+    assert cache.get(b"a") is not None
+    cache.put(b"c", result())
+    assert cache.get(b"b") is None
+    assert cache.get(b"a") is not None and cache.get(b"c") is not None
+    assert cache.bytes <= cache.max_bytes
+    assert cache.evictions == 1
+
+def test_oversized_entry_is_not_cached():
+    cache = EncodingCache(max_bytes=ENTRY_OVERHEAD, ttl=60)
+    cache.put(b"a", result())
+    assert len(cache) == 0 and cache.bytes == 0
+
+def test_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(encoding_cache.time, "monotonic", lambda: now[0])
+    cache = EncodingCache(max_bytes=1 << 20, ttl=5)
+    cache.put(b"a", result())
+    now[0] += 4
+    assert cache.get(b"a") is not None
+    now[0] += 2
+    assert cache.get(b"a") is None
+    assert cache.expirations == 1 and cache.bytes == 0
+
+def test_failures_are_not_cached():
+    cache = EncodingCache(max_bytes=1 << 20, ttl=60)
+
+    async def fail(image_bytes):
+        raise ValueError("bad image")
+
+    async def run():
+        for _ in range(2):
+            try:
+                await cache.get_or_compute(b"image", fail)
+            except ValueError:
+                pass
+
+    asyncio.run(run())
+    assert cache.misses == 2 and len(cache) == 0
+
+def test_disabled_cache_always_computes():
+    cache = EncodingCache(max_bytes=0, ttl=60)
+    calls = []
+
+    async def compute(image_bytes):
+        calls.append(image_bytes)
+        return result()
+
+    async def run():
+        await cache.get_or_compute(b"image", compute)
+        await cache.get_or_compute(b"image", compute)
+
+    asyncio.run(run())
+    assert len(calls) == 2 and len(cache) == 0
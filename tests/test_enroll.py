@@ -0,0 +1,117 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import csv
+import io
+import json
+import zipfile
+from contextlib import contextmanager
+import numpy as np
+import pytest
+import compute
+import db
+import enroll
+
+class FakeCursor:
+    def __init__(self, store):
+        self.store = store
+        self.result = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params):
+        if query.startswith("INSERT INTO users"):
+            self.store["users"].update(params[0])
+            self.result = []
+        elif query.startswith("SELECT name, id"):
+            self.result = [(name, f"user-{name}") for name in params[0]]
+        else:
+            self.result = [(r,) for r in params[0] if r in self.store["registrations"]]
+
+    def fetchall(self):
+        return self.result
+
+    def copy_expert(self, query, rows):
+        for user_id, encoding, registration_id in csv.reader(io.StringIO(rows.read())):
+            self.store["faces"].append((user_id, encoding, registration_id))
+            self.store["registrations"].add(registration_id)
+
+class FakeConnection:
+    def __init__(self, store):
+        self.store = store
+
+    def cursor(self):
+        return FakeCursor(self.store)
+
+    def commit(self):
+        self.store["commits"] += 1
+
+@pytest.fixture
+def store(monkeypatch):
+    store = {"users": set(), "faces": [], "registrations": set(), "commits": 0}
+
+    @contextmanager
+    def fake_connection():
+        yield FakeConnection(store)
+
+    def fake_encode(image_bytes, boxes=None):
+        # The test images' contents say how many faces they show
+        faces = int(image_bytes.split(b":")[1])
+        return [None] * faces, [np.full(128, faces / 10)] * faces
+
+    monkeypatch.setattr(db, "get_db_connection", fake_connection)
+    monkeypatch.setattr(compute, "load_models", lambda: None)
+    monkeypatch.setattr(compute, "face_locations_and_encodings_from_bytes", fake_encode)
+    return store
+
+PHOTOS = {
+    "alice/1.jpg": b"alice-1:1",
+    "alice/2.jpg": b"alice-2:1",
+    "alice/group.jpg": b"group:3",
+    "bob.png": b"bob:1",
+    "carol/empty.jpg": b"empty:0",
+    "notes.txt": b"not a photo",
+}
+
+def write_photos(root):
+    for path, contents in PHOTOS.items():
+        os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+        with open(os.path.join(root, path), "wb") as f:
+            f.write(contents)
+
+def test_person_name():
+    assert enroll.person_name("alice/1.jpg") == "alice"
+    assert enroll.person_name("site/alice/1.jpg") == "alice"
+    assert enroll.person_name("bob.png") == "bob"
+
+def test_enrolls_single_face_photos_and_resumes(tmp_path, store):
+    write_photos(tmp_path / "photos")
+    state = str(tmp_path / "state.jsonl")
+    report = enroll.enroll(str(tmp_path / "photos"), state, batch_size=2, workers=0)
+
+    assert report["photos"] == 5 and report["enrolled"] == 3 and report["people"] == 2
+    assert report["rejected"] == {compute.single_face_error([None] * 3): 1, compute.single_face_error([]): 1}
+    assert store["users"] == {"alice", "bob"}
+    assert sorted(user_id for user_id, _, _ in store["faces"]) == ["user-alice", "user-alice", "user-bob"]
+    encoding = store["faces"][0][1]
+    assert np.array_equal(np.frombuffer(bytes.fromhex(encoding[2:])), np.full(128, 0.1))
+    with open(state) as f:
+        assert len([json.loads(line) for line in f]) == 5
+
+    again = enroll.enroll(str(tmp_path / "photos"), state, workers=0)
+    assert again["skipped"] == 5 and again["encoded"] == 0
+    assert len(store["faces"]) == 3
+
+def test_stored_photos_are_not_duplicated_without_state(tmp_path, store):
+    archive = tmp_path / "photos.zip"
+    with zipfile.ZipFile(archive, "w") as zf:
+        for path, contents in PHOTOS.items():
+            zf.writestr(path, contents)
+    enroll.enroll(str(archive), workers=0)
+    report = enroll.enroll(str(archive), workers=0)
+    assert report["enrolled"] == 0 and report["already_stored"] == 3
+    assert len(store["faces"]) == 3
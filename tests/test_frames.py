@@ -0,0 +1,25 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import base64
+import pytest
+from frames import FrameError, pack_frame, parse_frame, image_bytes_of
+
+def test_frame_round_trip_keeps_payload_without_copy():
+    data = pack_frame(b"\xff\xd8jpeg-bytes", seq=42)
+    message = parse_frame(data)
+    assert message["type"] == "image"
+    assert message["seq"] == 42
+    assert isinstance(message["image_bytes"], memoryview)
+    assert message["image_bytes"].obj is data
+    assert image_bytes_of(message) == b"\xff\xd8jpeg-bytes"
+
+def test_json_messages_still_carry_base64_images():
+    message = {"type": "image", "image": base64.b64encode(b"png-bytes").decode()}
+    assert image_bytes_of(message) == b"png-bytes"
+    assert image_bytes_of({"type": "image"}) is None
+
+@pytest.mark.parametrize("data", [b"\x01\x01\x00", b"\x02\x01\x00\x00\x00\x01x", b"\x01\x09\x00\x00\x00\x01x"])
+def test_malformed_frames_are_rejected(data):
+    with pytest.raises(FrameError):
+        parse_frame(data)
@@ -0,0 +1,126 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import numpy as np
+import pytest
+import gallery as gallery_module
+from gallery import FaceGallery, exact_distances
+
+def make_rows(count, seed=0):
+    rng = np.random.default_rng(seed)
+    encodings = rng.normal(scale=0.1, size=(count, 128))
+    rows = [
+        (f"face-{i}", f"user-{i % 7}", f"name-{i % 7}", encodings[i].tobytes())
+        for i in range(count)
+    ]
+    return rows, encodings
+
+def test_best_match_agrees_with_per_row_loop():
+    rows, encodings = make_rows(500)
+    gallery = FaceGallery()
+    gallery.replace(rows)
+    query = encodings[123] + 0.01
+
+    # Reference: the original per-row loop
+    distances = [exact_distances(encodings[i:i + 1], query)[0] for i in range(len(rows))]
+    best = int(np.argmin(distances))
+
+    match = gallery.best_match(query)
+    assert match.user_id == rows[best][1]
+    assert match.name == rows[best][2]
+    assert match.distance == pytest.approx(distances[best])
+    assert np.allclose(gallery.distances(query), distances)
+
+def test_add_grows_and_ignores_duplicates():
+    rows, encodings = make_rows(3)
+    gallery = FaceGallery(initial_capacity=2)
+    gallery.replace(rows[:1])
+    for face_id, user_id, name, encoding_bytes in rows[1:]:
+        assert gallery.add(face_id, user_id, name, np.frombuffer(encoding_bytes))
+    assert not gallery.add(rows[0][0], rows[0][1], rows[0][2], encodings[0])
+    assert len(gallery) == 3
+    assert "face-2" in gallery
+    assert gallery.best_match(encodings[2]).distance == pytest.approx(0.0)
+
+def test_empty_gallery_has_no_match():
+    gallery = FaceGallery()
+    assert gallery.best_match(np.zeros(128)) is None
+
+def test_remove_swaps_last_row_into_gap():
+    rows, encodings = make_rows(5)
+    gallery = FaceGallery()
+    gallery.replace(rows)
+    assert gallery.remove(["face-1", "face-4", "missing"]) == 2
+    assert len(gallery) == 3
+    assert "face-1" not in gallery and "face-4" not in gallery
+    # Remaining rows are still matched exactly, including the one that moved
+    for i in (0, 2, 3):
+        match = gallery.best_match(encodings[i])
+        assert match.user_id == rows[i][1]
+        assert match.distance == pytest.approx(0.0)
+    assert gallery.best_match(encodings[1]).distance > 0
+
+def test_best_matches_agrees_with_best_match():
+    rows, encodings = make_rows(300)
+    gallery = FaceGallery()
+    gallery.replace(rows)
+    queries = encodings[[5, 77, 250]] + 0.01
+    matches = gallery.best_matches(queries)
+    for query, match in zip(queries, matches):
+        expected = gallery.best_match(query)
+        assert match.user_id == expected.user_id
+        assert match.distance == pytest.approx(expected.distance)
+    assert FaceGallery().best_matches(queries) == [None, None, None]
+
+def test_top_k_returns_nearest_users_in_order(monkeypatch):
+    # Several query blocks, so the per-block results are stitched together
+    monkeypatch.setattr(gallery_module, "MATCH_BLOCK_ELEMENTS", 400)
+    rows, encodings = make_rows(200)
+    rows = [(face_id, face_id, face_id, encoding) for face_id, _, _, encoding in rows]
+    gallery = FaceGallery()
+    gallery.replace(rows)
+    queries = encodings[[3, 150, 7]] + 0.01
+    for query, matches in zip(queries, gallery.top_k(queries, 5)):
+        expected = np.sort(exact_distances(encodings, query))[:5]
+        assert [match.distance for match in matches] == pytest.approx(expected.tolist())
+    assert len(gallery.top_k(queries[:1], 500)[0]) == 200
+
+def shots_gallery():
+    # Two users with three shots each, plus a query close to one of "b"'s shots
+    # but nearer to "a" on average
+    a = np.zeros((3, 128))
+    a[:, 0] = [0.30, 0.31, 0.32]
+    b = np.zeros((3, 128))
+    b[:, 0] = [-0.25, 1.0, 1.1]
+    rows = [(f"a{i}", "user-a", "a", a[i].tobytes()) for i in range(3)]
+    rows += [(f"b{i}", "user-b", "b", b[i].tobytes()) for i in range(3)]
+    gallery = FaceGallery()
+    gallery.replace(rows)
+    return gallery, np.zeros(128)
+
+def test_min_strategy_uses_closest_shot():
+    gallery, query = shots_gallery()
+    match = gallery.best_match(query, strategy="min")
+    assert (match.user_id, match.distance) == ("user-b", pytest.approx(0.25))
+
+def test_mean_knn_and_centroid_strategies_use_all_shots(monkeypatch):
+    monkeypatch.setattr(gallery_module, "MATCH_STRATEGY_K", 2)
+    gallery, query = shots_gallery()
+    match = gallery.best_match(query, strategy="mean_knn")
+    assert (match.user_id, match.distance) == ("user-a", pytest.approx(0.305))
+    ranked = gallery.top_k([query], 2, strategy="centroid")[0]
+    assert [m.user_id for m in ranked] == ["user-a", "user-b"]
+    assert ranked[1].distance == pytest.approx((1.0 + 1.1 - 0.25) / 3)
+
+def test_vote_strategy_counts_nearest_rows(monkeypatch):
+    monkeypatch.setattr(gallery_module, "MATCH_STRATEGY_K", 4)
+    gallery, query = shots_gallery()
+    match = gallery.best_match(query, strategy="vote")
+    assert (match.user_id, match.votes) == ("user-a", 3)
+    assert match.distance == pytest.approx(0.30)
+
+def test_centroids_follow_removals():
+    gallery, query = shots_gallery()
+    gallery.remove(["b1", "b2"])
+    assert gallery.best_match(query, strategy="centroid").user_id == "user-b"
+    assert gallery.user_count == 2
@@ -1,9 +1,13 @@
 import sys
 import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import io
+import json
+import zipfile
 import pytest
 from fastapi.testclient import TestClient
 from main import app
+import api
 
 client = TestClient(app)
 
@@ -71,6 +75,118 @@ def test_recognize_one_face():
     assert "matches" in data
     assert any(match["name"] == "one_face" for match in data["matches"])
 
+@pytest.fixture(scope="module")
+def live_client():
+    # Runs the lifespan (database pool, gallery and compute pools) and
+    # registers one_face.jpg, so recognition tests have a face to match
+    with TestClient(app) as live:
+        registered = live.post(
+            "/api/v1/register",
+            headers={"X-API-Key": API_KEY},
+            data={"name": "one_face"},
+            files={"file": ("one_face.jpg", load_image_bytes("one_face.jpg"), "image/jpeg")}
+        )
+        assert "registration_id" in registered.json()
+        yield live
+
+def test_recognize_batch(live_client):
+    response = live_client.post(
+        "/api/v1/recognize/batch",
+        headers={"X-API-Key": API_KEY},
+        files=[
+            ("files", ("one_face.jpg", load_image_bytes("one_face.jpg"), "image/jpeg")),
+            ("files", ("no_face.jpg", load_image_bytes("no_face.jpg"), "image/jpeg")),
+        ]
+    )
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["filename"] for result in results] == ["one_face.jpg", "no_face.jpg"]
+    assert any(match["name"] == "one_face" for match in results[0]["matches"])
+    assert "No face detected" in results[1]["error"]
+
+def zip_of(entries):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, data in entries:
+            zf.writestr(name, data)
+    return archive.getvalue()
+
+def test_recognize_batch_checks_zip_limits_before_extracting(monkeypatch):
+    monkeypatch.setattr(api, "MAX_BATCH_IMAGES", 3)
+    monkeypatch.setattr(api, "MAX_BATCH_BYTES", 1_000_000)
+    extracted = []
+    monkeypatch.setattr(zipfile.ZipFile, "read", lambda self, entry: extracted.append(entry))
+    too_many = zip_of([(f"{i}.jpg", b"x") for i in range(4)])
+    bomb = zip_of([("bomb.jpg", bytes(50_000_000))])
+    for archive, status_code in ((too_many, 400), (bomb, 413)):
+        response = client.post(
+            "/api/v1/recognize/batch",
+            headers={"X-API-Key": API_KEY},
+            files=[("files", ("batch.zip", archive, "application/zip"))]
+        )
+        assert response.status_code == status_code
+    assert extracted == []
+
+def test_recognize_multi_face_mode(live_client):
+    response = live_client.post(
+        "/api/v1/recognize?mode=multi&top_k=3",
+        headers={"X-API-Key": API_KEY},
+        files={"file": ("multi_face.png", load_image_bytes("multi_face.png"), "image/png")}
+    )
+    assert response.status_code == 200
+    faces = response.json()["faces"]
+    assert len(faces) > 1
+    for face in faces:
+        assert set(face["box"]) == {"x", "y", "width", "height"}
+        distances = [candidate["distance"] for candidate in face["candidates"]]
+        assert distances == sorted(distances) and 1 <= len(distances) <= 3
+
+def test_recognize_with_boxes_from_detect(live_client):
+    image_bytes = load_image_bytes("one_face.jpg")
+    detected = live_client.post("/detect", files={"file": ("one_face.jpg", image_bytes, "image/jpeg")})
+    faces = detected.json()["faces"]
+    assert len(faces) == 1
+    response = live_client.post(
+        "/api/v1/recognize",
+        headers={"X-API-Key": API_KEY},
+        data={"boxes": json.dumps(faces)},
+        files={"file": ("one_face.jpg", image_bytes, "image/jpeg")}
+    )
+    assert response.status_code == 200
+    assert any(match["name"] == "one_face" for match in response.json()["matches"])
+
+def test_recognize_rejects_malformed_boxes():
+    response = client.post(
+        "/api/v1/recognize",
+        headers={"X-API-Key": API_KEY},
+        data={"boxes": "[{\"x\": 1}]"},
+        files={"file": ("one_face.jpg", load_image_bytes("one_face.jpg"), "image/jpeg")}
+    )
+    assert response.status_code == 400
+    assert "Invalid boxes" in response.json()["detail"]
+
+def test_ws_register_survives_malformed_base64():
+    with client.websocket_connect("/ws/register") as websocket:
+        websocket.send_json({"type": "image", "image": "not-base64!"})
+        assert websocket.receive_json()["type"] == "error"
+        # The session is still open and answers the next message
+        websocket.send_json({"type": "image"})
+        assert websocket.receive_json()["message"] == "No image data received."
+
+def test_ws_detect_survives_malformed_base64():
+    with client.websocket_connect("/ws/detect") as websocket:
+        websocket.send_json({"image": "not-base64!", "seq": 1})
+        assert websocket.receive_json()["type"] == "error"
+        websocket.send_json({"seq": 2})
+        assert websocket.receive_json()["message"] == "No image data received."
+
+def test_ws_recognize_survives_malformed_base64():
+    with client.websocket_connect("/ws/recognize") as websocket:
+        websocket.send_json({"image": "not-base64!", "seq": 1})
+        assert websocket.receive_json()["type"] == "error"
+        websocket.send_json({"seq": 2})
+        assert websocket.receive_json()["message"] == "No image data received."
+
 # Placeholder for future tests
 def test_recognize_placeholder():
     assert True
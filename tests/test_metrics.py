@@ -0,0 +1,56 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import time
+import metrics
+from metrics import Registry
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    histogram = registry.histogram("test_seconds", "Test latency", ["stage"], buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe(value, stage="decode")
+    cumulative, total, count = histogram.snapshot()[("decode",)]
+    assert cumulative == [1, 3, 4]
+    assert count == 4 and abs(total - 6.05) < 1e-9
+
+def test_render_uses_prometheus_text_format():
+    registry = Registry()
+    registry.histogram("test_seconds", "Test latency", ["stage"], buckets=(0.1,)).observe(0.05, stage="match")
+    registry.gauge("test_connections", "Pool connections", lambda: {"idle": 2, "used": 1}, ["state"])
+    registry.gauge("test_size", "Gallery size", lambda: 42)
+    lines = registry.render().splitlines()
+    assert "# TYPE test_seconds histogram" in lines
+    assert 'test_seconds_bucket{stage="match",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{stage="match",le="+Inf"} 1' in lines
+    assert 'test_seconds_count{stage="match"} 1' in lines
+    assert 'test_connections{state="idle"} 2' in lines
+    assert "test_size 42" in lines
+
+def test_failing_gauge_is_skipped():
+    registry = Registry()
+
+    def not_started():
+        raise RuntimeError("pool not started")
+
+    registry.gauge("test_broken", "Broken", not_started)
+    registry.gauge("test_size", "Gallery size", lambda: 1)
+    text = registry.render()
+    assert "test_broken" not in text and "test_size 1" in text
+
+def test_worker_stages_are_collected_for_the_parent():
+    def work(x):
+        with metrics.stage("decode"):
+            time.sleep(0.01)
+        with metrics.stage("encode"):
+            pass
+        return x * 2
+
+    result, stages, ran = metrics.run_collecting(work, 21)
+    assert result == 42
+    assert [name for name, _ in stages] == ["decode", "encode"]
+    assert stages[0][1] >= 0.01 and ran >= stages[0][1]
+
+    before = metrics.STAGE_SECONDS.snapshot().get(("decode",), ([], 0.0, 0))[2]
+    metrics.record_stages(stages)
+    assert metrics.STAGE_SECONDS.snapshot()[("decode",)][2] == before + 1
@@ -0,0 +1,74 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import io
+import types
+import numpy as np
+import pytest
+from PIL import Image
+from preprocess import load_image, ImageDecodeError
+import compute
+from compute import detect_faces_from_bytes
+
+IMAGES = os.path.join(os.path.dirname(__file__), "images")
+
+def jpeg_bytes(image, **save_args):
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90, **save_args)
+    return buffer.getvalue()
+
+def test_large_jpeg_is_capped_and_locations_map_back():
+    image = Image.new("RGB", (4000, 3000), (120, 130, 140))
+    prepared = load_image(jpeg_bytes(image), max_side=1000)
+    assert prepared.rgb.shape == (750, 1000, 3)
+    assert prepared.original_size == (4000, 3000)
+    assert prepared.scale == pytest.approx(0.25)
+    assert prepared.location_to_original((10, 40, 30, 20)) == (40, 160, 120, 80)
+    assert prepared.box_to_original({"x": 5, "y": 6, "width": 7, "height": 8, "track_id": 1}) == \
+        {"x": 20, "y": 24, "width": 28, "height": 32, "track_id": 1}
+
+def test_small_images_keep_full_resolution():
+    prepared = load_image(jpeg_bytes(Image.new("RGB", (320, 240))), max_side=1000)
+    assert prepared.rgb.shape == (240, 320, 3) and prepared.scale == 1.0
+
+def test_exif_orientation_is_applied():
+    image = Image.new("RGB", (400, 200), (255, 0, 0))
+    image.paste((0, 0, 255), (0, 0, 100, 200))  # blue left quarter
+    exif = Image.Exif()
+    exif[0x0112] = 6  # rotate 90 degrees clockwise to display
+    prepared = load_image(jpeg_bytes(image, exif=exif), max_side=0)
+    assert prepared.rgb.shape == (400, 200, 3)
+    assert prepared.original_size == (200, 400)
+    # The blue quarter ends up at the top after rotation
+    assert prepared.rgb[20, 100, 2] > 200 and prepared.rgb[380, 100, 0] > 200
+
+def test_undecodable_bytes_raise():
+    with pytest.raises(ImageDecodeError):
+        load_image(b"not an image")
+
+def test_detection_boxes_are_in_original_coordinates():
+    small = Image.open(os.path.join(IMAGES, "multi_face.png")).convert("RGB")
+    large = small.resize((small.width * 4, small.height * 4), Image.BICUBIC)
+    small_faces = detect_faces_from_bytes(jpeg_bytes(small))
+    large_faces = detect_faces_from_bytes(jpeg_bytes(large))
+    assert len(large_faces) == len(small_faces) > 0
+    small_centers = sorted((f["x"] + f["width"] / 2, f["y"] + f["height"] / 2) for f in small_faces)
+    large_centers = sorted(((f["x"] + f["width"] / 2) / 4, (f["y"] + f["height"] / 2) / 4) for f in large_faces)
+    np.testing.assert_allclose(large_centers, small_centers, atol=6)
+    assert detect_faces_from_bytes(b"garbage") is None
+
+def test_tracked_boxes_are_refined_before_encoding(monkeypatch):
+    # HOG confirms the first box with a tighter location and misses the second
+    refined = {(10, 10, 40, 40): [(14, 46, 46, 16)], (100, 10, 40, 40): []}
+    monkeypatch.setattr(compute, "refine_face_locations", lambda rgb, boxes: refined[boxes[0]])
+    encoded = []
+
+    def face_encodings(rgb, known_face_locations):
+        encoded.extend(known_face_locations)
+        return [np.ones(128) for _ in known_face_locations]
+
+    monkeypatch.setitem(sys.modules, "face_recognition", types.SimpleNamespace(face_encodings=face_encodings))
+    image = jpeg_bytes(Image.new("RGB", (200, 100)))
+    encodings = compute.face_encodings_at_from_bytes(image, [(10, 10, 40, 40), (100, 10, 40, 40)])
+    assert encoded == [(14, 46, 46, 16)]
+    assert encodings[0] is not None and encodings[1] is None
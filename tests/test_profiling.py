@@ -0,0 +1,97 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import time
+import pytest
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi.testclient import TestClient
+import profiling
+from compute import ComputeExecutor
+
+executor = ComputeExecutor("profiled", "thread", 1)
+
+def busy_work(n):
+    return sum(i * i for i in range(n))
+
+def make_app():
+    app = FastAPI()
+    app.add_middleware(profiling.ProfilingMiddleware)
+    app.include_router(profiling.router, prefix="/admin")
+
+    @app.get("/work")
+    async def work():
+        return {"total": await executor.run(busy_work, 10000)}
+
+    @app.websocket("/ws/work")
+    async def ws_work(websocket: WebSocket):
+        await websocket.accept()
+        await websocket.receive_text()
+        await websocket.send_json({"total": await executor.run(busy_work, 10000)})
+        await websocket.close()
+
+    @app.websocket("/ws/echo")
+    async def ws_echo(websocket: WebSocket):
+        await websocket.accept()
+        while True:
+            try:
+                await websocket.send_text(await websocket.receive_text())
+            except WebSocketDisconnect:
+                return
+
+    return app
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(profiling, "ADMIN_API_KEY", "admin-secret")
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE_RATE", 0.0)
+    monkeypatch.setattr(profiling, "profiles", profiling.ProfileStore())
+    yield TestClient(make_app())
+    executor.shutdown()
+
+def test_only_authenticated_requests_are_profiled(client):
+    assert "x-profile-id" not in client.get("/work").headers
+    assert "x-profile-id" not in client.get("/work", headers={"X-Profile": "wrong"}).headers
+    response = client.get("/work", headers={"X-Profile": "admin-secret"})
+    profile_id = response.headers["x-profile-id"]
+
+    listing = client.get("/admin/profiles", headers={"X-Admin-Key": "admin-secret"}).json()
+    assert [p["id"] for p in listing["profiles"]] == [profile_id]
+    assert listing["profiles"][0]["worker_jobs"] == 1
+
+    report = client.get(f"/admin/profiles/{profile_id}", headers={"X-Admin-Key": "admin-secret"})
+    # Work done on the compute pool shows up in the request's report
+    assert "busy_work" in report.text
+
+def test_admin_endpoints_require_the_admin_key(client):
+    assert client.get("/admin/profiles", headers={"X-Admin-Key": "nope"}).status_code == 401
+    assert client.get("/admin/profiles/missing", headers={"X-Admin-Key": "admin-secret"}).status_code == 404
+
+def test_sampled_websocket_sessions_are_profiled(client, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE_RATE", 1.0)
+    with client.websocket_connect("/ws/work") as websocket:
+        websocket.send_text("go")
+        assert websocket.receive_json()["total"] > 0
+    summary, = profiling.profiles.summaries()
+    assert (summary["kind"], summary["path"], summary["trigger"]) == ("websocket", "/ws/work", "sample")
+    assert summary["worker_jobs"] == 1
+
+def test_long_websocket_sessions_are_profiled_only_for_their_first_messages(client, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(profiling, "PROFILE_WS_MAX_MESSAGES", 2)
+    with client.websocket_connect("/ws/echo") as websocket:
+        for text in ("a", "b", "c"):
+            websocket.send_text(text)
+            assert websocket.receive_text() == text
+        # Stored while the session is still open
+        summary, = profiling.profiles.summaries()
+        assert summary["messages"] == 2 and profiling.profiles.active is None
+
+def test_quiet_websocket_sessions_stop_being_profiled(client, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(profiling, "PROFILE_WS_MAX_SECONDS", 0.05)
+    with client.websocket_connect("/ws/echo") as websocket:
+        websocket.send_text("a")
+        assert websocket.receive_text() == "a"
+        time.sleep(0.2)
+        summary, = profiling.profiles.summaries()
+        assert summary["messages"] == 1
@@ -0,0 +1,86 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import asyncio
+import threading
+import time
+import pytest
+import compute
+import readiness as readiness_module
+from compute import ComputeExecutor
+from readiness import Readiness
+
+class FakeDatabase:
+    def __init__(self, delay=0.0, error=None):
+        self.delay = delay
+        self.error = error
+
+    async def ping(self):
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return 1.5
+
+class FakeGallery:
+    def __init__(self, loaded, size=0):
+        self.loaded = loaded
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+def test_ready_only_when_every_check_passes(monkeypatch):
+    async def warm_up():
+        return [{"pid": 1, "load_ms": 10.0, "warmup_ms": 5.0}]
+
+    monkeypatch.setattr(compute, "warm_up", warm_up)
+    state = Readiness()
+
+    async def scenario():
+        cold, report = await state.check(FakeDatabase(), FakeGallery(True, 3))
+        assert not cold and not report["checks"]["models"]["ok"]
+        state.start_warm_up()
+        await state._warm_up_task
+        ready, report = await state.check(FakeDatabase(), FakeGallery(True, 3))
+        assert ready
+        assert report["checks"]["gallery"]["encodings"] == 3
+        assert "models" in report["startup_ms"]
+        not_loaded, _ = await state.check(FakeDatabase(), FakeGallery(False))
+        assert not not_loaded
+
+    asyncio.run(scenario())
+
+def test_unreachable_database_is_not_ready(monkeypatch):
+    monkeypatch.setattr(readiness_module, "READY_DB_TIMEOUT", 0.05)
+    state = Readiness()
+    state.models_ready = True
+
+    async def scenario():
+        slow, report = await state.check(FakeDatabase(delay=1), FakeGallery(True))
+        assert not slow and report["checks"]["database"]["error"] == "TimeoutError"
+        failed, report = await state.check(FakeDatabase(error=ConnectionError("refused")), FakeGallery(True))
+        assert not failed and report["checks"]["database"]["error"] == "refused"
+
+    asyncio.run(scenario())
+
+def test_failed_step_is_recorded():
+    state = Readiness()
+    with pytest.raises(RuntimeError):
+        with state.step("gallery"):
+            raise RuntimeError("no snapshot")
+    assert state.errors == {"gallery": "no snapshot"}
+    assert "gallery" in state.steps
+
+def test_warm_up_reaches_every_worker(monkeypatch):
+    def fake_worker_models():
+        time.sleep(0.05)
+        return {"pid": os.getpid(), "thread": threading.get_ident()}
+
+    executor = ComputeExecutor("encode", "thread", 3)
+    monkeypatch.setattr(compute, "encode_executor", executor)
+    monkeypatch.setattr(compute, "_worker_models", fake_worker_models)
+    try:
+        workers = asyncio.run(compute.warm_up())
+    finally:
+        executor.shutdown()
+    assert len(workers) == 3
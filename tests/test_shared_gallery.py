@@ -0,0 +1,121 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import datetime
+import numpy as np
+from gallery import FaceGallery
+import shared_gallery
+from shared_gallery import SharedGallery, WRITER, READER
+
+class FakeSync:
+    started = False
+
+    def start(self):
+        self.started = True
+
+def make_rows(count=30, seed=0):
+    rng = np.random.default_rng(seed)
+    return [(f"face-{i}", f"user-{i % 10}", f"name-{i % 10}", rng.normal(scale=0.1, size=128).tobytes())
+            for i in range(count)]
+
+def start_pair(directory):
+    source = FaceGallery()
+    source.replace(make_rows())
+    source.loaded_at = datetime.datetime(2024, 1, 1)
+    writer = SharedGallery(source, FakeSync(), str(directory), interval=3600)
+    writer.start(sync_enabled=False)
+    reader = SharedGallery(FaceGallery(), FakeSync(), str(directory), interval=3600)
+    reader.start(sync_enabled=False)
+    return writer, reader
+
+def test_reader_maps_the_writers_gallery(tmp_path):
+    writer, reader = start_pair(tmp_path)
+    try:
+        assert (writer.role, reader.role) == (WRITER, READER)
+        assert reader.generation == writer.generation == 1
+        queries = np.random.default_rng(1).normal(scale=0.1, size=(5, 128))
+        assert reader.gallery.best_matches(queries) == writer.gallery.best_matches(queries)
+        # Readers never change the shared copy themselves
+        assert not reader.gallery.add("face-x", "user-x", "x", np.zeros(128))
+        assert reader.gallery.remove(["face-0"]) == 0
+    finally:
+        reader.stop()
+        writer.stop()
+
+def test_readers_apply_deltas_without_remapping(tmp_path):
+    writer, reader = start_pair(tmp_path)
+    try:
+        assert not writer.publish()
+        writer.gallery.add("face-new", "user-new", "new", np.ones(128))
+        writer.gallery.remove(["face-0"])
+        assert writer.publish()
+        assert reader.refresh()
+        # Same generation, changes replayed into the mapped copy's spare rows
+        assert reader.generation == writer.generation == 1
+        assert writer.full_publishes == 1 and reader.deltas == 2
+        assert isinstance(reader.gallery._encodings, np.memmap)
+        # Face ids stay mapped too; only the changed ones are tracked per worker
+        assert isinstance(reader.gallery._face_ids, np.memmap)
+        assert len(reader.gallery._positions._rows) <= 3
+        assert "face-new" in reader.gallery and "face-0" not in reader.gallery
+        assert reader.gallery.best_match(np.ones(128)).name == "new"
+        assert reader.gallery.read_only and not reader.refresh()
+        assert sorted(os.listdir(tmp_path)) == ["gen-1", "generation", "writer.lock"]
+    finally:
+        reader.stop()
+        writer.stop()
+
+def test_replaced_gallery_is_published_as_a_new_generation(tmp_path):
+    writer, reader = start_pair(tmp_path)
+    try:
+        writer.gallery.replace(make_rows(5, seed=2))
+        assert writer.publish()
+        assert reader.refresh()
+        assert reader.generation == 2 and len(reader.gallery) == 5
+        assert sorted(os.listdir(tmp_path)) == ["gen-2", "generation", "writer.lock"]
+    finally:
+        reader.stop()
+        writer.stop()
+
+def test_deltas_are_compacted_before_spare_rows_run_out(tmp_path, monkeypatch):
+    monkeypatch.setattr(shared_gallery, "MIN_SPARE", 8)
+    writer, reader = start_pair(tmp_path)
+    try:
+        for i in range(8):
+            writer.gallery.add(f"face-extra-{i}", "user-extra", "extra", np.full(128, i / 10))
+            writer.publish()
+        assert writer.generation == 2
+        assert reader.refresh() and len(reader.gallery) == 38
+    finally:
+        reader.stop()
+        writer.stop()
+
+def test_reader_takes_over_when_writer_stops(tmp_path):
+    writer, reader = start_pair(tmp_path)
+    writer.stop()
+    try:
+        assert reader._try_lock()
+        reader._become_writer(sync_enabled=True)
+        assert reader.role == WRITER and reader.sync.started
+        assert reader.generation == 2 and not reader.gallery.read_only
+        assert len(reader.gallery) == 30
+    finally:
+        reader.stop()
+
+def test_new_writer_numbers_past_generations_readers_already_map(tmp_path):
+    writer, reader = start_pair(tmp_path)
+    behind = SharedGallery(FaceGallery(), FakeSync(), str(tmp_path), interval=3600)
+    behind.start(sync_enabled=False)
+    # The writer moves on to generation 2; reader maps it, behind does not
+    writer.gallery.replace(make_rows(20, seed=3))
+    writer.publish()
+    assert reader.refresh() and reader.generation == 2
+    writer.stop()
+    try:
+        assert behind.generation == 1 and behind._try_lock()
+        behind._become_writer(sync_enabled=False)
+        assert behind.generation == 3
+        assert reader.refresh() and reader.generation == 3
+    finally:
+        behind.stop()
+        reader.stop()
@@ -0,0 +1,71 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import datetime
+import numpy as np
+import snapshot
+from gallery import FaceGallery
+
+def make_snapshot(path, people=20, shots=3, seed=0):
+    rng = np.random.default_rng(seed)
+    encodings = rng.normal(scale=0.1, size=(people * shots, 128))
+    face_ids = [f"face-{i}" for i in range(len(encodings))]
+    user_codes = np.arange(len(encodings)) // shots
+    users = [[f"user-{u}", f"name-{u}"] for u in range(people)]
+    snapshot.write(path, encodings, face_ids, user_codes, users, datetime.datetime(2024, 1, 2, 3, 4, 5))
+    rows = [(face_ids[i], users[user_codes[i]][0], users[user_codes[i]][1], encodings[i].tobytes())
+            for i in range(len(encodings))]
+    return rows, encodings
+
+def test_snapshot_gallery_matches_database_load(tmp_path):
+    path = str(tmp_path / "snap")
+    rows, encodings = make_snapshot(path)
+    expected = FaceGallery()
+    expected.replace(rows)
+
+    mapped = FaceGallery()
+    assert snapshot.load(mapped, path) == len(rows)
+    assert mapped.loaded_at == datetime.datetime(2024, 1, 2, 3, 4, 5)
+    assert len(mapped) == len(expected) and mapped.user_count == expected.user_count
+    for strategy in ("min", "centroid"):
+        assert mapped.best_matches(encodings[::7], strategy) == expected.best_matches(encodings[::7], strategy)
+
+def test_snapshot_file_is_not_modified_by_gallery_updates(tmp_path):
+    path = str(tmp_path / "snap")
+    _, encodings = make_snapshot(path)
+    mapped = FaceGallery()
+    snapshot.load(mapped, path)
+
+    assert mapped.remove(["face-0"]) == 1
+    assert mapped.add("face-new", "user-new", "new", np.ones(128))
+    assert mapped.best_match(np.ones(128)).user_id == "user-new"
+
+    columns, meta = snapshot.read(path)
+    assert meta["count"] == len(encodings)
+    np.testing.assert_array_equal(columns["encodings"], encodings)
+    assert columns["face_ids"][0] == "face-0"
+
+def test_mapped_face_ids_are_found_without_a_per_row_dict(tmp_path):
+    path = str(tmp_path / "snap")
+    make_snapshot(path)
+    mapped = FaceGallery()
+    snapshot.load(mapped, path)
+    assert isinstance(mapped._face_ids, np.memmap)
+    assert mapped._positions._rows == {}
+    assert all(f"face-{i}" in mapped for i in range(60)) and "face-60" not in mapped
+
+    # Only the ids that change are tracked; the last row moves into the gap
+    assert mapped.remove(["face-0", "face-10"]) == 2
+    assert mapped.add("face-0", "user-0", "name-0", np.ones(128))
+    assert sorted(mapped._positions._rows) == ["face-0", "face-10", "face-58", "face-59"]
+    assert "face-10" not in mapped and "face-59" in mapped
+    with mapped.view() as (_, face_ids):
+        assert all(mapped._positions.get(str(face_id)) == i for i, face_id in enumerate(face_ids))
+
+def test_rewriting_replaces_previous_snapshot(tmp_path):
+    path = str(tmp_path / "snap")
+    make_snapshot(path, people=5)
+    make_snapshot(path, people=8)
+    _, meta = snapshot.read(path)
+    assert meta["count"] == 24
+    assert sorted(os.listdir(tmp_path)) == ["snap"]
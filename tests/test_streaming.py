@@ -0,0 +1,54 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import asyncio
+import json
+from streaming import LatestFrameScheduler
+
+class FakeWebSocket:
+    def __init__(self):
+        self.incoming = asyncio.Queue()
+        self.sent = []
+
+    async def receive(self):
+        return await self.incoming.get()
+
+    async def send_json(self, message):
+        self.sent.append(message)
+
+    def push(self, message):
+        self.incoming.put_nowait({"type": "websocket.receive", "text": json.dumps(message)})
+
+    def disconnect(self):
+        self.incoming.put_nowait({"type": "websocket.disconnect", "code": 1000})
+
+def test_only_newest_frame_is_processed():
+    async def scenario():
+        websocket = FakeWebSocket()
+        async with LatestFrameScheduler(websocket) as scheduler:
+            for i in range(5):
+                websocket.push({"image": "x", "seq": i})
+            await asyncio.sleep(0)
+            data, _, dropped = await scheduler.next_frame()
+            assert (data["seq"], dropped) == (4, 4)
+
+            websocket.push({"image": "x", "seq": 5})
+            data, received_at, dropped = await scheduler.next_frame()
+            assert (data["seq"], dropped) == (5, 0)
+            assert scheduler.stats(received_at, dropped)["dropped_total"] == 4
+
+            websocket.disconnect()
+            assert await scheduler.next_frame() is None
+
+    asyncio.run(scenario())
+
+def test_invalid_messages_get_an_error_reply():
+    async def scenario():
+        websocket = FakeWebSocket()
+        async with LatestFrameScheduler(websocket) as scheduler:
+            websocket.incoming.put_nowait({"type": "websocket.receive", "bytes": b"\x01"})
+            websocket.disconnect()
+            assert await scheduler.next_frame() is None
+        assert websocket.sent[0]["type"] == "error"
+
+    asyncio.run(scenario())
@@ -0,0 +1,80 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import cv2
+import numpy as np
+import tracking
+from tracking import FaceTracker, IdentityCache, associate, iou, Track
+
+def load_image(filename):
+    return cv2.imread(os.path.join(os.path.dirname(__file__), "images", filename))
+
+def shifted(image, dx, dy):
+    return cv2.warpAffine(image, np.float32([[1, 0, dx], [0, 1, dy]]), (image.shape[1], image.shape[0]),
+                          borderMode=cv2.BORDER_REPLICATE)
+
+def test_iou_and_greedy_association():
+    assert iou((0, 0, 10, 10), (0, 0, 10, 10)) == 1.0
+    assert iou((0, 0, 10, 10), (20, 20, 5, 5)) == 0.0
+    tracks = [Track(1, (0, 0, 10, 10)), Track(2, (50, 50, 10, 10))]
+    pairs, unmatched = associate(tracks, [(51, 51, 10, 10), (100, 100, 10, 10), (1, 0, 10, 10)])
+    assert sorted((track.id, b) for track, b in pairs) == [(1, 2), (2, 0)]
+    assert unmatched == [1]
+
+def test_tracks_keep_ids_between_full_detections():
+    image = load_image("multi_face.png")
+    tracker = FaceTracker(detect_interval=4)
+    tracks, full = tracker.update(image)
+    assert full and len(tracks) > 1
+    ids = {track["track_id"] for track in tracks}
+
+    for step in range(1, 6):
+        tracks, full = tracker.update(shifted(image, 2 * step, step))
+        assert {track["track_id"] for track in tracks} == ids
+    # One full detection up front and one after detect_interval frames
+    assert tracker.full_detections == 2
+    assert tracker.frames == 6
+
+def test_lost_track_triggers_full_detection():
+    tracker = FaceTracker(detect_interval=100)
+    tracker.update(load_image("multi_face.png"))
+    blank = np.full_like(load_image("multi_face.png"), 127)
+    _, full = tracker.update(blank)
+    assert not full
+    _, full = tracker.update(blank)
+    assert full
+
+def test_downscaled_frames_keep_original_detector_thresholds(monkeypatch):
+    scales = []
+
+    def detect_faces(image, backend=None, scale=1.0):
+        scales.append(scale)
+        # A face 80 px wide in the original, 40 px in the half-size frame
+        return [{"x": 100, "y": 60, "width": 80, "height": 80}]
+
+    monkeypatch.setattr(tracking.detector, "detect_faces", detect_faces)
+    tracker = FaceTracker(detect_interval=100)
+    frame = np.zeros((120, 160, 3), dtype=np.uint8)
+    tracks, _ = tracker.update(frame, scale=0.5)
+    assert [(t["x"], t["y"], t["width"], t["height"]) for t in tracks] == [(50, 30, 40, 40)]
+    # Following the track searches a crop, which is still detected at the frame's scale
+    tracker.update(frame, scale=0.5)
+    assert scales == [0.5, 0.5]
+
+def test_identity_cache_encodes_each_track_once_until_refresh():
+    cache = IdentityCache(refresh_frames=3, retry_frames=1, min_confidence=0.5)
+    tracks = [{"track_id": 1}, {"track_id": 2}]
+    assert cache.due(tracks) == tracks
+    cache.store(1, {"confidence": 0.9})
+    cache.store(2, {"confidence": 0.2})
+
+    # The weak match is retried every frame, the strong one only on refresh
+    assert [t["track_id"] for t in cache.due(tracks)] == [2]
+    cache.store(2, {"confidence": 0.2})
+    assert [t["track_id"] for t in cache.due(tracks)] == [2]
+    cache.store(2, {"confidence": 0.2})
+    assert [t["track_id"] for t in cache.due(tracks)] == [1, 2]
+
+    # Entries of tracks that disappeared are dropped
+    cache.due([{"track_id": 2}])
+    assert len(cache) == 1 and cache.get(1) is None
@@ -0,0 +1,199 @@
+import itertools
+import os
+
+import detector
+
+# Full-frame detection runs every this many frames (and whenever a track is lost)
+TRACK_DETECT_INTERVAL = int(os.getenv('TRACK_DETECT_INTERVAL', '10'))
+# Padding around a track's last box, as a fraction of its size, searched between detections
+TRACK_ROI_PADDING = float(os.getenv('TRACK_ROI_PADDING', '0.5'))
+# Minimum overlap for a detection to continue an existing track
+TRACK_IOU_THRESHOLD = float(os.getenv('TRACK_IOU_THRESHOLD', '0.3'))
+# Full detections a track may go unmatched before it is dropped
+TRACK_MAX_MISSES = int(os.getenv('TRACK_MAX_MISSES', '2'))
+# A track's cached identity is re-checked after this many frames
+RECOGNIZE_REFRESH_FRAMES = int(os.getenv('RECOGNIZE_REFRESH_FRAMES', '30'))
+# Tracks whose cached match is weaker than this are re-checked more often
+RECOGNIZE_MIN_CONFIDENCE = float(os.getenv('RECOGNIZE_MIN_CONFIDENCE', '0.5'))
+RECOGNIZE_RETRY_FRAMES = int(os.getenv('RECOGNIZE_RETRY_FRAMES', '5'))
+
+
+def iou(a, b):
+    """Intersection over union of two (x, y, width, height) boxes"""
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    iw = min(ax + aw, bx + bw) - max(ax, bx)
+    ih = min(ay + ah, by + bh) - max(ay, by)
+    if iw <= 0 or ih <= 0:
+        return 0.0
+    inter = iw * ih
+    return inter / (aw * ah + bw * bh - inter)
+
+
+def associate(tracks, boxes, threshold=TRACK_IOU_THRESHOLD):
+    """Greedy IoU matching; returns (pairs of (track, box index), unmatched box indices)"""
+    candidates = sorted(
+        ((iou(track.box, box), t, b) for t, track in enumerate(tracks) for b, box in enumerate(boxes)),
+        reverse=True
+    )
+    used_tracks, used_boxes, pairs = set(), set(), []
+    for overlap, t, b in candidates:
+        if overlap < threshold:
+            break
+        if t in used_tracks or b in used_boxes:
+            continue
+        used_tracks.add(t)
+        used_boxes.add(b)
+        pairs.append((tracks[t], b))
+    return pairs, [b for b in range(len(boxes)) if b not in used_boxes]
+
+
+class Track:
+    def __init__(self, track_id, box):
+        self.id = track_id
+        self.box = box
+        self.misses = 0
+        self.hits = 1
+
+    def to_dict(self):
+        x, y, w, h = self.box
+        return {"track_id": self.id, "x": x, "y": y, "width": w, "height": h}
+
+
+def _box_tuple(face):
+    return (face["x"], face["y"], face["width"], face["height"])
+
+
+class FaceTracker:
+    """Per-connection face tracker for streaming detection.
+
+    A full-frame detection runs every detect_interval frames, or on the next
+    frame after a track is lost. In between, each track is followed by
+    re-running the detector only inside a padded region around its last box,
+    which is a small fraction of the frame. Track ids stay stable across
+    frames through IoU association.
+
+    Frames may be downscaled working images: boxes are kept in the frame's
+    pixels, while the detector's minimum face size stays in original ones.
+    """
+
+    def __init__(self, detect_interval=TRACK_DETECT_INTERVAL, backend=None):
+        self.detect_interval = max(1, detect_interval)
+        self.backend = backend
+        self.tracks = []
+        self.frames = 0
+        self.full_detections = 0
+        self._ids = itertools.count(1)
+        self._since_detection = 0
+        self._lost = False
+
+    def update(self, image, scale=1.0):
+        """Track faces in the next BGR frame; returns (tracks as dicts, whether a full detection ran).
+
+        scale is how much the frame was reduced from the original image.
+        """
+        self.frames += 1
+        full = not self.tracks or self._lost or self._since_detection >= self.detect_interval
+        if full:
+            self._detect(image, scale)
+        else:
+            self._follow(image, scale)
+        return [track.to_dict() for track in self.tracks], full
+
+    def _detect_boxes(self, image, scale):
+        # The detector returns original pixels; tracks stay in the frame's
+        return [tuple(int(round(v * scale)) for v in _box_tuple(face))
+                for face in detector.detect_faces(image, self.backend, scale=scale)]
+
+    def _detect(self, image, scale):
+        self.full_detections += 1
+        self._since_detection = 1
+        self._lost = False
+        boxes = self._detect_boxes(image, scale)
+        pairs, unmatched = associate(self.tracks, boxes)
+        matched = set()
+        for track, b in pairs:
+            track.box = boxes[b]
+            track.misses = 0
+            track.hits += 1
+            matched.add(track.id)
+        for track in self.tracks:
+            if track.id not in matched:
+                track.misses += 1
+        self.tracks = [track for track in self.tracks if track.misses <= TRACK_MAX_MISSES]
+        self.tracks.extend(Track(next(self._ids), boxes[b]) for b in unmatched)
+
+    def _follow(self, image, scale):
+        self._since_detection += 1
+        height, width = image.shape[:2]
+        for track in self.tracks:
+            x, y, w, h = track.box
+            pad_x, pad_y = int(w * TRACK_ROI_PADDING), int(h * TRACK_ROI_PADDING)
+            left, top = max(0, x - pad_x), max(0, y - pad_y)
+            right, bottom = min(width, x + w + pad_x), min(height, y + h + pad_y)
+            if right <= left or bottom <= top:
+                self._lost = True
+                continue
+            boxes = [(x + left, y + top, w, h)
+                     for (x, y, w, h) in self._detect_boxes(image[top:bottom, left:right], scale)]
+            best = max(boxes, key=lambda box: iou(track.box, box), default=None)
+            if best is not None and iou(track.box, best) >= TRACK_IOU_THRESHOLD:
+                track.box = best
+                track.hits += 1
+            else:
+                # Keep the last box and confirm with a full detection on the next frame
+                self._lost = True
+
+
+class IdentityCache:
+    """Cached gallery match per track id for streaming recognition.
+
+    A track is encoded when it first appears, then again only every
+    refresh_frames frames, or every retry_frames frames while its match is
+    missing or below min_confidence. Everything else reuses the cached
+    identity, so a face that stays in view costs one encoding.
+    """
+
+    def __init__(self, refresh_frames=RECOGNIZE_REFRESH_FRAMES, retry_frames=RECOGNIZE_RETRY_FRAMES,
+                 min_confidence=RECOGNIZE_MIN_CONFIDENCE):
+        self.refresh_frames = max(1, refresh_frames)
+        self.retry_frames = max(1, retry_frames)
+        self.min_confidence = min_confidence
+        self.encodings = 0
+        self.hits = 0
+        # track id -> [identity, frames since it was encoded]
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def due(self, tracks):
+        """Advance every entry by one frame and return the tracks that need encoding"""
+        live = {track["track_id"] for track in tracks}
+        for track_id in list(self._entries):
+            if track_id not in live:
+                del self._entries[track_id]
+
+        due = []
+        for track in tracks:
+            entry = self._entries.get(track["track_id"])
+            if entry is not None:
+                entry[1] += 1
+            if entry is None or entry[1] >= self._interval(entry[0]):
+                due.append(track)
+            else:
+                self.hits += 1
+        return due
+
+    def _interval(self, identity):
+        if identity is None or identity.get("confidence", 0) < self.min_confidence:
+            return self.retry_frames
+        return self.refresh_frames
+
+    def store(self, track_id, identity):
+        self.encodings += 1
+        self._entries[track_id] = [identity, 0]
+
+    def get(self, track_id):
+        entry = self._entries.get(track_id)
+        return entry[0] if entry is not None else None
@@ -1,33 +1,96 @@
+import asyncio
+import os
 import uuid
-import base64
-import io
 from fastapi import WebSocket, WebSocketDisconnect
-import face_recognition
-import numpy as np
-from db import get_db_connection, get_db_cursor
+from db_async import database, upsert_user, insert_faces, is_cancelled, mark_cancelled
+from gallery import gallery, MATCH_TOLERANCE
+from compute import encode_faces, encode_faces_at, detect_faces, track_faces
+from frames import negotiate_subprotocol, receive_message, image_bytes_of
+from streaming import LatestFrameScheduler
+from tracking import FaceTracker, IdentityCache
+from metrics import observe_frame
 import logging
-import cv2
-import os
+import time
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Frames of one registration session that may be encoding at the same time
+REGISTER_MAX_PENDING = int(os.getenv('REGISTER_MAX_PENDING', '4'))
+
 async def websocket_register(websocket: WebSocket):
-    """Handle face registration via WebSocket with better error handling"""
-    await websocket.accept()
+    """Handle face registration via WebSocket with better error handling.
+
+    Frames are encoded concurrently as they arrive, up to
+    REGISTER_MAX_PENDING at a time, so "finish" only waits for the frames
+    still in flight before storing everything in one transaction.
+    """
+    await websocket.accept(subprotocol=negotiate_subprotocol(websocket))
     images = []
+    pending = set()
     name = None
     registration_id = str(uuid.uuid4())
+    data = {}
+    send_lock = asyncio.Lock()
+
+    async def send_json(message):
+        # Encoding tasks and the receive loop reply on the same socket
+        async with send_lock:
+            await websocket.send_json(message)
+
+    async def encode_image(image_bytes, seq):
+        try:
+            started = time.perf_counter()
+            encodings = await encode_faces(image_bytes)
+            observe_frame("/ws/register", time.perf_counter() - started)
+            
+            if len(encodings) == 0:
+                await send_json({
+                    "type": "error", 
+                    "message": "No face detected."
+                })
+                return
+            
+            if len(encodings) > 1:
+                await send_json({
+                    "type": "error", 
+                    "message": "Multiple faces detected."
+                })
+                return
+            
+            images.append(encodings[0])
+            response = {"type": "progress", "count": len(images)}
+            if seq is not None:
+                response["seq"] = seq
+            await send_json(response)
+        
+        except Exception as e:
+            logger.error(f"Error processing image: {e}")
+            await send_json({
+                "type": "error", 
+                "message": f"Error processing image: {str(e)}"
+            })
+
+    async def cancel_pending():
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        pending.clear()
     
     try:
         while True:
-            data = await websocket.receive_json()
+            try:
+                data = await receive_message(websocket)
+            except ValueError as e:
+                await send_json({"type": "error", "message": f"Invalid message: {str(e)}"})
+                continue
             
             if data.get("type") == "start":
+                await cancel_pending()
                 name = data.get("name")
                 images = []
-                await websocket.send_json({
+                await send_json({
                     "type": "info", 
                     "message": "Registration started.", 
                     "registration_id": registration_id
@@ -35,96 +98,59 @@ async def websocket_register(websocket: WebSocket):
             
             elif data.get("type") == "image":
                 try:
-                    img_b64 = data.get("image")
-                    if not img_b64:
-                        await websocket.send_json({
-                            "type": "error", 
-                            "message": "No image data received."
-                        })
-                        continue
-                    
-                    image_bytes = base64.b64decode(img_b64)
-                    img = face_recognition.load_image_file(io.BytesIO(image_bytes))
-                    encodings = face_recognition.face_encodings(img)
-                    
-                    if len(encodings) == 0:
-                        await websocket.send_json({
-                            "type": "error", 
-                            "message": "No face detected."
-                        })
-                        continue
-                    
-                    if len(encodings) > 1:
-                        await websocket.send_json({
-                            "type": "error", 
-                            "message": "Multiple faces detected."
-                        })
-                        continue
-                    
-                    images.append(encodings[0])
-                    await websocket.send_json({
-                        "type": "progress", 
-                        "count": len(images)
+                    image_bytes = image_bytes_of(data)
+                except ValueError as e:
+                    # binascii.Error from a malformed base64 field is a ValueError
+                    await send_json({
+                        "type": "error",
+                        "message": f"Error processing image: {str(e)}"
                     })
-                
-                except Exception as e:
-                    logger.error(f"Error processing image: {e}")
-                    await websocket.send_json({
+                    continue
+                if not image_bytes:
+                    await send_json({
                         "type": "error", 
-                        "message": f"Error processing image: {str(e)}"
+                        "message": "No image data received."
                     })
+                    continue
+                
+                # Stop reading while the session already has enough frames in flight
+                if len(pending) >= REGISTER_MAX_PENDING:
+                    _, still_pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    pending.intersection_update(still_pending)
+                task = asyncio.create_task(encode_image(image_bytes, data.get("seq")))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
             
             elif data.get("type") == "finish":
+                if pending:
+                    await asyncio.gather(*pending)
                 if not name or len(images) < 5:
-                    await websocket.send_json({
+                    await send_json({
                         "type": "error", 
                         "message": "Not enough images or name missing."
                     })
                     continue
                 
                 try:
-                    # Check if cancelled
-                    with get_db_cursor() as cur:
-                        cur.execute(
-                            "SELECT 1 FROM cancel_points WHERE registration_id = %s", 
-                            (registration_id,)
-                        )
-                        if cur.fetchone():
-                            await websocket.send_json({
-                                "type": "stopped", 
-                                "message": "Registration was cancelled."
-                            })
-                            break
+                    # Check for cancellation and store the user and encodings in a
+                    # single transaction: three statements, whatever the image count
+                    async with database.transaction() as conn:
+                        cancelled = await is_cancelled(conn, registration_id)
+                        if not cancelled:
+                            user_id = await upsert_user(conn, name)
+                            face_ids = await insert_faces(conn, user_id, images, registration_id)
+                    if cancelled:
+                        await send_json({
+                            "type": "stopped", 
+                            "message": "Registration was cancelled."
+                        })
+                        break
                     
-                    # Store user and encodings within a single transaction
-                    with get_db_connection() as conn:
-                        with conn.cursor() as cur:
-                            # Create or get user
-                            cur.execute(
-                                "INSERT INTO users (name) VALUES (%s) ON CONFLICT (name) DO NOTHING RETURNING id",
-                                (name,)
-                            )
-                            result = cur.fetchone()
-                            if result is None:
-                                cur.execute("SELECT id FROM users WHERE name = %s", (name,))
-                                result = cur.fetchone()
-                                if result is None:
-                                    await websocket.send_json({
-                                        "type": "error", 
-                                        "message": "Failed to create or retrieve user."
-                                    })
-                                    break
-                            
-                            user_id = result[0]
-                            
-                            # Store all face encodings
-                            for encoding in images:
-                                cur.execute(
-                                    "INSERT INTO user_faces (user_id, face_encoding, registration_id) VALUES (%s, %s, %s)",
-                                    (user_id, encoding.tobytes(), registration_id)
-                                )
+                    # Make the new faces recognizable without reloading the gallery
+                    for face_id, encoding in zip(face_ids, images):
+                        gallery.add(face_id, user_id, name, encoding)
                     
-                    await websocket.send_json({
+                    await send_json({
                         "type": "done", 
                         "message": f"Registered {name} with {len(images)} images."
                     })
@@ -132,23 +158,21 @@ async def websocket_register(websocket: WebSocket):
                     
                 except Exception as e:
                     logger.error(f"Database error during registration: {e}")
-                    await websocket.send_json({
+                    await send_json({
                         "type": "error", 
                         "message": f"Database error: {str(e)}"
                     })
                     break
             
             elif data.get("type") == "stop":
+                await cancel_pending()
                 try:
                     # Mark as cancelled
-                    with get_db_cursor() as cur:
-                        cur.execute(
-                            "INSERT INTO cancel_points (registration_id) VALUES (%s) ON CONFLICT DO NOTHING", 
-                            (registration_id,)
-                        )
+                    async with database.connection() as conn:
+                        await mark_cancelled(conn, registration_id)
                     
                     images.clear()
-                    await websocket.send_json({
+                    await send_json({
                         "type": "stopped", 
                         "message": "Registration cancelled and will be cleaned up."
                     })
@@ -156,7 +180,7 @@ async def websocket_register(websocket: WebSocket):
                     
                 except Exception as e:
                     logger.error(f"Error cancelling registration: {e}")
-                    await websocket.send_json({
+                    await send_json({
                         "type": "error", 
                         "message": f"Error cancelling registration: {str(e)}"
                     })
@@ -167,11 +191,8 @@ async def websocket_register(websocket: WebSocket):
         # If disconnected during active registration, mark as cancelled
         if name and not data.get("type") == "finish":
             try:
-                with get_db_cursor() as cur:
-                    cur.execute(
-                        "INSERT INTO cancel_points (registration_id) VALUES (%s) ON CONFLICT DO NOTHING", 
-                        (registration_id,)
-                    )
+                async with database.connection() as conn:
+                    await mark_cancelled(conn, registration_id)
                 logger.info(f"Marked registration as cancelled after disconnect: {registration_id}")
             except Exception as e:
                 logger.error(f"Error marking registration as cancelled: {e}")
@@ -179,45 +200,62 @@ async def websocket_register(websocket: WebSocket):
     except Exception as e:
         logger.error(f"Unexpected error in websocket_register: {e}")
         try:
-            await websocket.send_json({
+            await send_json({
                 "type": "error", 
                 "message": "An unexpected error occurred."
             })
         except:
             pass  # Connection might be closed already
+    
+    finally:
+        await cancel_pending()
 
 async def websocket_detect(websocket: WebSocket):
-    """WebSocket endpoint for real-time face detection"""
-    await websocket.accept()
+    """WebSocket endpoint for real-time face detection.
+
+    Frames that arrive while a detection is running are dropped in favour
+    of the newest one, so boxes never lag behind the camera. Connecting with
+    ?mode=track follows faces between periodic full detections and tags
+    each box with a stable track_id.
+    """
+    await websocket.accept(subprotocol=negotiate_subprotocol(websocket))
+    tracker = FaceTracker() if websocket.query_params.get("mode") == "track" else None
     try:
-        while True:
-            data = await websocket.receive_json()
-            img_b64 = data.get("image")
-            if not img_b64:
-                await websocket.send_json({"type": "error", "message": "No image data received."})
-                continue
-            try:
-                image_bytes = base64.b64decode(img_b64)
-                np_arr = np.frombuffer(image_bytes, np.uint8)
-                img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-                if img is None:
-                    await websocket.send_json({"type": "error", "message": "Could not decode image."})
-                    continue
-                gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-                cascade_path = os.path.join(os.path.dirname(__file__), "haarcascade_frontalface_default.xml")
-                face_cascade = cv2.CascadeClassifier(cascade_path)
-                faces = face_cascade.detectMultiScale(
-                    gray,
-                    scaleFactor=1.1,
-                    minNeighbors=5,
-                    minSize=(30, 30)
-                )
-                face_list = []
-                for (x, y, w, h) in faces:
-                    face_list.append({"x": int(x), "y": int(y), "width": int(w), "height": int(h)})
-                await websocket.send_json({"type": "faces", "faces": face_list})
-            except Exception as e:
-                await websocket.send_json({"type": "error", "message": f"Detection error: {str(e)}"})
+        async with LatestFrameScheduler(websocket) as scheduler:
+            while True:
+                frame = await scheduler.next_frame()
+                if frame is None:
+                    break
+                data, received_at, dropped = frame
+                try:
+                    image_bytes = image_bytes_of(data)
+                    if not image_bytes:
+                        await scheduler.send_json({"type": "error", "message": "No image data received."})
+                        continue
+                    # Binary frames are decoded straight from the received buffer
+                    started = time.perf_counter()
+                    if tracker is not None:
+                        result = await track_faces(tracker, image_bytes)
+                        face_list, full_detection = result if result is not None else (None, None)
+                    else:
+                        face_list = await detect_faces(image_bytes)
+                    if face_list is None:
+                        await scheduler.send_json({"type": "error", "message": "Could not decode image."})
+                        continue
+                    response = {
+                        "type": "faces",
+                        "faces": face_list,
+                        "processing_ms": round(1000 * (time.perf_counter() - started), 2),
+                        **scheduler.stats(received_at, dropped),
+                    }
+                    if tracker is not None:
+                        response["full_detection"] = full_detection
+                    if "seq" in data:
+                        response["seq"] = data["seq"]
+                    observe_frame("/ws/detect", time.perf_counter() - started)
+                    await scheduler.send_json(response)
+                except Exception as e:
+                    await scheduler.send_json({"type": "error", "message": f"Detection error: {str(e)}"})
     except WebSocketDisconnect:
         pass
     except Exception as e:
@@ -226,3 +264,81 @@ async def websocket_detect(websocket: WebSocket):
             await websocket.send_json({"type": "error", "message": "Unexpected error."})
         except:
             pass
+
+def track_identity(match):
+    """Cached identity of a track from its best gallery match"""
+    if match is None:
+        return {"id": None, "name": None, "distance": None, "confidence": 0.0, "is_match": False}
+    is_match = match.distance <= MATCH_TOLERANCE
+    return {
+        "id": match.user_id if is_match else None,
+        "name": match.name if is_match else None,
+        "distance": match.distance,
+        "confidence": float(max(0, 1 - match.distance)),
+        "is_match": is_match,
+    }
+
+async def websocket_recognize(websocket: WebSocket):
+    """WebSocket endpoint for real-time face recognition.
+
+    Faces are tracked between frames and each track's identity is cached,
+    so only new tracks, and tracks due for a periodic re-check, are encoded
+    and matched against the gallery. Frame handling is latest-frame-wins as
+    in /ws/detect.
+    """
+    await websocket.accept(subprotocol=negotiate_subprotocol(websocket))
+    tracker = FaceTracker()
+    identities = IdentityCache()
+    try:
+        async with LatestFrameScheduler(websocket) as scheduler:
+            while True:
+                frame = await scheduler.next_frame()
+                if frame is None:
+                    break
+                data, received_at, dropped = frame
+                try:
+                    image_bytes = image_bytes_of(data)
+                    if not image_bytes:
+                        await scheduler.send_json({"type": "error", "message": "No image data received."})
+                        continue
+                    started = time.perf_counter()
+                    result = await track_faces(tracker, image_bytes)
+                    if result is None:
+                        await scheduler.send_json({"type": "error", "message": "Could not decode image."})
+                        continue
+                    tracks, full_detection = result
+
+                    due = identities.due(tracks)
+                    if due:
+                        boxes = [(t["x"], t["y"], t["width"], t["height"]) for t in due]
+                        encodings = await encode_faces_at(image_bytes, boxes)
+                        confirmed = [encoding for encoding in encodings if encoding is not None]
+                        matches = iter(gallery.best_matches(confirmed) if confirmed else [])
+                        for track, encoding in zip(due, encodings):
+                            # A track HOG does not confirm is unknown until its next retry
+                            match = next(matches) if encoding is not None else None
+                            identities.store(track["track_id"], track_identity(match))
+
+                    response = {
+                        "type": "faces",
+                        "faces": [{**track, **(identities.get(track["track_id"]) or track_identity(None))}
+                                  for track in tracks],
+                        "encoded": len(due),
+                        "full_detection": full_detection,
+                        "processing_ms": round(1000 * (time.perf_counter() - started), 2),
+                        **scheduler.stats(received_at, dropped),
+                    }
+                    if "seq" in data:
+                        response["seq"] = data["seq"]
+                    observe_frame("/ws/recognize", time.perf_counter() - started)
+                    await scheduler.send_json(response)
+                except Exception as e:
+                    await scheduler.send_json({"type": "error", "message": f"Recognition error: {str(e)}"})
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logging.error(f"WebSocket recognize error: {e}")
+        try:
+            await websocket.send_json({"type": "error", "message": "Unexpected error."})
+        except:
+            pass